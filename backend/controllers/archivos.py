@@ -0,0 +1,189 @@
+import os
+import struct
+import uuid
+from typing import BinaryIO, Iterator
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from sqlalchemy.orm import Session
+
+from backend.controllers.cache_claves import cargar_clave_publica, propietario_usuario
+from backend.controllers.keys import firmar_digest, get_hash_function
+from backend.controllers.sobre import abrir_sobre_guardado, cifrar_sobre, codificar_sobre
+from backend.database import db as db_instance
+from backend.database.schemas import Archivos, User
+
+# Cifrado por segmentos autenticados (construcción STREAM sobre AES-GCM):
+#
+#   cabecera: versión (1 byte) | tamaño de segmento (4 bytes) | prefijo del nonce (7 bytes)
+#   segmentos: ciphertext + tag de hasta ``tamaño de segmento`` bytes de texto plano cada uno
+#
+# El nonce del segmento i es prefijo (7 bytes) | i (4 bytes) | 1 si es el último segmento y 0 si no.
+# La cabecera va como datos asociados de todos los segmentos. Cambiar el orden de los segmentos,
+# quitar los del final o añadir otros hace fallar el tag; cada segmento se descifra por separado,
+# así que la memoria no depende del tamaño del archivo.
+VERSION_STREAM = 1
+LONGITUD_PREFIJO_NONCE = 7
+LONGITUD_CABECERA_STREAM = 1 + 4 + LONGITUD_PREFIJO_NONCE
+LONGITUD_TAG = 16
+MAX_SEGMENTOS = 2 ** 32
+
+# Bytes de texto plano por segmento cifrado
+TAMANO_SEGMENTO = int(os.getenv("ARCHIVOS_TAMANO_SEGMENTO", str(64 * 1024)))
+# Directorio donde se guardan los archivos cifrados
+DIRECTORIO_ARCHIVOS = os.getenv(
+    "ARCHIVOS_DIRECTORIO",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "archivos")
+)
+
+
+def _nonce_segmento(prefijo: bytes, indice: int, ultimo: bool) -> bytes:
+    if indice >= MAX_SEGMENTOS:
+        raise ValueError("El archivo supera el número máximo de segmentos")
+    return prefijo + struct.pack(">IB", indice, 1 if ultimo else 0)
+
+
+def cifrar_flujo(origen: BinaryIO, destino: BinaryIO, clave: bytes, hash_algo: str = "sha256", tamano_segmento: int = TAMANO_SEGMENTO) -> tuple[int, bytes]:
+    """
+    Cifra ``origen`` en ``destino`` por segmentos y calcula a la vez el hash del texto plano, en una
+    sola pasada y con un segmento en memoria.
+
+    :param origen: Archivo de texto plano abierto en binario
+    :param destino: Archivo donde se escribe la cabecera y los segmentos cifrados
+    :param clave: Clave AES-256
+    :param hash_algo: Algoritmo del hash del texto plano
+    :param tamano_segmento: Bytes de texto plano por segmento
+    :return: Tupla (tamaño del texto plano, hash del texto plano)
+    """
+    hash_func, _ = get_hash_function(hash_algo)
+    digest = hash_func()
+    aesgcm = AESGCM(clave)
+    prefijo = os.urandom(LONGITUD_PREFIJO_NONCE)
+    cabecera = struct.pack(">BI", VERSION_STREAM, tamano_segmento) + prefijo
+    destino.write(cabecera)
+
+    # Se lee un segmento por adelantado para saber cuál es el último (un archivo vacío es un segmento vacío)
+    indice, tamano = 0, 0
+    segmento = origen.read(tamano_segmento)
+    while True:
+        siguiente = origen.read(tamano_segmento)
+        ultimo = not siguiente
+        digest.update(segmento)
+        tamano += len(segmento)
+        destino.write(aesgcm.encrypt(_nonce_segmento(prefijo, indice, ultimo), segmento, cabecera))
+        if ultimo:
+            return tamano, digest.digest()
+        segmento = siguiente
+        indice += 1
+
+
+def descifrar_flujo(origen: BinaryIO, clave: bytes) -> Iterator[bytes]:
+    """
+    Inverso de ``cifrar_flujo``: produce el texto plano segmento a segmento.
+
+    :param origen: Archivo cifrado abierto en binario, al principio de la cabecera
+    :param clave: Clave AES-256
+    :raises ValueError: Si la cabecera no es válida o un segmento está truncado, alterado o fuera de orden
+    :return: Generador de bloques de texto plano
+    """
+    cabecera = origen.read(LONGITUD_CABECERA_STREAM)
+    if len(cabecera) < LONGITUD_CABECERA_STREAM:
+        raise ValueError("Archivo cifrado truncado")
+    version, tamano_segmento = struct.unpack(">BI", cabecera[:5])
+    if version != VERSION_STREAM:
+        raise ValueError(f"Versión de archivo cifrado no soportada: {version}")
+    prefijo = cabecera[5:]
+    aesgcm = AESGCM(clave)
+    tamano_cifrado = tamano_segmento + LONGITUD_TAG
+
+    indice = 0
+    segmento = origen.read(tamano_cifrado)
+    while True:
+        siguiente = origen.read(tamano_cifrado)
+        ultimo = not siguiente
+        try:
+            yield aesgcm.decrypt(_nonce_segmento(prefijo, indice, ultimo), segmento, cabecera)
+        except Exception:
+            raise ValueError(f"Segmento {indice} del archivo cifrado truncado o alterado")
+        if ultimo:
+            return
+        segmento = siguiente
+        indice += 1
+
+
+def ruta_archivo(nombre_almacenado: str) -> str:
+    return os.path.join(DIRECTORIO_ARCHIVOS, nombre_almacenado)
+
+
+def guardar_archivo(
+        origen: BinaryIO,
+        nombre: str,
+        propietario: User,
+        private_key: ec.EllipticCurvePrivateKey,
+        hash_algo: str = "sha256"
+) -> Archivos:
+    """
+    Cifra y guarda un archivo subido por un usuario. La clave AES del archivo se cifra con la clave
+    pública del usuario (sobre ECIES) y el hash del texto plano se firma con su clave privada.
+
+    :param origen: Contenido del archivo abierto en binario
+    :param nombre: Nombre original del archivo
+    :param propietario: Usuario que lo sube
+    :param private_key: Clave privada ECC del usuario, para firmar el hash
+    :param hash_algo: "sha256" o "sha3_256"
+    :raises ValueError: Si el algoritmo de hash no es soportado
+    :return: Registro del archivo guardado
+    """
+    get_hash_function(hash_algo)
+    os.makedirs(DIRECTORIO_ARCHIVOS, exist_ok=True)
+
+    clave = AESGCM.generate_key(bit_length=256)
+    nombre_almacenado = f"{uuid.uuid4().hex}.bin"
+    ruta = ruta_archivo(nombre_almacenado)
+    try:
+        with open(ruta, "wb") as destino:
+            tamano, digest = cifrar_flujo(origen, destino, clave, hash_algo)
+
+        public_key = cargar_clave_publica(propietario.public_key, propietario_usuario(propietario.id_pk))
+        with db_instance.write() as session:
+            archivo = Archivos(
+                id_propietario_fk=propietario.id_pk,
+                nombre=nombre,
+                nombre_almacenado=nombre_almacenado,
+                tamano=tamano,
+                algoritmo_hash=hash_algo,
+                hash_archivo=digest.hex(),
+                firma=firmar_digest(private_key, digest, hash_algo).hex(),
+                clave_aes_cifrada=codificar_sobre(cifrar_sobre(clave, public_key))
+            )
+            session.add(archivo)
+            session.flush()
+            session.expunge(archivo)
+            return archivo
+    except Exception:
+        if os.path.exists(ruta):
+            os.remove(ruta)
+        raise
+
+
+def obtener_archivo(session: Session, id_archivo: int) -> Archivos | None:
+    return session.query(Archivos).filter(Archivos.id_pk == id_archivo).one_or_none()
+
+
+def abrir_archivo(archivo: Archivos, private_key: ec.EllipticCurvePrivateKey) -> Iterator[bytes]:
+    """
+    Descifra la clave del archivo con la clave privada del propietario y devuelve el generador
+    del texto plano. La clave se comprueba antes de empezar a leer, así que una clave privada
+    incorrecta falla aquí y no a mitad de la descarga.
+
+    :param archivo: Registro del archivo
+    :param private_key: Clave privada ECC del propietario
+    :return: Generador de bloques de texto plano
+    """
+    clave = abrir_sobre_guardado(archivo.clave_aes_cifrada, private_key)
+
+    def generar():
+        with open(ruta_archivo(archivo.nombre_almacenado), "rb") as origen:
+            yield from descifrar_flujo(origen, clave)
+
+    return generar()
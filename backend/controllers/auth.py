@@ -4,6 +4,8 @@ from datetime import datetime, timedelta, timezone
 import jwt
 from fastapi import HTTPException, Header
 from jwt.exceptions import ExpiredSignatureError, DecodeError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from backend.database import db, User
 
@@ -88,6 +90,36 @@ def login(email: str, password: str) -> tuple[str, str]:
         return user.email, token
 
 
+"""
+
+----------------------- ASYNC -----------------------
+
+"""
+
+async def obtener_usuario_por_correo_async(session: AsyncSession, correo: str) -> User | None:
+    """Obtiene un usuario por su correo sin bloquear el event loop."""
+    resultado = await session.execute(select(User).where(User.correo == correo))
+    return resultado.scalars().first()
+
+
+async def obtener_usuario_por_id_async(session: AsyncSession, id_usuario: int) -> User | None:
+    """Obtiene un usuario por su id sin bloquear el event loop."""
+    return await session.get(User, id_usuario)
+
+
+async def registrar_usuario_async(session: AsyncSession, correo: str, contraseña_hash: str | None, public_key: str, nombre: str) -> User:
+    """Inserta un usuario nuevo y confirma la transacción."""
+    user = User(
+        correo=correo,
+        contraseña=contraseña_hash,
+        public_key=public_key,
+        nombre=nombre,
+        hash=None,
+    )
+    session.add(user)
+    await session.commit()
+    await session.refresh(user)
+    return user
 
 
 if __name__ == "__main__":
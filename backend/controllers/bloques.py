@@ -0,0 +1,412 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import func, insert, update
+from sqlalchemy.orm import Session
+
+from backend.database import db as db_instance
+from backend.database.schemas import Blockchain, Mensajes, MensajesGrupo, AnclajesParticion
+from backend.controllers.cabecera import prefijo_cabecera, completar_cabecera, hash_cabecera
+from backend.controllers.merkle import hoja_mensaje, hoja_cabeza, calcular_raiz
+from backend.controllers.minero import Minero, minero as minero_por_defecto
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Un bloque se sella cada BLOQUE_INTERVALO_SEGUNDOS o en cuanto haya BLOQUE_MAX_MENSAJES pendientes
+INTERVALO_BLOQUE = float(os.getenv("BLOQUE_INTERVALO_SEGUNDOS", "2"))
+MAX_MENSAJES_BLOQUE = int(os.getenv("BLOQUE_MAX_MENSAJES", "512"))
+# Cada ANCLAJE_INTERVALO_SEGUNDOS la cadena raíz ancla las cabezas de todas las particiones
+INTERVALO_ANCLAJE = float(os.getenv("ANCLAJE_INTERVALO_SEGUNDOS", "30"))
+
+HASH_GENESIS = "0" * 64
+
+# Cadena raíz: bloques antiguos, transacciones manuales y anclajes de las particiones
+PARTICION_RAIZ = "raiz"
+
+
+def particion_conversacion(id_usuario_a: int, id_usuario_b: int) -> str:
+    """Partición de la conversación entre dos usuarios (independiente del orden)."""
+    return f"par:{min(id_usuario_a, id_usuario_b)}:{max(id_usuario_a, id_usuario_b)}"
+
+
+def particion_grupo(id_grupo: int) -> str:
+    """Partición de los mensajes de un grupo."""
+    return f"grupo:{id_grupo}"
+
+
+class CabezaCadena:
+    """
+    Mantiene en memoria el último bloque de la cadena y serializa todos los appends con un lock.
+
+    Leer la cabeza y escribir el bloque ocurren dentro del mismo lock y la misma transacción,
+    así dos peticiones concurrentes nunca encadenan sobre el mismo ``hash_anterior`` (fork)
+    y ningún append paga la consulta ``ORDER BY id_bloque_pk DESC LIMIT 1``.
+    El lock es por proceso: la app se despliega con un único worker de uvicorn.
+    Cada partición tiene su propia cabeza y su propio lock (ver ``CadenasParticionadas``).
+    """
+
+    def __init__(self, database=db_instance, particion: str = PARTICION_RAIZ, minero: Minero = minero_por_defecto):
+        self.database = database
+        self.particion = particion
+        self.minero = minero
+        self.id_bloque = 0
+        self.hash_actual = HASH_GENESIS
+        self._cargada = False
+        self._lock = threading.Lock()
+
+    def recargar(self):
+        """Vuelve a leer la cabeza desde la base de datos (al arrancar o tras limpiar la base)."""
+        with self._lock:
+            self._recargar()
+
+    def invalidar(self):
+        """Marca la cabeza para releerla de la base en el próximo append."""
+        with self._lock:
+            self._cargada = False
+
+    def _recargar(self):
+        ultimo = None
+        with self.database.read() as session:
+            ultimo = (
+                session.query(Blockchain.id_bloque_pk, Blockchain.hash_actual)
+                .filter(Blockchain.particion == self.particion)
+                .order_by(Blockchain.id_bloque_pk.desc())
+                .first()
+            )
+        self.id_bloque, self.hash_actual = (ultimo.id_bloque_pk, ultimo.hash_actual) if ultimo else (0, HASH_GENESIS)
+        self._cargada = True
+
+    def agregar(self, preparar: Callable[[Session], tuple | None]) -> tuple[int, str] | None:
+        """
+        Encadena un bloque nuevo tras la cabeza actual y confirma la transacción.
+
+        :param preparar: Función que recibe la sesión de escritura y devuelve
+            ``(raiz_merkle, num_transacciones, al_agregar)`` o None si no hay nada que encadenar.
+            ``al_agregar(session, id_bloque)`` (opcional) se ejecuta en la misma transacción.
+        :return: Tupla (id_bloque, hash_actual) del bloque creado, o None
+        """
+        with self._lock:
+            if not self._cargada:
+                self._recargar()
+
+            try:
+                with self.database.write() as session:
+                    contenido = preparar(session)
+                    if contenido is None:
+                        return None
+                    raiz_merkle, num_transacciones, al_agregar = contenido
+
+                    # El hash del bloque es el de su cabecera binaria; el minado solo varía el nonce final
+                    timestamp = datetime.utcnow()
+                    dificultad = self.minero.dificultad
+                    prefijo = prefijo_cabecera(self.hash_actual, raiz_merkle, timestamp, dificultad, num_transacciones)
+                    nonce = self.minero.minar(prefijo, dificultad)
+                    cabecera = completar_cabecera(prefijo, nonce)
+                    bloque = Blockchain(
+                        particion=self.particion,
+                        hash_anterior=self.hash_actual,
+                        hash_actual=hash_cabecera(cabecera),
+                        cabecera=cabecera,
+                        nonce=f"{nonce:016x}",
+                        dificultad=dificultad,
+                        timestamp=timestamp,
+                        raiz_merkle=raiz_merkle,
+                        num_transacciones=num_transacciones,
+                    )
+                    session.add(bloque)
+                    session.flush()
+
+                    if al_agregar:
+                        al_agregar(session, bloque.id_bloque_pk)
+
+                    nueva_cabeza = (bloque.id_bloque_pk, bloque.hash_actual)
+            except Exception:
+                # No se sabe si la cabeza en memoria sigue siendo válida: se relee en el próximo append
+                self._cargada = False
+                raise
+
+            self.id_bloque, self.hash_actual = nueva_cabeza
+            return nueva_cabeza
+
+    def agregar_contenido(self, contenido: str, num_transacciones: int = 0) -> tuple[int, str]:
+        """Encadena un bloque cuyo contenido es un hash ya calculado (p. ej. una transacción manual)."""
+        return self.agregar(lambda session: (contenido, num_transacciones, None))
+
+
+class CadenasParticionadas:
+    """
+    Registro de las cabezas de cada partición (una por conversación, una por grupo y la raíz).
+    Los appends de particiones distintas no comparten lock, así que no se esperan entre sí.
+    """
+
+    def __init__(self, database=db_instance, minero: Minero = minero_por_defecto):
+        self.database = database
+        self.minero = minero
+        self._cabezas: dict[str, CabezaCadena] = {}
+        self._lock = threading.Lock()
+
+    def cabeza(self, particion: str) -> CabezaCadena:
+        """Devuelve la cabeza de la partición, creándola (sin cargar) la primera vez."""
+        with self._lock:
+            cabeza = self._cabezas.get(particion)
+            if cabeza is None:
+                cabeza = self._cabezas[particion] = CabezaCadena(self.database, particion, self.minero)
+            return cabeza
+
+    def invalidar(self):
+        """Obliga a todas las cabezas a releerse de la base (p. ej. tras limpiarla)."""
+        with self._lock:
+            cabezas = list(self._cabezas.values())
+        for cabeza in cabezas:
+            cabeza.invalidar()
+
+
+cadenas = CadenasParticionadas()
+cabeza_cadena = cadenas.cabeza(PARTICION_RAIZ)
+
+
+def _contenido_sello(individuales: list, grupales: list):
+    """Prepara el bloque de una partición con sus mensajes pendientes: raíz, número de hojas y actualización."""
+    def preparar(session: Session):
+        # Orden de las hojas: primero individuales y luego grupales, cada uno por id
+        hojas = [hoja_mensaje("individual", m.id, m.hash_mensaje) for m in individuales]
+        hojas += [hoja_mensaje("grupal", m.id_transacciones_pk, m.hash_mensaje) for m in grupales]
+
+        def al_agregar(session: Session, id_bloque: int):
+            if individuales:
+                session.execute(update(Mensajes), [
+                    {"id": m.id, "id_bloque": id_bloque, "indice_hoja": i}
+                    for i, m in enumerate(individuales)
+                ])
+            if grupales:
+                desplazamiento = len(individuales)
+                session.execute(update(MensajesGrupo), [
+                    {"id_transacciones_pk": m.id_transacciones_pk, "id_bloque_grupo": id_bloque, "indice_hoja": desplazamiento + i}
+                    for i, m in enumerate(grupales)
+                ])
+
+        return calcular_raiz(hojas).hex(), len(hojas), al_agregar
+
+    return preparar
+
+
+def sellar_bloques(registro: CadenasParticionadas = cadenas, max_mensajes: int = MAX_MENSAJES_BLOQUE) -> int:
+    """
+    Toma hasta ``max_mensajes`` mensajes pendientes (sin bloque), los reparte por partición
+    y sella un bloque de Merkle en la cadena de cada partición.
+    No es reentrante: solo debe llamarlo un hilo a la vez (``ConstructorBloques``).
+
+    :param registro: Cabezas de las particiones
+    :param max_mensajes: Máximo de mensajes a sellar en esta pasada
+    :return: Número de bloques sellados (0 si no había mensajes pendientes)
+    """
+    with registro.database.read() as session:
+        individuales = (
+            session.query(Mensajes.id, Mensajes.id_remitente, Mensajes.id_receptor, Mensajes.hash_mensaje)
+            .filter(Mensajes.id_bloque.is_(None))
+            .order_by(Mensajes.id)
+            .limit(max_mensajes)
+            .all()
+        )
+        grupales = (
+            session.query(MensajesGrupo.id_transacciones_pk, MensajesGrupo.id_grupo_fk, MensajesGrupo.hash_mensaje)
+            .filter(MensajesGrupo.id_bloque_grupo.is_(None))
+            .order_by(MensajesGrupo.id_transacciones_pk)
+            .limit(max_mensajes - len(individuales))
+            .all()
+        ) if len(individuales) < max_mensajes else []
+
+    por_particion = defaultdict(lambda: ([], []))
+    for m in individuales:
+        por_particion[particion_conversacion(m.id_remitente, m.id_receptor)][0].append(m)
+    for m in grupales:
+        por_particion[particion_grupo(m.id_grupo_fk)][1].append(m)
+
+    for particion, (mensajes_individuales, mensajes_grupales) in por_particion.items():
+        registro.cabeza(particion).agregar(_contenido_sello(mensajes_individuales, mensajes_grupales))
+
+    return len(por_particion)
+
+
+def anclar_particiones(registro: CadenasParticionadas = cadenas) -> tuple[int, str] | None:
+    """
+    Añade a la cadena raíz un bloque cuya raíz de Merkle compromete la cabeza actual de cada partición.
+
+    :return: (id_bloque, hash_actual) del bloque de anclaje o None si no hay particiones
+    """
+    def preparar(session: Session):
+        ultimos = (
+            session.query(Blockchain.particion, func.max(Blockchain.id_bloque_pk).label("id_bloque"))
+            .filter(Blockchain.particion != PARTICION_RAIZ)
+            .group_by(Blockchain.particion)
+            .subquery()
+        )
+        cabezas = (
+            session.query(ultimos.c.particion, ultimos.c.id_bloque, Blockchain.hash_actual)
+            .join(Blockchain, Blockchain.id_bloque_pk == ultimos.c.id_bloque)
+            .order_by(ultimos.c.particion)
+            .all()
+        )
+        if not cabezas:
+            return None
+
+        hojas = [hoja_cabeza(particion, id_bloque, hash_bloque) for particion, id_bloque, hash_bloque in cabezas]
+
+        def al_agregar(session: Session, id_bloque_ancla: int):
+            session.execute(insert(AnclajesParticion), [
+                {"id_bloque_ancla": id_bloque_ancla, "particion": particion, "id_bloque_cabeza": id_bloque, "indice_hoja": i}
+                for i, (particion, id_bloque, _) in enumerate(cabezas)
+            ])
+
+        return calcular_raiz(hojas).hex(), len(hojas), al_agregar
+
+    return registro.cabeza(PARTICION_RAIZ).agregar(preparar)
+
+
+class ConstructorBloques:
+    """
+    Hilo en segundo plano que sella los mensajes pendientes en bloques de Merkle,
+    cada ``intervalo`` segundos o antes si se acumulan ``max_mensajes`` envíos,
+    y cada ``intervalo_anclaje`` segundos ancla en la cadena raíz las particiones que avanzaron.
+    """
+
+    def __init__(
+            self,
+            intervalo: float = INTERVALO_BLOQUE,
+            max_mensajes: int = MAX_MENSAJES_BLOQUE,
+            intervalo_anclaje: float = INTERVALO_ANCLAJE
+    ):
+        self.intervalo = intervalo
+        self.max_mensajes = max_mensajes
+        self.intervalo_anclaje = intervalo_anclaje
+        self._sin_anclar = False
+        self._ultimo_anclaje = 0.0
+        self._lock_sello = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+        self._pendientes = 0
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._ejecutar, name="constructor-bloques", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        """Detiene el hilo después de sellar lo que quede pendiente."""
+        self._detener.set()
+        self._despertar.set()
+        if self._hilo:
+            self._hilo.join()
+            self._hilo = None
+
+    def notificar(self):
+        """Avisa de un mensaje nuevo; despierta al hilo si ya hay suficientes para un bloque lleno."""
+        with self._lock:
+            self._pendientes += 1
+            if self._pendientes >= self.max_mensajes:
+                self._despertar.set()
+
+    def sellar_pendientes(self) -> int:
+        """
+        Sella todos los mensajes pendientes en uno o más bloques.
+
+        :return: Número de bloques sellados
+        """
+        with self._lock:
+            self._pendientes = 0
+
+        sellados = 0
+        with self._lock_sello:
+            while sellado := sellar_bloques(cadenas, self.max_mensajes):
+                sellados += sellado
+            if sellados:
+                self._sin_anclar = True
+        return sellados
+
+    def anclar(self, forzar: bool = False) -> bool:
+        """
+        Ancla las cabezas de las particiones en la cadena raíz si alguna avanzó desde el último
+        anclaje y ya pasó ``intervalo_anclaje`` (o siempre que haya algo sin anclar si ``forzar``).
+
+        :return: True si se creó un bloque de anclaje
+        """
+        with self._lock_sello:
+            if not self._sin_anclar:
+                return False
+            if not forzar and time.monotonic() - self._ultimo_anclaje < self.intervalo_anclaje:
+                return False
+            anclaje = anclar_particiones(cadenas)
+            self._sin_anclar = False
+            self._ultimo_anclaje = time.monotonic()
+            return anclaje is not None
+
+    def _ciclo(self, forzar_anclaje: bool = False):
+        try:
+            self.sellar_pendientes()
+            self.anclar(forzar_anclaje)
+        except Exception as error:
+            logger.error(f"Error sellando bloque: {error}")
+
+    def _ejecutar(self):
+        while not self._detener.is_set():
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+            self._ciclo()
+        self._ciclo(forzar_anclaje=True)
+
+
+constructor_bloques = ConstructorBloques()
+
+
+if __name__ == "__main__":
+    # Prueba de estrés: muchos hilos encadenando a la vez en varias particiones
+    # deben producir una cadena lineal por partición
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    from backend.database.database import Database
+
+    HILOS, BLOQUES_POR_HILO = 16, 200
+    PARTICIONES = [PARTICION_RAIZ, particion_grupo(1), particion_grupo(2), particion_conversacion(1, 2)]
+
+    with tempfile.TemporaryDirectory() as directorio:
+        # El constructor ya conecta y crea las tablas
+        database = Database(os.path.join(directorio, "estres.db"))
+        # Dificultad baja: aquí se mide la serialización de los appends, no el minado
+        registro = CadenasParticionadas(database, Minero(dificultad=8))
+
+        def encadenar(hilo: int):
+            for i in range(BLOQUES_POR_HILO):
+                particion = PARTICIONES[(hilo + i) % len(PARTICIONES)]
+                registro.cabeza(particion).agregar_contenido(hashlib.sha256(f"{hilo}:{i}".encode()).hexdigest())
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(HILOS) as ejecutor:
+            list(ejecutor.map(encadenar, range(HILOS)))
+        duracion = time.perf_counter() - inicio
+
+        with database.read() as session:
+            bloques = session.query(Blockchain).order_by(Blockchain.id_bloque_pk).all()
+            cabezas = {}
+            for bloque in bloques:
+                esperado = cabezas.get(bloque.particion, HASH_GENESIS)
+                assert bloque.hash_anterior == esperado, f"Bifurcación en el bloque {bloque.id_bloque_pk}"
+                cabezas[bloque.particion] = bloque.hash_actual
+            assert len(bloques) == HILOS * BLOQUES_POR_HILO
+            for particion in PARTICIONES:
+                assert registro.cabeza(particion).hash_actual == cabezas[particion]
+
+        print(f"{len(bloques)} bloques encadenados en {len(PARTICIONES)} particiones sin bifurcaciones "
+              f"en {duracion:.2f}s ({len(bloques) / duracion:.0f} bloques/s)")
+        database.engine.dispose()
@@ -0,0 +1,94 @@
+import hashlib
+import struct
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+# Cabecera binaria de ancho fijo (big-endian, 86 bytes):
+#   versión (1) | hash anterior (32) | raíz de Merkle (32) | timestamp en µs desde epoch (8)
+#   | dificultad (1) | número de transacciones (4) | nonce (8)
+# El nonce va al final para que el minado solo tenga que añadir 8 bytes a un prefijo fijo.
+VERSION_CABECERA = 1
+_FORMATO = struct.Struct(">B32s32sQBIQ")
+TAMANO_CABECERA = _FORMATO.size
+TAMANO_NONCE = 8
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSEGUNDO = timedelta(microseconds=1)
+
+
+class Cabecera(NamedTuple):
+    version: int
+    hash_anterior: str
+    raiz_merkle: str
+    timestamp: datetime
+    dificultad: int
+    num_transacciones: int
+    nonce: str
+
+
+def a_microsegundos(timestamp: datetime) -> int:
+    """Convierte una fecha UTC sin zona horaria a microsegundos desde epoch (exacto, sin floats)."""
+    return (timestamp - _EPOCH) // _MICROSEGUNDO
+
+
+def desde_microsegundos(microsegundos: int) -> datetime:
+    """Inversa de ``a_microsegundos``."""
+    return _EPOCH + timedelta(microseconds=microsegundos)
+
+
+def prefijo_cabecera(
+        hash_anterior: str,
+        raiz_merkle: str,
+        timestamp: datetime,
+        dificultad: int,
+        num_transacciones: int
+) -> bytes:
+    """
+    Empaqueta la cabecera sin el nonce (los 78 primeros bytes), que es lo que se mina.
+
+    :param hash_anterior: Hash hexadecimal del bloque anterior (64 caracteres)
+    :param raiz_merkle: Raíz de Merkle o contenido del bloque en hexadecimal (64 caracteres)
+    :param timestamp: Fecha de creación del bloque (UTC)
+    :param dificultad: Bits a cero exigidos al hash
+    :param num_transacciones: Hojas del árbol de Merkle
+    :return: Bytes de la cabecera sin nonce
+    """
+    return _FORMATO.pack(
+        VERSION_CABECERA,
+        bytes.fromhex(hash_anterior),
+        bytes.fromhex(raiz_merkle),
+        a_microsegundos(timestamp),
+        dificultad,
+        num_transacciones,
+        0,
+    )[:-TAMANO_NONCE]
+
+
+def completar_cabecera(prefijo: bytes, nonce: int) -> bytes:
+    """Añade el nonce al prefijo para formar la cabecera completa."""
+    return prefijo + nonce.to_bytes(TAMANO_NONCE, "big")
+
+
+def leer_cabecera(cabecera: bytes) -> Cabecera:
+    """Desempaqueta una cabecera binaria a sus campos en el formato de las columnas de ``Blockchain``."""
+    version, anterior, raiz, microsegundos, dificultad, num_transacciones, nonce = _FORMATO.unpack(cabecera)
+    return Cabecera(
+        version,
+        anterior.hex(),
+        raiz.hex(),
+        desde_microsegundos(microsegundos),
+        dificultad,
+        num_transacciones,
+        f"{nonce:016x}",
+    )
+
+
+def hash_cabecera(cabecera: bytes) -> str:
+    """Hash del bloque: SHA-256 de su cabecera binaria."""
+    return hashlib.sha256(cabecera).hexdigest()
+
+
+def hash_bloque_texto(hash_anterior: str, contenido: str, nonce: str, timestamp: datetime) -> str:
+    """Hash de los bloques anteriores a la cabecera binaria: SHA-256 sobre los campos concatenados como texto."""
+    datos = f"{hash_anterior}{contenido}{nonce}{timestamp.isoformat()}"
+    return hashlib.sha256(datos.encode()).hexdigest()
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+# Número máximo de claves públicas ya parseadas que se mantienen en memoria
+CAPACIDAD_CACHE_CLAVES = int(os.getenv("CACHE_CLAVES_CAPACIDAD", "1024"))
+
+
+def propietario_usuario(id_usuario: int) -> str:
+    return f"user:{id_usuario}"
+
+
+def propietario_grupo(id_grupo: int) -> str:
+    return f"grupo:{id_grupo}"
+
+
+class CacheClavesPublicas:
+    """
+    LRU acotada de claves públicas ya parseadas, indexada por propietario y SHA-256 del PEM.
+    Parsear el PEM en cada mensaje aparece en los perfiles del envío; los objetos de clave
+    de ``cryptography`` son inmutables y se pueden compartir entre hilos.
+    """
+
+    def __init__(self, capacidad: int = CAPACIDAD_CACHE_CLAVES):
+        self.capacidad = capacidad
+        self._claves = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, pem: str, propietario: str | None = None):
+        """
+        Devuelve la clave pública del PEM, parseándola solo si no está en la caché.
+
+        :param pem: Clave pública en formato PEM
+        :param propietario: "user:<id>" o "grupo:<id>" (None si la clave no es de un usuario o grupo conocido)
+        :return: Objeto de clave pública
+        """
+        clave = (propietario, hashlib.sha256(pem.encode()).digest())
+        with self._lock:
+            if clave in self._claves:
+                self._claves.move_to_end(clave)
+                self.aciertos += 1
+                return self._claves[clave]
+            self.fallos += 1
+
+        # Se parsea fuera del lock; si otro hilo la parsea a la vez, gana la última
+        objeto = load_pem_public_key(pem.encode())
+
+        with self._lock:
+            self._claves[clave] = objeto
+            self._claves.move_to_end(clave)
+            while len(self._claves) > self.capacidad:
+                self._claves.popitem(last=False)
+        return objeto
+
+    def invalidar(self, propietario: str):
+        """Elimina las claves de un propietario (p. ej. cuando se regenera la clave de un usuario)."""
+        with self._lock:
+            for clave in [clave for clave in self._claves if clave[0] == propietario]:
+                del self._claves[clave]
+
+    def metricas(self) -> dict:
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._claves),
+                "capacidad": self.capacidad,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": round(self.aciertos / consultas, 4) if consultas else None,
+            }
+
+
+cache_claves_publicas = CacheClavesPublicas()
+
+
+def cargar_clave_publica(pem: str, propietario: str | None = None):
+    """Atajo a ``cache_claves_publicas.obtener``."""
+    return cache_claves_publicas.obtener(pem, propietario)
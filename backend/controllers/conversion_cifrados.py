@@ -0,0 +1,162 @@
+import base64
+import json
+import logging
+import os
+import threading
+
+from sqlalchemy import update
+
+from backend.database import db as db_instance
+from backend.database.schemas import Mensajes, MensajesGrupo
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Filas convertidas por transacción: lotes pequeños mantienen cortos los bloqueos de escritura de SQLite
+LOTE_CONVERSION = int(os.getenv("CONVERSION_CIFRADOS_LOTE", "500"))
+# Pausa entre lotes para dejar pasar las escrituras de las peticiones
+PAUSA_CONVERSION = float(os.getenv("CONVERSION_CIFRADOS_PAUSA_SEGUNDOS", "0.05"))
+
+
+def _convertir_mensaje(fila) -> dict:
+    datos = json.loads(fila.mensaje)
+    return {
+        "id": fila.id,
+        "mensaje": "",
+        "cifrado": base64.b64decode(datos["ciphertext"]),
+        "nonce_cifrado": base64.b64decode(datos["nonce"]),
+    }
+
+
+def _convertir_mensaje_grupo(fila) -> dict:
+    return {
+        "id_transacciones_pk": fila.id_transacciones_pk,
+        "mensaje": "",
+        "nonce": "",
+        "cifrado": base64.b64decode(fila.mensaje),
+        "nonce_cifrado": base64.b64decode(fila.nonce),
+    }
+
+
+# tabla -> (modelo, columna clave, columnas que se leen, conversión de una fila)
+TABLAS = {
+    "mensajes": (Mensajes, Mensajes.id, (Mensajes.id, Mensajes.mensaje), _convertir_mensaje),
+    "mensajes_grupo": (
+        MensajesGrupo,
+        MensajesGrupo.id_transacciones_pk,
+        (MensajesGrupo.id_transacciones_pk, MensajesGrupo.mensaje, MensajesGrupo.nonce),
+        _convertir_mensaje_grupo
+    ),
+}
+
+
+class ConversorCifrados:
+    """
+    Hilo en segundo plano que pasa el ciphertext y el nonce de las filas guardadas en base64
+    (``mensaje``/``nonce``) a las columnas binarias ``cifrado``/``nonce_cifrado``. Recorre cada
+    tabla por id en lotes de ``lote`` filas, cada uno en su propia transacción, así que se puede
+    interrumpir en cualquier momento: al volver a arrancar sigue con las filas que falten. Las
+    filas que no se pueden decodificar se dejan como están (los lectores aceptan ambos formatos).
+    """
+
+    def __init__(self, lote: int = LOTE_CONVERSION, pausa: float = PAUSA_CONVERSION, database=db_instance):
+        self.lote = lote
+        self.pausa = pausa
+        self.database = database
+        self._ultimos = {tabla: 0 for tabla in TABLAS}
+        self._detener = threading.Event()
+        self._hilo = None
+        self._lock = threading.Lock()
+        self._convertidas = {tabla: 0 for tabla in TABLAS}
+        self._errores = 0
+        self._completada = False
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._ejecutar, name="conversor-cifrados", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        """Detiene el hilo al terminar el lote en curso."""
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join()
+            self._hilo = None
+
+    def convertir_lote(self, tabla: str) -> int:
+        """
+        Convierte el siguiente lote de filas pendientes de ``tabla``.
+
+        :param tabla: "mensajes" o "mensajes_grupo"
+        :return: Número de filas recorridas (0 cuando ya no quedan pendientes)
+        """
+        modelo, columna_id, columnas, convertir = TABLAS[tabla]
+        with self.database.write() as session:
+            filas = (
+                session.query(*columnas)
+                .filter(columna_id > self._ultimos[tabla], modelo.cifrado.is_(None), modelo.mensaje != "")
+                .order_by(columna_id)
+                .limit(self.lote)
+                .all()
+            )
+            if not filas:
+                return 0
+
+            cambios, errores = [], 0
+            for fila in filas:
+                try:
+                    cambios.append(convertir(fila))
+                except Exception:
+                    errores += 1
+            if cambios:
+                session.execute(update(modelo), cambios)
+
+        self._ultimos[tabla] = filas[-1][0]
+        with self._lock:
+            self._convertidas[tabla] += len(cambios)
+            self._errores += errores
+        if errores:
+            logger.warning(f"{errores} filas de {tabla} no se pudieron convertir a binario")
+        return len(filas)
+
+    def convertir_todo(self) -> bool:
+        """
+        Convierte todas las filas pendientes de todas las tablas.
+
+        :return: True si terminó, False si se pidió detener antes
+        """
+        for tabla in TABLAS:
+            while not self._detener.is_set() and self.convertir_lote(tabla):
+                self._detener.wait(self.pausa)
+            if self._detener.is_set():
+                return False
+        with self._lock:
+            self._completada = True
+        return True
+
+    def _ejecutar(self):
+        try:
+            if self.convertir_todo():
+                logger.info("Conversión de cifrados a columnas binarias completada")
+        except Exception as error:
+            logger.error(f"Error convirtiendo cifrados: {error}")
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                "completada": self._completada,
+                "convertidas": dict(self._convertidas),
+                "errores": self._errores,
+                "lote": self.lote,
+            }
+
+
+conversor_cifrados = ConversorCifrados()
+
+
+if __name__ == "__main__":
+    # Conversión sin levantar el servidor; después conviene un VACUUM para devolver el espacio
+    conversor_cifrados.convertir_todo()
+    print(conversor_cifrados.metricas())
@@ -0,0 +1,330 @@
+import threading
+from bisect import bisect_left
+from typing import Callable, NamedTuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from sqlalchemy.orm import Session
+
+from backend.controllers.cache_claves import cache_claves_publicas, propietario_grupo, propietario_usuario
+from backend.controllers.keys import cifrar_con_ecdh_aes_con_clave, descifrar_con_ecdh_aes
+from backend.controllers.pool_claves import pool_claves_ecc
+from backend.database import db as db_instance
+from backend.database.schemas import EpocasGrupo, Grupos, LlavesNodoGrupo, MiembrosGrupos, NodosGrupo, User
+from backend.utils.ejecutor_cripto import ejecutor_cripto
+
+# Árbol de llaves de un grupo (Logical Key Hierarchy):
+#   - Las hojas (nivel 0) son los miembros; la "llave" de una hoja es la llave pública del usuario.
+#   - Cada nodo interno (nivel, indice) tiene un par ECC propio y su llave privada va cifrada para
+#     sus hijos (2*indice y 2*indice + 1 del nivel inferior) con ``cifrar_con_ecdh_aes``.
+#   - La raíz (profundidad, 0) es la llave del grupo en la época: con ella se cifran los mensajes.
+# Al agregar o eliminar un miembro solo se regeneran los nodos del camino de su hoja a la raíz,
+# así que cada cambio cuesta O(log n) cifrados en lugar de O(n). Las versiones anteriores de los
+# nodos se conservan para que los miembros puedan seguir descifrando las épocas pasadas.
+
+
+class NodoNuevo(NamedTuple):
+    nivel: int
+    indice: int
+    llave_publica: str
+    llaves_hijos: dict  # indice_hijo -> llave privada del nodo cifrada para ese hijo
+
+
+def profundidad_para(num_hojas: int) -> int:
+    """Niveles de nodos internos necesarios para ``num_hojas`` hojas (al menos uno)."""
+    return max(1, (num_hojas - 1).bit_length())
+
+
+def camino(hoja: int, profundidad: int) -> set[tuple[int, int]]:
+    """Posiciones (nivel, indice) de los nodos internos entre una hoja y la raíz."""
+    return {(nivel, hoja >> nivel) for nivel in range(1, profundidad + 1)}
+
+
+def todas_las_posiciones(profundidad: int) -> set[tuple[int, int]]:
+    """Posiciones de todos los nodos internos de un árbol de ``profundidad`` niveles."""
+    return {(nivel, indice) for nivel in range(1, profundidad + 1) for indice in range(1 << (profundidad - nivel))}
+
+
+def _ocupado(hojas_ordenadas: list[int], nivel: int, indice: int) -> bool:
+    """Indica si el subárbol de (nivel, indice) contiene alguna hoja ocupada."""
+    inicio, fin = indice << nivel, (indice + 1) << nivel
+    posicion = bisect_left(hojas_ordenadas, inicio)
+    return posicion < len(hojas_ordenadas) and hojas_ordenadas[posicion] < fin
+
+
+def generar_nodos(
+        profundidad: int,
+        hojas: dict[int, tuple[int, str]],
+        posiciones: set[tuple[int, int]],
+        llave_publica_vigente: Callable[[int, int], str] | None = None
+) -> tuple[list[NodoNuevo], str | None]:
+    """
+    Genera versiones nuevas de los nodos en ``posiciones`` (de abajo arriba) y cifra la llave
+    privada de cada uno para sus hijos no vacíos. Los nodos de un mismo nivel se generan en
+    paralelo en el ejecutor criptográfico. Los subárboles sin miembros se omiten.
+
+    :param profundidad: Niveles del árbol
+    :param hojas: Hoja -> (id del usuario, llave pública PEM) de cada miembro
+    :param posiciones: Nodos (nivel, indice) que se regeneran
+    :param llave_publica_vigente: Llave pública actual de un nodo que no se regenera
+    :return: Tupla (nodos generados, llave privada PEM de la raíz o None si no se regeneró)
+    """
+    hojas_ordenadas = sorted(hojas)
+    nuevas_publicas = {}
+    nodos = []
+    llave_raiz = None
+
+    for nivel in range(1, profundidad + 1):
+        indices = sorted(i for n, i in posiciones if n == nivel and _ocupado(hojas_ordenadas, nivel, i))
+
+        # Las llaves de los hijos se resuelven aquí: la sesión no se comparte con los hilos del pool
+        hijos_por_nodo = []
+        for indice in indices:
+            hijos = []
+            for hijo in (2 * indice, 2 * indice + 1):
+                if not _ocupado(hojas_ordenadas, nivel - 1, hijo):
+                    continue
+                if nivel == 1:
+                    id_usuario, publica = hojas[hijo]
+                    hijos.append((hijo, publica, propietario_usuario(id_usuario)))
+                elif (nivel - 1, hijo) in nuevas_publicas:
+                    hijos.append((hijo, nuevas_publicas[(nivel - 1, hijo)], None))
+                else:
+                    hijos.append((hijo, llave_publica_vigente(nivel - 1, hijo), None))
+            hijos_por_nodo.append((indice, hijos))
+
+        def generar(entrada):
+            indice, hijos = entrada
+            privada_pem, publica_pem = pool_claves_ecc.obtener()
+            privada = load_pem_private_key(privada_pem.encode(), password=None)
+            llaves = {
+                hijo: cifrar_con_ecdh_aes_con_clave(privada, publica, privada_pem.encode(), propietario)
+                for hijo, publica, propietario in hijos
+            }
+            return NodoNuevo(nivel, indice, publica_pem, llaves), privada_pem
+
+        for nodo, privada_pem in ejecutor_cripto.mapear_en_orden(generar, hijos_por_nodo):
+            nuevas_publicas[(nivel, nodo.indice)] = nodo.llave_publica
+            nodos.append(nodo)
+            if nivel == profundidad:
+                llave_raiz = privada_pem
+
+    return nodos, llave_raiz
+
+
+def filas_nodos(id_grupo: int, epoca: int, nodos: list[NodoNuevo]) -> list[NodosGrupo]:
+    """Convierte los nodos generados en filas de ``NodosGrupo`` con sus ``LlavesNodoGrupo``."""
+    return [
+        NodosGrupo(
+            id_grupo_fk=id_grupo,
+            nivel=nodo.nivel,
+            indice=nodo.indice,
+            epoca=epoca,
+            llave_publica=nodo.llave_publica,
+            llaves=[
+                LlavesNodoGrupo(indice_hijo=hijo, llave_cifrada=llave)
+                for hijo, llave in nodo.llaves_hijos.items()
+            ]
+        )
+        for nodo in nodos
+    ]
+
+
+def construir_arbol(hojas: dict[int, tuple[int, str]]) -> tuple[int, list[NodoNuevo], str]:
+    """
+    Genera un árbol completo para los miembros dados.
+
+    :param hojas: Hoja -> (id del usuario, llave pública PEM) de cada miembro
+    :return: Tupla (profundidad, nodos, llave privada PEM de la raíz)
+    """
+    profundidad = profundidad_para(max(hojas) + 1)
+    nodos, llave_raiz = generar_nodos(profundidad, hojas, todas_las_posiciones(profundidad))
+    return profundidad, nodos, llave_raiz
+
+
+def _nodo_vigente(session: Session, id_grupo: int, nivel: int, indice: int, epoca: int) -> NodosGrupo | None:
+    return session.query(NodosGrupo).filter(
+        NodosGrupo.id_grupo_fk == id_grupo,
+        NodosGrupo.nivel == nivel,
+        NodosGrupo.indice == indice,
+        NodosGrupo.epoca <= epoca
+    ).order_by(NodosGrupo.epoca.desc()).first()
+
+
+def _hojas_del_grupo(session: Session, id_grupo: int) -> dict[int, tuple[int, str]]:
+    filas = session.query(MiembrosGrupos.hoja, MiembrosGrupos.id_user_fk, User.public_key) \
+        .join(User, User.id_pk == MiembrosGrupos.id_user_fk) \
+        .filter(MiembrosGrupos.id_grupo_fk == id_grupo, MiembrosGrupos.hoja.isnot(None)) \
+        .all()
+    return {hoja: (id_usuario, publica) for hoja, id_usuario, publica in filas}
+
+
+def _asignar_hojas(session: Session, id_grupo: int):
+    """Coloca en hojas consecutivas a todos los miembros de un grupo sin árbol (creado antes de las épocas)."""
+    miembros = session.query(MiembrosGrupos).filter(MiembrosGrupos.id_grupo_fk == id_grupo) \
+        .order_by(MiembrosGrupos.id_user_fk).all()
+    for hoja, miembro in enumerate(miembros):
+        miembro.hoja = hoja
+    session.flush()
+
+
+def hoja_libre(session: Session, grupo: Grupos) -> int:
+    """
+    Devuelve la primera hoja libre del árbol del grupo. Si el árbol está lleno, la siguiente
+    rotación lo hace crecer un nivel (la raíz anterior pasa a ser el hijo izquierdo de la nueva).
+    """
+    ocupadas = {hoja for (hoja,) in session.query(MiembrosGrupos.hoja).filter(
+        MiembrosGrupos.id_grupo_fk == grupo.id_pk,
+        MiembrosGrupos.hoja.isnot(None)
+    )}
+    hoja = 0
+    while hoja in ocupadas:
+        hoja += 1
+    return hoja
+
+
+def rotar_epoca(session: Session, grupo: Grupos, hojas_cambiadas: list[int]) -> int | None:
+    """
+    Abre una nueva época de la llave del grupo después de un cambio de miembros, que ya debe estar
+    aplicado en la sesión (hojas asignadas o miembros borrados). Regenera solo los nodos de los
+    caminos de ``hojas_cambiadas``; los grupos sin árbol se convierten con un árbol completo.
+    No confirma la transacción.
+
+    :param session: Sesión de escritura
+    :param grupo: Grupo cuyos miembros cambiaron
+    :param hojas_cambiadas: Hojas agregadas o vaciadas
+    :return: Nueva época, o None si el grupo se quedó sin miembros
+    """
+    if grupo.profundidad_arbol is None:
+        _asignar_hojas(session, grupo.id_pk)
+
+    hojas = _hojas_del_grupo(session, grupo.id_pk)
+    if not hojas:
+        return None
+
+    epoca = grupo.epoca_actual + 1
+    if grupo.profundidad_arbol is None:
+        profundidad, nodos, _ = construir_arbol(hojas)
+    else:
+        profundidad = max(grupo.profundidad_arbol, profundidad_para(max(hojas) + 1))
+        posiciones = set()
+        for hoja in hojas_cambiadas:
+            posiciones |= camino(hoja, profundidad)
+        # Si el árbol creció, la raíz nueva también cambia aunque no esté en ningún camino anterior
+        posiciones.add((profundidad, 0))
+
+        def llave_publica_vigente(nivel: int, indice: int) -> str:
+            return _nodo_vigente(session, grupo.id_pk, nivel, indice, grupo.epoca_actual).llave_publica
+
+        nodos, _ = generar_nodos(profundidad, hojas, posiciones, llave_publica_vigente)
+
+    raiz = next(nodo for nodo in nodos if nodo.nivel == profundidad)
+    session.add_all(filas_nodos(grupo.id_pk, epoca, nodos))
+    session.add(EpocasGrupo(
+        id_grupo_fk=grupo.id_pk,
+        epoca=epoca,
+        llave_publica=raiz.llave_publica,
+        profundidad=profundidad
+    ))
+    grupo.epoca_actual = epoca
+    grupo.profundidad_arbol = profundidad
+    grupo.llave_publica = raiz.llave_publica
+    cache_claves_publicas.invalidar(propietario_grupo(grupo.id_pk))
+    return epoca
+
+
+def _descifrar_llave_de_miembro(epoca: int, llave_privada, llave_publica_pem: str, llave_cifrada: bytes, propietario: str | None = None) -> str:
+    # Una hoja reutilizada conserva los cifrados hechos para el miembro anterior: con la llave del
+    # nuevo el tag no cuadra, y eso es que no tiene acceso a la época
+    try:
+        return descifrar_con_ecdh_aes(llave_privada, llave_publica_pem, llave_cifrada, propietario).decode()
+    except InvalidTag:
+        raise ValueError(f"No tienes acceso a la época {epoca}.")
+
+
+def descifrar_llave_de_epoca(session: Session, miembro: MiembrosGrupos, llave_privada_usuario, epoca: int) -> str:
+    """
+    Obtiene la llave privada del grupo en una época subiendo por el árbol desde la hoja del miembro:
+    en cada nivel descifra la llave del padre con la del hijo (O(log n) ECDH).
+
+    :param session: Sesión de lectura
+    :param miembro: Membresía del usuario
+    :param llave_privada_usuario: Llave privada ECC del usuario
+    :param epoca: Época pedida
+    :raises ValueError: Si la época no existe o el miembro no tiene acceso a ella
+    :return: Llave privada PEM del grupo en esa época
+    """
+    registro = session.query(EpocasGrupo).filter_by(id_grupo_fk=miembro.id_grupo_fk, epoca=epoca).first()
+    if not registro:
+        raise ValueError(f"El grupo no tiene la época {epoca}.")
+
+    if registro.profundidad is None:
+        # Época sin árbol: la llave del grupo va cifrada directamente para cada miembro
+        if not miembro.llave_privada_grupo_cifrada:
+            raise ValueError(f"No tienes acceso a la época {epoca}.")
+        return _descifrar_llave_de_miembro(
+            epoca,
+            llave_privada_usuario,
+            registro.llave_publica,
+            miembro.llave_privada_grupo_cifrada,
+            propietario_grupo(miembro.id_grupo_fk)
+        )
+
+    if miembro.hoja is None:
+        raise ValueError(f"No tienes acceso a la época {epoca}.")
+
+    llave_actual = llave_privada_usuario
+    hijo = miembro.hoja
+    llave_pem = None
+    for nivel in range(1, registro.profundidad + 1):
+        indice = hijo // 2
+        nodo = _nodo_vigente(session, miembro.id_grupo_fk, nivel, indice, epoca)
+        llave = None
+        if nodo:
+            llave = session.query(LlavesNodoGrupo.llave_cifrada).filter_by(id_nodo_fk=nodo.id_pk, indice_hijo=hijo).scalar()
+        if llave is None:
+            raise ValueError(f"No tienes acceso a la época {epoca}.")
+
+        llave_pem = _descifrar_llave_de_miembro(epoca, llave_actual, nodo.llave_publica, llave)
+        llave_actual = load_pem_private_key(llave_pem.encode(), password=None)
+        hijo = indice
+
+    return llave_pem
+
+
+def llaves_de_epoca_de_miembro(id_grupo: int, id_usuario: int, llave_privada_usuario) -> Callable[[int], ec.EllipticCurvePrivateKey]:
+    """
+    Devuelve una función que da la llave privada del grupo en una época para el miembro, para
+    descifrar un historial con mensajes de varias épocas. Cada época se descifra una sola vez
+    (también cuando falla) y la función se puede llamar desde varios hilos.
+
+    :param id_grupo: Id del grupo
+    :param id_usuario: Id del miembro
+    :param llave_privada_usuario: Llave privada ECC del miembro
+    :return: Función época -> llave privada del grupo; lanza ``ValueError`` si el miembro no tiene acceso
+    """
+    llaves = {}
+    lock = threading.Lock()
+
+    def llave_de_epoca(epoca: int) -> ec.EllipticCurvePrivateKey:
+        with lock:
+            if epoca not in llaves:
+                # ``read`` registra y descarta las excepciones: se capturan todas dentro y se guarda el
+                # error, y si aun así no se llega a guardar nada queda el error por defecto
+                llaves[epoca] = ValueError(f"No se pudo obtener la llave de la época {epoca}.")
+                with db_instance.read() as session:
+                    try:
+                        miembro = session.query(MiembrosGrupos).filter_by(id_grupo_fk=id_grupo, id_user_fk=id_usuario).first()
+                        if not miembro:
+                            raise ValueError("No eres miembro del grupo.")
+                        llave_pem = descifrar_llave_de_epoca(session, miembro, llave_privada_usuario, epoca)
+                        llaves[epoca] = load_pem_private_key(llave_pem.encode(), password=None)
+                    except Exception as error:
+                        llaves[epoca] = error
+            llave = llaves[epoca]
+        if isinstance(llave, Exception):
+            raise llave
+        return llave
+
+    return llave_de_epoca
@@ -2,10 +2,13 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import hashlib, base64, json
 import os
 
+from backend.controllers.cache_claves import cargar_clave_publica
+from backend.controllers.sobre import cifrar_sobre, codificar_sobre
+from backend.utils.ejecutor_cripto import ejecutor_cripto
+
 def calcular_hash_mensaje(mensaje: str, algoritmo: str = "sha256") -> str:
     if algoritmo == "sha256":
         return hashlib.sha256(mensaje.encode()).hexdigest()
@@ -18,8 +21,8 @@ def sign_message(private_key: ec.EllipticCurvePrivateKey, message: str) -> str:
     signature = private_key.sign(message.encode(), ec.ECDSA(hashes.SHA256()))
     return signature.hex()
 
-def verify_signature(public_key_pem: str, message: str, signature_hex: str) -> bool:
-    public_key = serialization.load_pem_public_key(public_key_pem.encode())
+def verify_signature(public_key_pem: str, message: str, signature_hex: str, propietario: str | None = None) -> bool:
+    public_key = cargar_clave_publica(public_key_pem, propietario)
     signature = bytes.fromhex(signature_hex)
     try:
         public_key.verify(signature, message.encode(), ec.ECDSA(hashes.SHA256()))
@@ -27,6 +30,24 @@ def verify_signature(public_key_pem: str, message: str, signature_hex: str) -> b
     except Exception:
         return False
 
+def verificar_firmas_lote(firmas: list) -> list[dict]:
+    """
+    Verifica varias firmas en el pool criptográfico. Las claves repetidas se parsean una
+    sola vez gracias a la caché de claves públicas.
+
+    :param firmas: Lista de tuplas (clave pública PEM, mensaje, firma hexadecimal)
+    :return: Un resultado por firma, en el mismo orden: {"indice", "valida"} y "error" si la entrada no es válida
+    """
+    def verificar(entrada):
+        indice, (public_key_pem, message, signature_hex) = entrada
+        try:
+            return {"indice": indice, "valida": verify_signature(public_key_pem, message, signature_hex)}
+        except ValueError as e:
+            # PEM o firma hexadecimal mal formados: se informa en el elemento sin abortar el lote
+            return {"indice": indice, "valida": False, "error": str(e)}
+
+    return ejecutor_cripto.mapear_en_orden(verificar, enumerate(firmas))
+
 def generate_aes_key():
     return os.urandom(32)
 
@@ -59,6 +80,36 @@ def encrypt_message_aes(message: str, aes_key: bytes) -> dict:
         "nonce": base64.b64encode(nonce).decode()
     }
 
+def cifrar_mensaje_aes(message: str, aes_key: bytes) -> tuple[bytes, bytes]:
+    """Como ``encrypt_message_aes`` pero en binario, para las columnas ``cifrado`` y ``nonce_cifrado``: (ciphertext, nonce)."""
+    nonce = os.urandom(12)
+    return AESGCM(aes_key).encrypt(nonce, message.encode(), None), nonce
+
+def partes_mensaje_cifrado(mensaje: str, cifrado: bytes | None, nonce: bytes | None) -> tuple[bytes, bytes]:
+    """
+    Devuelve (ciphertext, nonce) de un mensaje individual guardado, ya sea en las columnas binarias
+    o en el JSON en base64 de las filas que todavía no se han convertido.
+    """
+    if cifrado is not None:
+        return cifrado, nonce
+    datos = json.loads(mensaje)
+    return base64.b64decode(datos["ciphertext"]), base64.b64decode(datos["nonce"])
+
+def mensaje_cifrado_a_texto(mensaje: str, cifrado: bytes | None, nonce: bytes | None) -> str:
+    """JSON {"ciphertext", "nonce"} en base64 de un mensaje individual guardado, tal como lo devuelve la API."""
+    if cifrado is None:
+        return mensaje
+    return json.dumps({
+        "ciphertext": base64.b64encode(cifrado).decode(),
+        "nonce": base64.b64encode(nonce).decode()
+    })
+
+def descifrar_mensaje_aes(cifrado: bytes, nonce: bytes, clave_aes: bytes) -> str:
+    try:
+        return AESGCM(clave_aes).decrypt(nonce, cifrado, None).decode("utf-8")
+    except Exception as e:
+        raise ValueError(f"Error al descifrar mensaje AES-GCM: {e}")
+
 def decrypt_message_aes(mensaje_cifrado: str, clave_aes: bytes) -> str:
     try:
         datos = json.loads(mensaje_cifrado)
@@ -71,29 +122,6 @@ def decrypt_message_aes(mensaje_cifrado: str, clave_aes: bytes) -> str:
     except Exception as e:
         raise ValueError(f"Error al descifrar mensaje AES-GCM: {e}")
 
-def encrypt_aes_key_with_ecc(aes_key: bytes, peer_public_key: ec.EllipticCurvePublicKey) -> dict:
-    ephemeral_private_key = ec.generate_private_key(ec.SECP256R1())
-    shared_key = ephemeral_private_key.exchange(ec.ECDH(), peer_public_key)
-
-    derived_key = HKDF(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=None,
-        info=b"ecies",
-    ).derive(shared_key)
-
-    aesgcm = AESGCM(derived_key)
-    nonce = os.urandom(12)
-    encrypted_key = aesgcm.encrypt(nonce, aes_key, None)
-
-    ephemeral_public_key = ephemeral_private_key.public_key()
-    ephemeral_pem = ephemeral_public_key.public_bytes(
-        serialization.Encoding.PEM,
-        serialization.PublicFormat.SubjectPublicKeyInfo
-    ).decode()
-
-    return {
-        "encrypted_key": base64.b64encode(encrypted_key).decode(),
-        "nonce": base64.b64encode(nonce).decode(),
-        "ephemeral_public_key": ephemeral_pem
-    }
+def encrypt_aes_key_with_ecc(aes_key: bytes, peer_public_key: ec.EllipticCurvePublicKey) -> str:
+    """Cifra la clave AES para el receptor con ECIES y devuelve el sobre binario en base64 (ver ``sobre``)."""
+    return codificar_sobre(cifrar_sobre(aes_key, peer_public_key))
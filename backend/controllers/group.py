@@ -1,19 +1,22 @@
 from sqlalchemy.exc import IntegrityError
 from backend.database import db as db_instance
-from backend.database.schemas import MiembrosGrupos, Grupos, User, MensajesGrupo
+from backend.database.schemas import MiembrosGrupos, Grupos, User, MensajesGrupo, EpocasGrupo, SesionesGrupo
 from backend.models.message import MensajeGrupoResponse
-from backend.controllers.keys import generate_rsa_keys, generate_ecc_keys
+from backend.controllers.keys import generate_rsa_keys
+from backend.controllers.epocas import construir_arbol, filas_nodos, hoja_libre, rotar_epoca
+from backend.controllers.pool_claves import pool_claves_ecc
+from backend.controllers.cache_claves import cargar_clave_publica
+from backend.controllers.sobre import abrir_sobre_guardado, cifrar_sobre, codificar_sobre
+from backend.utils.ejecutor_cripto import ejecutor_cripto
 from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from backend.database import db, User, Mensajes, Blockchain
-from typing import List, Type
+from typing import Iterator, List, Type
 from fastapi import Depends, HTTPException
-from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import base64
-import os
-import json
 
 def agregar_miembro_controller(id_grupo: int, id_usuario: int) -> dict:
     with db_instance.write() as session:
@@ -37,21 +40,27 @@ def agregar_miembro_controller(id_grupo: int, id_usuario: int) -> dict:
             id_grupo_fk=id_grupo,
             id_user_fk=id_usuario
         )
+        if grupo.profundidad_arbol is not None:
+            nuevo_miembro.hoja = hoja_libre(session, grupo)
         session.add(nuevo_miembro)
         session.flush()  # fuerza que se le asigne id_pk sin cerrar sesión
 
+        # Nueva época: solo se regenera el camino de la hoja del miembro nuevo
+        epoca = rotar_epoca(session, grupo, [nuevo_miembro.hoja] if nuevo_miembro.hoja is not None else [])
+
         # Extrae los datos antes de cerrar la sesión
         return {
             "id_pk": nuevo_miembro.id_pk,
             "id_grupo_fk": nuevo_miembro.id_grupo_fk,
-            "id_user_fk": nuevo_miembro.id_user_fk
+            "id_user_fk": nuevo_miembro.id_user_fk,
+            "epoca": epoca
         }
 
 def crear_grupo(session: Session, nombre: str) -> tuple[Grupos, str]:
     tipo_cifrado = 'ECC'  # Forzado
 
-    # Generar llaves ECC
-    llave_privada, llave_publica = generate_ecc_keys()
+    # Generar llaves ECC (del pool de pares pregenerados)
+    llave_privada, llave_publica = pool_claves_ecc.obtener()
 
     grupo = Grupos(
         nombre_de_grupo=nombre,
@@ -61,6 +70,8 @@ def crear_grupo(session: Session, nombre: str) -> tuple[Grupos, str]:
 
     session.add(grupo)
     try:
+        session.flush()
+        session.add(EpocasGrupo(id_grupo_fk=grupo.id_pk, epoca=0, llave_publica=llave_publica))
         session.commit()
     except IntegrityError:
         session.rollback()
@@ -69,6 +80,54 @@ def crear_grupo(session: Session, nombre: str) -> tuple[Grupos, str]:
     return grupo, llave_privada
 
 
+async def crear_grupo_con_miembros_async(session: AsyncSession, nombre: str, ids_miembros: set[int]) -> tuple[Grupos, str]:
+    """
+    Crea el grupo con todos sus miembros en una sola transacción. Las claves públicas de los
+    miembros se cargan con una consulta y el árbol de llaves de la época 0 se genera en paralelo
+    en el ejecutor criptográfico, antes de abrir la transacción de escritura.
+
+    :param session: Sesión asíncrona
+    :param nombre: Nombre del grupo
+    :param ids_miembros: Ids de los usuarios miembros (incluido el creador)
+    :return: Tupla (grupo, llave privada del grupo en PEM)
+    """
+    resultado = await session.execute(
+        select(User.id_pk, User.public_key).where(User.id_pk.in_(ids_miembros))
+    )
+    claves_publicas = dict(resultado.all())
+    ids_ordenados = sorted(ids_miembros)
+    for id_usuario in ids_ordenados:
+        if not claves_publicas.get(id_usuario):
+            raise ValueError(f"Usuario {id_usuario} no tiene clave pública válida")
+
+    hojas = {hoja: (id_usuario, claves_publicas[id_usuario]) for hoja, id_usuario in enumerate(ids_ordenados)}
+    profundidad, nodos, llave_privada = await ejecutor_cripto.ejecutar_en_hilo(construir_arbol, hojas)
+    llave_publica = next(nodo.llave_publica for nodo in nodos if nodo.nivel == profundidad)
+
+    grupo = Grupos(
+        nombre_de_grupo=nombre,
+        tipo_cifrado='ECC',
+        llave_publica=llave_publica,
+        epoca_actual=0,
+        profundidad_arbol=profundidad,
+    )
+    session.add(grupo)
+    try:
+        await session.flush()
+        session.add_all([
+            MiembrosGrupos(id_grupo_fk=grupo.id_pk, id_user_fk=id_usuario, hoja=hoja)
+            for hoja, id_usuario in enumerate(ids_ordenados)
+        ])
+        session.add_all(filas_nodos(grupo.id_pk, 0, nodos))
+        session.add(EpocasGrupo(id_grupo_fk=grupo.id_pk, epoca=0, llave_publica=llave_publica, profundidad=profundidad))
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise ValueError("Error: Ya existe un grupo con este nombre.")
+
+    return grupo, llave_privada
+
+
 def listar_grupos(session: Session, user_id: int) -> List[Grupos]:
     """
     Retorna los grupos a los que pertenece el usuario especificado.
@@ -111,54 +170,63 @@ def eliminar_miembro_controller(id_grupo: int, id_usuario: int):
         if not miembro:
             raise ValueError("El usuario no es miembro del grupo o ya fue eliminado.")
 
+        hoja = miembro.hoja
+        grupo = miembro.grupo
         session.delete(miembro)
+        session.flush()
+
+        # Nueva época sin el miembro: solo se regenera el camino de su hoja
+        return rotar_epoca(session, grupo, [hoja] if hoja is not None else [])
 
 
 
-def encrypt_aes_key_with_public_key(aes_key: bytes, public_key_pem: str) -> str:
+def encrypt_aes_key_with_public_key(aes_key: bytes, public_key_pem: str, propietario: str | None = None) -> str:
     """
     Cifra la clave AES con la clave pública del grupo usando ECIES (ECDH + AES-GCM).
-    Devuelve un JSON base64 string con:
-    {
-      "encrypted_key": base64,
-      "nonce": base64,
-      "ephemeral_public_key": PEM
-    }
+    Devuelve el sobre binario en base64: versión, clave efímera comprimida, nonce y ciphertext
+    (ver ``controllers.sobre``).
     """
-    peer_public_key = serialization.load_pem_public_key(public_key_pem.encode())
+    return codificar_sobre(cifrar_sobre(aes_key, cargar_clave_publica(public_key_pem, propietario)))
 
-    ephemeral_private_key = ec.generate_private_key(ec.SECP256R1())
-    shared_key = ephemeral_private_key.exchange(ec.ECDH(), peer_public_key)
 
-    derived_key = HKDF(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=None,
-        info=b"ecies",
-    ).derive(shared_key)
+def decrypt_aes_key_with_private_key(grupo_priv_key: ec.EllipticCurvePrivateKey, clave_aes_cifrada: dict | str) -> bytes:
+    """
+    Inverso de ``encrypt_aes_key_with_public_key``. También acepta el JSON con la clave efímera
+    en PEM de los mensajes guardados antes del sobre binario.
+
+    :param grupo_priv_key: Clave privada ECC del grupo
+    :param clave_aes_cifrada: Sobre en base64, o el diccionario JSON anterior o su texto
+    :return: Clave descifrada
+    """
+    return abrir_sobre_guardado(clave_aes_cifrada, grupo_priv_key)
 
-    aesgcm = AESGCM(derived_key)
-    nonce = os.urandom(12)
-    encrypted_key = aesgcm.encrypt(nonce, aes_key, None)
 
-    ephemeral_public_key = ephemeral_private_key.public_key()
-    ephemeral_pem = ephemeral_public_key.public_bytes(
-        serialization.Encoding.PEM,
-        serialization.PublicFormat.SubjectPublicKeyInfo
-    ).decode()
+def decrypt_message_with_aes_key(aes_key: bytes, mensaje_cifrado: bytes | str, nonce: bytes | str) -> str:
+    """Descifra un mensaje de grupo AES-GCM con su clave AES. Ciphertext y nonce en binario o en base64 (texto)."""
+    if isinstance(mensaje_cifrado, str):
+        mensaje_cifrado = base64.b64decode(mensaje_cifrado)
+    if isinstance(nonce, str):
+        nonce = base64.b64decode(nonce)
+    return AESGCM(aes_key).decrypt(nonce, mensaje_cifrado, None).decode()
 
-    payload = {
-        "encrypted_key": base64.b64encode(encrypted_key).decode(),
-        "nonce": base64.b64encode(nonce).decode(),
-        "ephemeral_public_key": ephemeral_pem
-    }
 
-    return json.dumps(payload)
+def decrypt_group_message(grupo_priv_key: ec.EllipticCurvePrivateKey, mensaje_cifrado: str, nonce: str, clave_aes_cifrada: dict | str) -> str:
+    """
+    Descifra un mensaje de grupo con la clave privada del grupo ya cargada: ECDH con la clave
+    efímera, descifrado de la clave AES y descifrado del mensaje.
+
+    :param grupo_priv_key: Clave privada ECC del grupo
+    :param mensaje_cifrado: Mensaje cifrado AES-GCM (binario o base64)
+    :param nonce: Nonce AES-GCM del mensaje (binario o base64)
+    :param clave_aes_cifrada: Sobre de ``encrypt_aes_key_with_public_key`` (o el JSON anterior)
+    :return: Mensaje plano
+    """
+    aes_key = decrypt_aes_key_with_private_key(grupo_priv_key, clave_aes_cifrada)
+    return decrypt_message_with_aes_key(aes_key, mensaje_cifrado, nonce)
 
 
-def obtener_mensajes_de_grupo(grupo_id: int, user_id: int, db: Session) -> List[MensajeGrupoResponse]:
-    # Verificar si el usuario pertenece al grupo
-    miembro = db.query(MiembrosGrupos).filter_by(
+def verificar_miembro_de_grupo(db: Session, grupo_id: int, user_id: int):
+    miembro = db.query(MiembrosGrupos.id_pk).filter_by(
         id_grupo_fk=grupo_id,
         id_user_fk=user_id
     ).first()
@@ -166,22 +234,101 @@ def obtener_mensajes_de_grupo(grupo_id: int, user_id: int, db: Session) -> List[
     if not miembro:
         raise HTTPException(status_code=403, detail="No tienes acceso a este grupo")
 
-    mensajes = (
-        db.query(MensajesGrupo)
+
+def _consulta_mensajes_de_grupo(db: Session, grupo_id: int):
+    return (
+        db.query(
+            MensajesGrupo.id_transacciones_pk,
+            MensajesGrupo.mensaje,
+            MensajesGrupo.nonce,
+            MensajesGrupo.cifrado,
+            MensajesGrupo.nonce_cifrado,
+            MensajesGrupo.clave_aes_cifrada,
+            MensajesGrupo.firma,
+            MensajesGrupo.timestamp,
+            MensajesGrupo.epoca,
+            MensajesGrupo.id_sesion_fk,
+            MensajesGrupo.contador,
+            MensajesGrupo.id_remitente_fk,
+            User.correo.label("remitente"),
+        )
+        .outerjoin(User, User.id_pk == MensajesGrupo.id_remitente_fk)
         .filter(MensajesGrupo.id_grupo_fk == grupo_id)
         .order_by(MensajesGrupo.timestamp.asc())
-        .all()
     )
 
-    return [
-        MensajeGrupoResponse(
-            id_transaccion=m.id_transacciones_pk,
-            remitente=m.remitente.correo,
-            mensaje=m.mensaje,
-            nonce=m.nonce,
-            clave_aes_cifrada=m.clave_aes_cifrada,
-            firma=m.firma,
-            timestamp=m.timestamp.isoformat()
-        )
-        for m in mensajes
-    ]
\ No newline at end of file
+
+def _mensaje_grupo_a_respuesta(m) -> MensajeGrupoResponse:
+    # Las filas convertidas guardan el cifrado en binario: se pasa a base64 solo al responder
+    return MensajeGrupoResponse(
+        id_transaccion=m.id_transacciones_pk,
+        remitente=m.remitente or (str(m.id_remitente_fk) if m.id_remitente_fk is not None else None),
+        mensaje=base64.b64encode(m.cifrado).decode() if m.cifrado is not None else m.mensaje,
+        nonce=base64.b64encode(m.nonce_cifrado).decode() if m.nonce_cifrado is not None else m.nonce,
+        clave_aes_cifrada=m.clave_aes_cifrada,
+        firma=m.firma,
+        timestamp=m.timestamp.isoformat(),
+        epoca=m.epoca or 0,
+        id_sesion=m.id_sesion_fk,
+        contador=m.contador
+    )
+
+
+def obtener_mensajes_de_grupo(grupo_id: int, user_id: int, db: Session) -> List[MensajeGrupoResponse]:
+    # Verificar si el usuario pertenece al grupo
+    verificar_miembro_de_grupo(db, grupo_id, user_id)
+
+    mensajes = _consulta_mensajes_de_grupo(db, grupo_id).all()
+
+    return [_mensaje_grupo_a_respuesta(m) for m in mensajes]
+
+
+def iterar_mensajes_cifrados_por_id(grupo_id: int, ids_mensajes: List[int], tamano_lote: int) -> Iterator[tuple]:
+    """
+    Recorre los mensajes del grupo con los ids dados, consultándolos por lotes de ``tamano_lote``.
+    Produce tuplas (id, mensaje, nonce, clave_aes_cifrada, clave_cadena_cifrada, contador, epoca), con
+    el mensaje y el nonce en binario (o en base64 si la fila no se ha convertido); clave_cadena_cifrada
+    y contador solo en mensajes de una sesión de emisor. Los ids que no existen o son de otro grupo se
+    producen con los demás campos a None.
+    Abre su propia sesión porque se consume mientras se envía la respuesta.
+    """
+    with db_instance.read() as session:
+        for inicio in range(0, len(ids_mensajes), tamano_lote):
+            lote = ids_mensajes[inicio:inicio + tamano_lote]
+            filas = {
+                m.id_transacciones_pk: m
+                for m in session.query(
+                    MensajesGrupo.id_transacciones_pk,
+                    MensajesGrupo.mensaje,
+                    MensajesGrupo.nonce,
+                    MensajesGrupo.cifrado,
+                    MensajesGrupo.nonce_cifrado,
+                    MensajesGrupo.clave_aes_cifrada,
+                    MensajesGrupo.contador,
+                    MensajesGrupo.epoca,
+                    SesionesGrupo.clave_cadena_cifrada,
+                ).outerjoin(
+                    SesionesGrupo, SesionesGrupo.id_pk == MensajesGrupo.id_sesion_fk
+                ).filter(
+                    MensajesGrupo.id_grupo_fk == grupo_id,
+                    MensajesGrupo.id_transacciones_pk.in_(lote)
+                )
+            }
+            for id_mensaje in lote:
+                m = filas.get(id_mensaje)
+                if m is None:
+                    yield id_mensaje, None, None, None, None, None, None
+                else:
+                    cifrado, nonce = (m.cifrado, m.nonce_cifrado) if m.cifrado is not None else (m.mensaje, m.nonce)
+                    yield id_mensaje, cifrado, nonce, m.clave_aes_cifrada, m.clave_cadena_cifrada, m.contador, m.epoca or 0
+
+
+def iterar_mensajes_de_grupo(grupo_id: int, tamano_lote: int) -> Iterator[MensajeGrupoResponse]:
+    """
+    Recorre los mensajes del grupo por lotes con ``yield_per``, sin materializar la lista.
+    Abre su propia sesión porque se consume mientras se envía la respuesta.
+    La pertenencia al grupo se debe verificar antes con ``verificar_miembro_de_grupo``.
+    """
+    with db_instance.read() as session:
+        for m in _consulta_mensajes_de_grupo(session, grupo_id).yield_per(tamano_lote):
+            yield _mensaje_grupo_a_respuesta(m)
@@ -2,12 +2,18 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 import hashlib
 from cryptography.hazmat.primitives import hashes as crypto_hashes
-from cryptography.hazmat.primitives.asymmetric import padding, rsa, ec
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, ec, utils
 from cryptography.hazmat.primitives.asymmetric.padding import PSS, MGF1
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives.serialization import load_pem_public_key, load_pem_private_key
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+from backend.controllers.cache_claves import cargar_clave_publica
 import os
+from typing import BinaryIO
+
+# Bytes que se leen por vez al calcular el hash de un archivo (la memoria no depende del tamaño del archivo)
+TAMANO_BLOQUE_HASH = int(os.getenv("ARCHIVOS_BLOQUE_HASH", str(1024 * 1024)))
 
 def get_hash_function(name):
     if name.lower() == "sha256":
@@ -18,10 +24,43 @@ def get_hash_function(name):
         raise ValueError("Algoritmo de hash no soportado")
 
 
-def save_hash(file_data: bytes, file_path: str, method: str, hash_algo: str) -> str:
-    """Calcula el hash del archivo y lo guarda en un archivo txt con el método de firma."""
+def hash_archivo(archivo: BinaryIO, hash_algo: str = "sha256") -> bytes:
+    """
+    Calcula el hash de un archivo abierto en binario leyéndolo por bloques de ``TAMANO_BLOQUE_HASH``.
+
+    :param archivo: Archivo abierto en modo binario, en la posición desde la que se quiere el hash
+    :param hash_algo: "sha256" o "sha3_256"
+    :return: Digest del contenido
+    """
     hash_func, _ = get_hash_function(hash_algo)
-    file_hash = hash_func(file_data).hexdigest()
+    digest = hash_func()
+    while bloque := archivo.read(TAMANO_BLOQUE_HASH):
+        digest.update(bloque)
+    return digest.digest()
+
+
+def firmar_digest(private_key_obj: rsa.RSAPrivateKey | ec.EllipticCurvePrivateKey, digest: bytes, hash_algo: str = "sha256") -> bytes:
+    """
+    Firma un hash ya calculado (``Prehashed``), sin volver a pasar los datos por la clave. La firma
+    es la misma que la de firmar los datos completos, así que se verifica con la clave pública de
+    la forma habitual.
+
+    :param private_key_obj: Clave privada RSA (PSS) o ECC (ECDSA)
+    :param digest: Hash de los datos con ``hash_algo``
+    :param hash_algo: Algoritmo con el que se calculó ``digest``
+    :return: Firma
+    """
+    _, crypto_hash = get_hash_function(hash_algo)
+    prehashed = utils.Prehashed(crypto_hash)
+    if isinstance(private_key_obj, rsa.RSAPrivateKey):
+        return private_key_obj.sign(digest, PSS(mgf=MGF1(crypto_hash), salt_length=PSS.MAX_LENGTH), prehashed)
+    if isinstance(private_key_obj, ec.EllipticCurvePrivateKey):
+        return private_key_obj.sign(digest, ec.ECDSA(prehashed))
+    raise ValueError("Tipo de clave privada no soportado")
+
+
+def save_hash(file_hash: str, file_path: str, method: str, hash_algo: str) -> str:
+    """Guarda el hash (hexadecimal) del archivo en un archivo txt con el método de firma."""
     hash_file_path = f"{file_path}.{method}.{hash_algo}.hash"
     with open(hash_file_path, "w") as f:
         f.write(f"{hash_algo.upper()}: {file_hash}\nFirmado con: {method.upper()}")
@@ -31,17 +70,12 @@ def save_hash(file_data: bytes, file_path: str, method: str, hash_algo: str) ->
 
 def sign_file_with_rsa(file_path: str, private_key_obj: rsa.RSAPrivateKey, hash_algo: str = "sha256") -> tuple:
     """Firma el archivo utilizando un objeto de clave privada RSA y guarda el hash."""
+    # El archivo se lee por bloques y se firma el hash, sin cargarlo entero en memoria
     with open(file_path, "rb") as f:
-        file_data = f.read()
-
-    _, crypto_hash = get_hash_function(hash_algo)
+        file_hash = hash_archivo(f, hash_algo)
 
     # Generar la firma del archivo
-    signature = private_key_obj.sign(
-        file_data,
-        PSS(mgf=MGF1(crypto_hash), salt_length=PSS.MAX_LENGTH),
-        crypto_hash
-    )
+    signature = firmar_digest(private_key_obj, file_hash, hash_algo)
 
     # Guardar la firma en un archivo
     signature_path = f"{file_path}.rsa.{hash_algo}.sig"
@@ -49,7 +83,7 @@ def sign_file_with_rsa(file_path: str, private_key_obj: rsa.RSAPrivateKey, hash_
         f.write(signature)
 
     # Guardar el hash
-    hash_file_path = save_hash(file_data, file_path, "rsa", hash_algo)
+    hash_file_path = save_hash(file_hash.hex(), file_path, "rsa", hash_algo)
 
     return signature_path, hash_file_path
 
@@ -57,15 +91,10 @@ def sign_file_with_rsa(file_path: str, private_key_obj: rsa.RSAPrivateKey, hash_
 def sign_file_with_ecc(file_path: str, private_key_obj: ec.EllipticCurvePrivateKey, hash_algo: str = "sha256") -> tuple:
     """Firma el archivo utilizando un objeto de clave privada ECC y guarda el hash."""
     with open(file_path, "rb") as f:
-        file_data = f.read()
-
-    _, crypto_hash = get_hash_function(hash_algo)
+        file_hash = hash_archivo(f, hash_algo)
 
     # Generar la firma del archivo
-    signature = private_key_obj.sign(
-        file_data,
-        ec.ECDSA(crypto_hash)
-    )
+    signature = firmar_digest(private_key_obj, file_hash, hash_algo)
 
     # Guardar la firma en un archivo
     signature_path = f"{file_path}.ecc.{hash_algo}.sig"
@@ -73,7 +102,7 @@ def sign_file_with_ecc(file_path: str, private_key_obj: ec.EllipticCurvePrivateK
         f.write(signature)
 
     # Guardar el hash
-    hash_file_path = save_hash(file_data, file_path, "ecc", hash_algo)
+    hash_file_path = save_hash(file_hash.hex(), file_path, "ecc", hash_algo)
 
     return signature_path, hash_file_path
 
@@ -135,10 +164,15 @@ def generate_keys():
         }
     }
 
-def cifrar_con_ecdh_aes(priv_key_grupo_pem: str, pub_key_usuario_pem: str, datos_a_cifrar: bytes) -> bytes:
-    # Cargar claves
+def cifrar_con_ecdh_aes(priv_key_grupo_pem: str, pub_key_usuario_pem: str, datos_a_cifrar: bytes, propietario: str | None = None) -> bytes:
     private_key = load_pem_private_key(priv_key_grupo_pem.encode(), password=None)
-    public_key = load_pem_public_key(pub_key_usuario_pem.encode())
+    return cifrar_con_ecdh_aes_con_clave(private_key, pub_key_usuario_pem, datos_a_cifrar, propietario)
+
+
+def cifrar_con_ecdh_aes_con_clave(private_key: ec.EllipticCurvePrivateKey, pub_key_usuario_pem: str, datos_a_cifrar: bytes, propietario: str | None = None) -> bytes:
+    """Como ``cifrar_con_ecdh_aes`` pero con la clave privada ya cargada, para cifrar para muchos usuarios."""
+    # La clave pública del usuario sale de la caché de claves parseadas
+    public_key = cargar_clave_publica(pub_key_usuario_pem, propietario)
 
     # ECDH: generar clave compartida
     shared_key = private_key.exchange(ec.ECDH(), public_key)
@@ -156,4 +190,26 @@ def cifrar_con_ecdh_aes(priv_key_grupo_pem: str, pub_key_usuario_pem: str, datos
     nonce = os.urandom(12)
     ciphertext = aesgcm.encrypt(nonce, datos_a_cifrar, None)
 
-    return nonce + ciphertext
\ No newline at end of file
+    return nonce + ciphertext
+
+
+def descifrar_con_ecdh_aes(private_key: ec.EllipticCurvePrivateKey, pub_key_pem: str, datos_cifrados: bytes, propietario: str | None = None) -> bytes:
+    """
+    Inverso de ``cifrar_con_ecdh_aes``: el destinatario usa su clave privada y la pública de quien cifró.
+
+    :param private_key: Clave privada del destinatario
+    :param pub_key_pem: Clave pública PEM de quien cifró (p. ej. la del grupo o la de un nodo de su árbol)
+    :param datos_cifrados: nonce (12 bytes) + ciphertext AES-GCM
+    :param propietario: Propietario de la clave pública para la caché de claves parseadas
+    :return: Datos descifrados
+    """
+    public_key = cargar_clave_publica(pub_key_pem, propietario)
+    shared_key = private_key.exchange(ec.ECDH(), public_key)
+    derived_key = HKDF(
+        algorithm=crypto_hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'grupo-key-ecdh',
+    ).derive(shared_key)
+
+    return AESGCM(derived_key).decrypt(datos_cifrados[:12], datos_cifrados[12:], None)
\ No newline at end of file
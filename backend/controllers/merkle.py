@@ -0,0 +1,91 @@
+import hashlib
+
+# Prefijos de dominio para que una hoja nunca pueda hacerse pasar por un nodo interno
+PREFIJO_HOJA = b"\x00"
+PREFIJO_NODO = b"\x01"
+
+
+def hoja_mensaje(tipo: str, id_mensaje: int | str, hash_mensaje: str) -> bytes:
+    """
+    Calcula la hoja del árbol de Merkle de un mensaje. Incluye el tipo y el id para que dos
+    mensajes con el mismo texto (y por tanto el mismo hash) produzcan hojas distintas.
+
+    :param tipo: "individual" o "grupal"
+    :param id_mensaje: Id del mensaje en su tabla
+    :param hash_mensaje: Hash hexadecimal del mensaje plano
+    :return: Hash de la hoja (32 bytes)
+    """
+    contenido = f"{tipo}:{id_mensaje}:{hash_mensaje}".encode()
+    return hashlib.sha256(PREFIJO_HOJA + contenido).digest()
+
+
+def hoja_cabeza(particion: str, id_bloque: int, hash_bloque: str) -> bytes:
+    """
+    Calcula la hoja con la que un bloque de anclaje de la cadena raíz compromete la cabeza de una partición.
+
+    :param particion: Nombre de la partición (p. ej. "grupo:3")
+    :param id_bloque: Id del bloque cabeza de la partición
+    :param hash_bloque: Hash de ese bloque
+    :return: Hash de la hoja (32 bytes)
+    """
+    return hoja_mensaje("cabeza", f"{particion}:{id_bloque}", hash_bloque)
+
+
+def _hash_nodo(izquierda: bytes, derecha: bytes) -> bytes:
+    return hashlib.sha256(PREFIJO_NODO + izquierda + derecha).digest()
+
+
+def _siguiente_nivel(nivel: list[bytes]) -> list[bytes]:
+    siguiente = []
+    for i in range(0, len(nivel) - 1, 2):
+        siguiente.append(_hash_nodo(nivel[i], nivel[i + 1]))
+    if len(nivel) % 2 == 1:
+        # El nodo sin pareja sube sin cambios (no se duplica, ver CVE-2012-2459)
+        siguiente.append(nivel[-1])
+    return siguiente
+
+
+def calcular_raiz(hojas: list[bytes]) -> bytes:
+    """Calcula la raíz de Merkle de una lista ordenada de hojas."""
+    if not hojas:
+        raise ValueError("No se puede calcular la raíz de un árbol vacío")
+
+    nivel = list(hojas)
+    while len(nivel) > 1:
+        nivel = _siguiente_nivel(nivel)
+    return nivel[0]
+
+
+def generar_prueba(hojas: list[bytes], indice: int) -> list[dict]:
+    """
+    Genera la prueba de inclusión de la hoja ``indice``.
+
+    :return: Lista de pasos ``{"hash": hex, "lado": "izquierda" | "derecha"}`` desde la hoja hasta la raíz
+    """
+    if not 0 <= indice < len(hojas):
+        raise ValueError("Índice de hoja fuera de rango")
+
+    prueba = []
+    nivel = list(hojas)
+    while len(nivel) > 1:
+        hermano = indice ^ 1
+        if hermano < len(nivel):
+            prueba.append({
+                "hash": nivel[hermano].hex(),
+                "lado": "izquierda" if hermano < indice else "derecha"
+            })
+        nivel = _siguiente_nivel(nivel)
+        indice //= 2
+    return prueba
+
+
+def verificar_prueba(hoja: bytes, prueba: list[dict], raiz: bytes) -> bool:
+    """Recalcula la raíz a partir de la hoja y la prueba y la compara con la esperada."""
+    actual = hoja
+    for paso in prueba:
+        hermano = bytes.fromhex(paso["hash"])
+        if paso["lado"] == "izquierda":
+            actual = _hash_nodo(hermano, actual)
+        else:
+            actual = _hash_nodo(actual, hermano)
+    return actual == raiz
@@ -1,38 +1,18 @@
-from backend.database import db, User, Mensajes, Blockchain
-from backend.controllers.firma import calcular_hash_mensaje, verify_signature, sign_message, encrypt_message_aes, encrypt_aes_key_with_ecc
-
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec
+from backend.database import db, User, Mensajes
+from backend.controllers.bloques import constructor_bloques
+from backend.controllers.firma import calcular_hash_mensaje, verify_signature, sign_message, cifrar_mensaje_aes, encrypt_aes_key_with_ecc
+from backend.controllers.cache_claves import cargar_clave_publica, propietario_usuario
+from backend.controllers.ratchet import clave_de_mensaje
+from backend.controllers.sobre import abrir_sobre_guardado
+from backend.controllers.sesiones_mensajes import SESIONES_MENSAJES, MENSAJES_POR_SESION, siguiente_clave_de_sesion
+
+from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 import os
-import hashlib
 import base64
-import json
-
-from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
-from datetime import datetime
-
-
-def crear_bloque(hash_mensaje: str, db_session) -> int:
-    ultimo_bloque = db_session.query(Blockchain).order_by(Blockchain.id_bloque_pk.desc()).first()
-    hash_anterior = ultimo_bloque.hash_actual if ultimo_bloque else "0" * 64
-    nonce = os.urandom(8).hex()
-    timestamp = datetime.utcnow()
-
-    contenido = f"{hash_anterior}{hash_mensaje}{nonce}{timestamp}"
-    hash_actual = hashlib.sha256(contenido.encode()).hexdigest()
 
-    nuevo_bloque = Blockchain(
-        hash_anterior=hash_anterior,
-        hash_actual=hash_actual,
-        nonce=nonce,
-        timestamp=timestamp
-    )
-    db_session.add(nuevo_bloque)
-    db_session.flush()
-    return nuevo_bloque.id_bloque_pk
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 
 
 def guardar_mensaje_individual(data, algoritmo_hash: str = "sha256"):
@@ -43,45 +23,55 @@ def guardar_mensaje_individual(data, algoritmo_hash: str = "sha256"):
         if not remitente or not receptor:
             raise ValueError("Remitente o receptor no encontrado")
 
+        # Con sesiones, la clave AES sale de la cadena de la conversación y no se cifra por mensaje
+        id_sesion = contador = clave_aes = None
+        if SESIONES_MENSAJES:
+            id_sesion, contador, clave_aes = siguiente_clave_de_sesion(remitente.id_pk, receptor)
+
         resultado = procesar_mensaje_para_envio(
             mensaje=data.mensaje,
             clave_privada_pem=data.clave_privada_remitente,
             clave_publica_receptor_pem=receptor.public_key,
-            algoritmo_hash=algoritmo_hash
+            algoritmo_hash=algoritmo_hash,
+            propietario_receptor=propietario_usuario(receptor.id_pk),
+            clave_aes=clave_aes
         )
 
-        id_bloque = crear_bloque(resultado["hash_mensaje"], session)
-
+        # El bloque lo sella después el constructor de bloques (id_bloque queda pendiente)
         nuevo_mensaje = Mensajes(
             id_remitente=data.id_remitente,
             id_receptor=data.id_receptor,
-            mensaje=resultado["mensaje_cifrado"],
-            clave_aes_cifrada=json.dumps(resultado["clave_aes_cifrada"]),
+            mensaje="",
+            cifrado=resultado["cifrado"],
+            nonce_cifrado=resultado["nonce"],
+            clave_aes_cifrada=resultado["clave_aes_cifrada"] or "",
             firma=resultado["firma"],
             hash_mensaje=resultado["hash_mensaje"],
-            id_bloque=id_bloque,
             clave_aes=resultado["clave_aes"],
+            id_sesion_fk=id_sesion,
+            contador=contador,
         )
         session.add(nuevo_mensaje)
         session.commit()
 
+        constructor_bloques.notificar()
+
         return {"message": "Mensaje guardado correctamente", "timestamp": nuevo_mensaje.timestamp}
 
 
-def procesar_mensaje_para_envio(mensaje: str, clave_privada_pem: str, clave_publica_receptor_pem: str, algoritmo_hash="sha256"):
-    # Cargar claves
+def procesar_mensaje_para_envio(mensaje: str, clave_privada_pem: str, clave_publica_receptor_pem: str, algoritmo_hash="sha256", propietario_receptor: str | None = None, clave_aes: bytes | None = None):
+    # Cargar clave privada del remitente
     private_key = load_pem_private_key(clave_privada_pem.encode(), password=None)
-    public_key_receptor = load_pem_public_key(clave_publica_receptor_pem.encode())
 
-    # Generar clave AES aleatoria
-    clave_aes = os.urandom(32)
+    clave_aes_cifrada = None
+    if clave_aes is None:
+        # Sin sesión: generar clave AES aleatoria y cifrarla con ECC (pública del receptor, de la caché de claves parseadas)
+        clave_aes = os.urandom(32)
+        public_key_receptor = cargar_clave_publica(clave_publica_receptor_pem, propietario_receptor)
+        clave_aes_cifrada = encrypt_aes_key_with_ecc(clave_aes, public_key_receptor)
 
-    # Cifrar mensaje con AES
-    mensaje_cifrado = encrypt_message_aes(mensaje, clave_aes)
-    mensaje_cifrado_json = json.dumps(mensaje_cifrado)
-
-    # Cifrar clave AES con ECC (pública del receptor)
-    clave_aes_cifrada = encrypt_aes_key_with_ecc(clave_aes, public_key_receptor)
+    # Cifrar mensaje con AES (ciphertext y nonce en binario)
+    cifrado, nonce = cifrar_mensaje_aes(mensaje, clave_aes)
 
     # Calcular hash
     hash_mensaje = calcular_hash_mensaje(mensaje, algoritmo_hash)
@@ -90,7 +80,8 @@ def procesar_mensaje_para_envio(mensaje: str, clave_privada_pem: str, clave_publ
     firma = sign_message(private_key, mensaje)
 
     return {
-        "mensaje_cifrado": mensaje_cifrado_json,
+        "cifrado": cifrado,
+        "nonce": nonce,
         "clave_aes_cifrada": clave_aes_cifrada,
         "firma": firma,
         "hash_mensaje": hash_mensaje,
@@ -100,30 +91,35 @@ def procesar_mensaje_para_envio(mensaje: str, clave_privada_pem: str, clave_publ
 
 def verificar_y_descifrar_mensaje(
         mensaje_cifrado: dict,
-        clave_aes_cifrada: dict,
+        clave_aes_cifrada: dict | str | None,
         firma: str,
         hash_mensaje: str,
         clave_privada_receptor_pem: str,
         clave_publica_remitente_pem: str,
-        algoritmo_hash: str = "sha256"
+        algoritmo_hash: str = "sha256",
+        clave_cadena_cifrada: dict | str | None = None,
+        contador: int | None = None
 ) -> str:
-    # Derivar clave AES a partir de la clave privada del receptor y la clave pública efímera
-    ephemeral_public_key = serialization.load_pem_public_key(clave_aes_cifrada["ephemeral_public_key"].encode())
+    """
+    Descifra un mensaje individual con la clave privada del receptor y verifica su firma y su hash.
+    Los mensajes de una sesión no traen ``clave_aes_cifrada``: se pasa la semilla cifrada de la
+    sesión y el contador del mensaje, y la clave AES se deriva avanzando la cadena. Las claves
+    cifradas pueden venir como sobre binario en base64 o en el JSON anterior.
+
+    :raises ValueError: Si falta la clave del mensaje, el contador está fuera de la sesión o la firma o el hash no coinciden
+    :return: Mensaje plano
+    """
     receptor_private_key = serialization.load_pem_private_key(clave_privada_receptor_pem.encode(), password=None)
-    shared_key = receptor_private_key.exchange(ec.ECDH(), ephemeral_public_key)
-
-    derived_key = HKDF(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=None,
-        info=b"ecies",
-    ).derive(shared_key)
-
-    # Descifrar clave AES
-    aesgcm = AESGCM(derived_key)
-    nonce = base64.b64decode(clave_aes_cifrada["nonce"])
-    encrypted_key = base64.b64decode(clave_aes_cifrada["encrypted_key"])
-    aes_key = aesgcm.decrypt(nonce, encrypted_key, None)
+
+    # Derivar clave AES: con la clave pública efímera del mensaje o con la de la sesión y la cadena
+    if clave_aes_cifrada:
+        aes_key = abrir_sobre_guardado(clave_aes_cifrada, receptor_private_key)
+    elif clave_cadena_cifrada is not None and contador is not None:
+        if not 0 <= contador < MENSAJES_POR_SESION:
+            raise ValueError(f"Contador fuera de la sesión: {contador}")
+        aes_key = clave_de_mensaje(abrir_sobre_guardado(clave_cadena_cifrada, receptor_private_key), contador)
+    else:
+        raise ValueError("Falta la clave AES cifrada o la sesión del mensaje")
 
     # Descifrar mensaje
     aesgcm_mensaje = AESGCM(aes_key)
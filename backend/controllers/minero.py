@@ -0,0 +1,201 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Bits a cero que debe tener al principio el hash de un bloque (0 desactiva la prueba de trabajo)
+DIFICULTAD = int(os.getenv("POW_DIFICULTAD", "12"))
+# "fija" o "adaptativa" (ajusta la dificultad para que minar un bloque tarde POW_TIEMPO_OBJETIVO_SEGUNDOS)
+MODO_DIFICULTAD = os.getenv("POW_MODO", "fija")
+TIEMPO_OBJETIVO = float(os.getenv("POW_TIEMPO_OBJETIVO_SEGUNDOS", "0.5"))
+DIFICULTAD_MINIMA = int(os.getenv("POW_DIFICULTAD_MINIMA", "8"))
+DIFICULTAD_MAXIMA = int(os.getenv("POW_DIFICULTAD_MAXIMA", "32"))
+# Procesos del pool de minado; por debajo de POW_DIFICULTAD_PARALELA se mina en el propio hilo
+PROCESOS_MINADO = int(os.getenv("POW_PROCESOS", str(os.cpu_count() or 1)))
+DIFICULTAD_PARALELA = int(os.getenv("POW_DIFICULTAD_PARALELA", "18"))
+
+# Intentos entre cada comprobación de si otro proceso ya encontró el nonce
+INTENTOS_POR_LOTE = 4096
+
+_cancelado = None
+
+
+def cumple_dificultad(hash_hex: str, dificultad: int) -> bool:
+    """Indica si el hash (hexadecimal) empieza por al menos ``dificultad`` bits a cero."""
+    if not dificultad:
+        return True
+    return int(hash_hex, 16) >> (256 - dificultad) == 0
+
+
+def _iniciar_proceso(cancelado):
+    global _cancelado
+    _cancelado = cancelado
+
+
+def _buscar_nonce(prefijo: bytes, dificultad: int, inicio: int, paso: int) -> tuple[int | None, int]:
+    """
+    Prueba los nonces ``inicio, inicio + paso, ...`` hasta que ``sha256(prefijo + nonce)``
+    (nonce de 8 bytes big-endian) cumpla la dificultad o se cancele la búsqueda.
+
+    :return: Tupla (nonce o None si se canceló, intentos realizados)
+    """
+    base = hashlib.sha256(prefijo)
+    limite = 1 << (256 - dificultad)
+    candidato = inicio
+    intentos = 0
+    while _cancelado is None or not _cancelado.is_set():
+        for _ in range(INTENTOS_POR_LOTE):
+            h = base.copy()
+            h.update(candidato.to_bytes(8, "big"))
+            if int.from_bytes(h.digest(), "big") < limite:
+                return candidato, intentos + 1
+            candidato = (candidato + paso) & 0xFFFFFFFFFFFFFFFF
+            intentos += 1
+    return None, intentos
+
+
+class Minero:
+    """
+    Prueba de trabajo de los bloques: busca un nonce cuyo hash tenga ``dificultad`` bits a cero al principio.
+    Con dificultades altas reparte el espacio de nonces entre un pool de procesos y cancela
+    a los demás en cuanto uno encuentra un nonce válido.
+    """
+
+    def __init__(
+            self,
+            dificultad: int = DIFICULTAD,
+            modo: str = MODO_DIFICULTAD,
+            tiempo_objetivo: float = TIEMPO_OBJETIVO,
+            procesos: int = PROCESOS_MINADO,
+            dificultad_paralela: int = DIFICULTAD_PARALELA
+    ):
+        if modo not in ("fija", "adaptativa"):
+            raise ValueError(f"Modo de dificultad no soportado: {modo}")
+
+        self.dificultad = dificultad
+        self.modo = modo
+        self.tiempo_objetivo = tiempo_objetivo
+        self.procesos = procesos
+        self.dificultad_paralela = dificultad_paralela
+
+        self._pool = None
+        self._cancelado = None
+        self._lock = threading.Lock()
+        self._lock_metricas = threading.Lock()
+        self._bloques = 0
+        self._intentos = 0
+        self._segundos = 0.0
+        self._ultimo = None
+
+    def _obtener_pool(self):
+        if self._pool is None:
+            # "spawn" porque el proceso principal tiene hilos (servidor y constructor de bloques)
+            contexto = multiprocessing.get_context("spawn")
+            self._cancelado = contexto.Event()
+            self._pool = contexto.Pool(self.procesos, initializer=_iniciar_proceso, initargs=(self._cancelado,))
+        return self._pool
+
+    def _minar_en_paralelo(self, prefijo: bytes, dificultad: int, inicio: int) -> tuple[int, int]:
+        with self._lock:
+            pool = self._obtener_pool()
+            self._cancelado.clear()
+            tareas = [(prefijo, dificultad, (inicio + i) & 0xFFFFFFFFFFFFFFFF, self.procesos) for i in range(self.procesos)]
+
+            nonce = None
+            intentos = 0
+            for encontrado, intentos_proceso in pool.imap_unordered(_ejecutar_busqueda, tareas):
+                intentos += intentos_proceso
+                if encontrado is not None and nonce is None:
+                    nonce = encontrado
+                    self._cancelado.set()
+            return nonce, intentos
+
+    def minar(self, prefijo: bytes, dificultad: int) -> int:
+        """
+        Busca un nonce de 8 bytes tal que ``sha256(prefijo + nonce)`` tenga ``dificultad`` bits a cero.
+        La dificultad se pasa explícitamente porque forma parte del prefijo (la cabecera del bloque);
+        normalmente es ``self.dificultad``.
+
+        :param prefijo: Cabecera del bloque sin el nonce
+        :param dificultad: Bits a cero exigidos
+        :return: Nonce encontrado
+        """
+        # Punto de partida aleatorio para que los nonces no sean predecibles
+        inicio = int.from_bytes(os.urandom(8), "big")
+
+        if dificultad <= 0:
+            return inicio
+
+        comienzo = time.perf_counter()
+        if self.procesos > 1 and dificultad >= self.dificultad_paralela:
+            nonce, intentos = self._minar_en_paralelo(prefijo, dificultad, inicio)
+        else:
+            nonce, intentos = _buscar_nonce(prefijo, dificultad, inicio, 1)
+        segundos = time.perf_counter() - comienzo
+
+        self._registrar(dificultad, intentos, segundos)
+        return nonce
+
+    def _registrar(self, dificultad: int, intentos: int, segundos: float):
+        with self._lock_metricas:
+            self._bloques += 1
+            self._intentos += intentos
+            self._segundos += segundos
+            self._ultimo = {
+                "dificultad": dificultad,
+                "intentos": intentos,
+                "segundos": round(segundos, 4),
+                "hashrate": round(intentos / segundos, 1) if segundos else None,
+            }
+
+            if self.modo == "adaptativa":
+                # Un bit más duplica el trabajo esperado: se ajusta de uno en uno hacia el tiempo objetivo
+                if segundos < self.tiempo_objetivo / 2 and self.dificultad < DIFICULTAD_MAXIMA:
+                    self.dificultad += 1
+                elif segundos > self.tiempo_objetivo * 2 and self.dificultad > DIFICULTAD_MINIMA:
+                    self.dificultad -= 1
+
+    def metricas(self) -> dict:
+        """Devuelve la dificultad actual y el hashrate del último bloque y acumulado."""
+        with self._lock_metricas:
+            return {
+                "dificultad": self.dificultad,
+                "modo": self.modo,
+                "tiempo_objetivo_segundos": self.tiempo_objetivo if self.modo == "adaptativa" else None,
+                "procesos": self.procesos,
+                "bloques_minados": self._bloques,
+                "intentos": self._intentos,
+                "segundos": round(self._segundos, 3),
+                "hashrate_medio": round(self._intentos / self._segundos, 1) if self._segundos else None,
+                "ultimo_bloque": self._ultimo,
+            }
+
+    def cerrar(self):
+        """Cierra el pool de procesos si se llegó a crear."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+
+def _ejecutar_busqueda(argumentos: tuple) -> tuple[int | None, int]:
+    return _buscar_nonce(*argumentos)
+
+
+minero = Minero()
+
+
+if __name__ == "__main__":
+    # Hashrate en un solo proceso frente al pool completo
+    for procesos in (1, PROCESOS_MINADO):
+        prueba = Minero(dificultad=20, procesos=procesos, dificultad_paralela=0)
+        for i in range(3):
+            prueba.minar(f"bloque-{i}".encode(), prueba.dificultad)
+        print(procesos, "procesos:", prueba.metricas())
+        prueba.cerrar()
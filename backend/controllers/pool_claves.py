@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+from collections import deque
+
+from backend.controllers.keys import generate_ecc_keys
+from backend.utils.ejecutor_cripto import ejecutor_cripto
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Cuando quedan menos de POOL_CLAVES_ECC_MINIMO pares listos, el hilo rellena hasta POOL_CLAVES_ECC_MAXIMO
+MINIMO_POOL_CLAVES = int(os.getenv("POOL_CLAVES_ECC_MINIMO", "16"))
+MAXIMO_POOL_CLAVES = int(os.getenv("POOL_CLAVES_ECC_MAXIMO", "64"))
+
+
+class PoolClavesECC:
+    """
+    Pares de claves ECC (secp256r1, PEM PKCS8) generados de antemano por un hilo en segundo plano.
+    El hilo rellena el pool hasta ``maximo`` cuando baja de ``minimo``; si se vacía (p. ej. en un
+    pico de registros) las claves se generan en el momento.
+    """
+
+    def __init__(self, minimo: int = MINIMO_POOL_CLAVES, maximo: int = MAXIMO_POOL_CLAVES):
+        if minimo > maximo:
+            raise ValueError("El mínimo del pool de claves no puede ser mayor que el máximo")
+
+        self.minimo = minimo
+        self.maximo = maximo
+        self._claves = deque()
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+        self._servidas = 0
+        self._generadas_en_linea = 0
+        self._generadas_en_fondo = 0
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._despertar.set()
+        self._hilo = threading.Thread(target=self._ejecutar, name="pool-claves-ecc", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._despertar.set()
+        if self._hilo:
+            self._hilo.join()
+            self._hilo = None
+
+    def _tomar(self) -> tuple[str, str] | None:
+        with self._lock:
+            par = self._claves.popleft() if self._claves else None
+            if par is not None:
+                self._servidas += 1
+            if len(self._claves) < self.minimo:
+                self._despertar.set()
+            return par
+
+    def obtener(self) -> tuple[str, str]:
+        """
+        Devuelve un par (clave privada PEM, clave pública PEM) del pool, o lo genera si está vacío.
+        Cada par se entrega una sola vez.
+        """
+        par = self._tomar()
+        if par is None:
+            with self._lock:
+                self._generadas_en_linea += 1
+            par = generate_ecc_keys()
+        return par
+
+    async def obtener_async(self) -> tuple[str, str]:
+        """Como ``obtener``, pero si el pool está vacío genera el par en el ejecutor criptográfico."""
+        par = self._tomar()
+        if par is None:
+            with self._lock:
+                self._generadas_en_linea += 1
+            par = await ejecutor_cripto.ejecutar(generate_ecc_keys)
+        return par
+
+    def _ejecutar(self):
+        while not self._detener.is_set():
+            self._despertar.wait()
+            self._despertar.clear()
+            while not self._detener.is_set():
+                with self._lock:
+                    if len(self._claves) >= self.maximo:
+                        break
+                try:
+                    par = generate_ecc_keys()
+                except Exception:
+                    logger.exception("Error generando claves para el pool")
+                    break
+                with self._lock:
+                    self._claves.append(par)
+                    self._generadas_en_fondo += 1
+
+    def metricas(self) -> dict:
+        """Devuelve la profundidad del pool y cuántos pares se sirvieron del pool o se generaron en el momento."""
+        with self._lock:
+            return {
+                "profundidad": len(self._claves),
+                "minimo": self.minimo,
+                "maximo": self.maximo,
+                "servidas_del_pool": self._servidas,
+                "generadas_en_linea": self._generadas_en_linea,
+                "generadas_en_fondo": self._generadas_en_fondo,
+            }
+
+
+pool_claves_ecc = PoolClavesECC()
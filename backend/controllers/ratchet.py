@@ -0,0 +1,126 @@
+import hmac
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+# Cadena simétrica (hash ratchet): de cada clave de cadena salen la clave del mensaje,
+# HMAC-SHA256(cadena, 0x01), y la siguiente clave de cadena, HMAC-SHA256(cadena, 0x02).
+# Conociendo la semilla (posición 0) se obtiene la clave de cualquier posición posterior,
+# pero no se puede volver atrás desde una clave de cadena.
+CONSTANTE_MENSAJE = b"\x01"
+CONSTANTE_CADENA = b"\x02"
+
+
+def avanzar(clave_cadena: bytes) -> tuple[bytes, bytes]:
+    """
+    Da un paso en la cadena.
+
+    :param clave_cadena: Clave de cadena actual (32 bytes)
+    :return: Tupla (clave del mensaje, siguiente clave de cadena)
+    """
+    return (
+        hmac.digest(clave_cadena, CONSTANTE_MENSAJE, "sha256"),
+        hmac.digest(clave_cadena, CONSTANTE_CADENA, "sha256"),
+    )
+
+
+def clave_de_mensaje(semilla: bytes, contador: int) -> bytes:
+    """
+    Deriva la clave AES del mensaje en la posición ``contador`` de la cadena (``contador`` HMAC).
+
+    :param semilla: Clave de cadena en la posición 0
+    :param contador: Posición del mensaje
+    :return: Clave AES-256 del mensaje
+    """
+    if contador < 0:
+        raise ValueError("El contador de la cadena no puede ser negativo")
+    cadena = semilla
+    for _ in range(contador):
+        cadena = hmac.digest(cadena, CONSTANTE_CADENA, "sha256")
+    return hmac.digest(cadena, CONSTANTE_MENSAJE, "sha256")
+
+
+class CadenasDeEnvio:
+    """
+    Cadenas de envío abiertas en este proceso, en una LRU acotada. De cada sesión solo se guarda en
+    memoria la clave de cadena actual, así que las claves de los mensajes ya enviados no se pueden
+    recalcular desde aquí. Cuando una cadena se pierde (reinicio, expulsión de la LRU) o llega a
+    ``max_mensajes`` hay que abrir una sesión nueva, lo que además acota el coste de derivar la
+    clave de un mensaje al descifrar.
+    """
+
+    def __init__(self, capacidad: int, max_mensajes: int):
+        self.capacidad = capacidad
+        self.max_mensajes = max_mensajes
+        self._cadenas = OrderedDict()  # clave -> [id_sesion, contador, clave de cadena]
+        self._lock = threading.Lock()
+        self._abiertas = 0
+        self._mensajes = 0
+
+    def siguiente(self, clave: Hashable) -> tuple[int, int, bytes] | None:
+        """
+        Reserva la siguiente posición de la cadena abierta para ``clave`` y avanza la cadena.
+
+        :param clave: Identificador de la cadena (p. ej. grupo, remitente y época)
+        :return: Tupla (id de la sesión, contador, clave del mensaje), o None si no hay una cadena utilizable
+        """
+        with self._lock:
+            estado = self._cadenas.get(clave)
+            if estado is None:
+                return None
+            id_sesion, contador, cadena = estado
+            if contador >= self.max_mensajes:
+                del self._cadenas[clave]
+                return None
+            clave_mensaje, estado[2] = avanzar(cadena)
+            estado[1] = contador + 1
+            self._cadenas.move_to_end(clave)
+            self._mensajes += 1
+            return id_sesion, contador, clave_mensaje
+
+    def abrir(self, clave: Hashable, id_sesion: int, semilla: bytes) -> tuple[int, int, bytes]:
+        """
+        Registra una sesión recién creada y reserva su primera posición. Si otro hilo abrió a la
+        vez una sesión para la misma clave, la nueva la sustituye; la otra sigue siendo válida
+        para los mensajes que ya la usaron.
+
+        :param clave: Identificador de la cadena
+        :param id_sesion: Id de la sesión ya guardada
+        :param semilla: Clave de cadena en la posición 0
+        :return: Tupla (id de la sesión, 0, clave del mensaje)
+        """
+        clave_mensaje, cadena = avanzar(semilla)
+        with self._lock:
+            self._cadenas[clave] = [id_sesion, 1, cadena]
+            self._cadenas.move_to_end(clave)
+            while len(self._cadenas) > self.capacidad:
+                self._cadenas.popitem(last=False)
+            self._abiertas += 1
+            self._mensajes += 1
+        return id_sesion, 0, clave_mensaje
+
+    def siguiente_o_abrir(self, clave: Hashable, crear_sesion: Callable[[bytes], int]) -> tuple[int, int, bytes]:
+        """
+        Como ``siguiente``, pero si no hay una cadena utilizable genera una semilla nueva y abre la sesión.
+
+        :param clave: Identificador de la cadena
+        :param crear_sesion: Recibe la semilla, guarda la sesión con la semilla cifrada y devuelve su id
+        :return: Tupla (id de la sesión, contador, clave del mensaje)
+        """
+        siguiente = self.siguiente(clave)
+        if siguiente is not None:
+            return siguiente
+
+        semilla = os.urandom(32)
+        return self.abrir(clave, crear_sesion(semilla), semilla)
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                "cadenas_en_memoria": len(self._cadenas),
+                "capacidad": self.capacidad,
+                "mensajes_por_sesion": self.max_mensajes,
+                "sesiones_abiertas": self._abiertas,
+                "mensajes_cifrados": self._mensajes,
+            }
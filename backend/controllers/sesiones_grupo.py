@@ -0,0 +1,94 @@
+import os
+
+from cryptography.hazmat.primitives.asymmetric import ec
+from sqlalchemy.orm import Session
+
+from backend.controllers.cache_claves import propietario_grupo
+from backend.controllers.group import decrypt_aes_key_with_private_key, decrypt_message_with_aes_key, encrypt_aes_key_with_public_key
+from backend.controllers.ratchet import CadenasDeEnvio, clave_de_mensaje
+from backend.database import db as db_instance
+from backend.database.schemas import Grupos, SesionesGrupo
+
+# Modo sender keys: cada remitente abre una sesión por grupo y época y sus mensajes derivan la
+# clave AES de una cadena simétrica; el cifrado ECIES con la llave del grupo se hace una vez por sesión.
+# Desactivado por defecto: el cliente web descifra con clave_aes_cifrada y no envía id_sesion/contador
+CLAVES_DE_EMISOR_GRUPO = os.getenv("GRUPOS_CLAVES_EMISOR", "0").lower() in ("1", "true", "si", "yes")
+# Mensajes por sesión antes de abrir otra (acota los HMAC necesarios para derivar una clave al descifrar)
+MENSAJES_POR_SESION_GRUPO = int(os.getenv("GRUPOS_MENSAJES_POR_SESION", "1000"))
+# Cadenas de envío que se mantienen en memoria
+CAPACIDAD_SESIONES_GRUPO = int(os.getenv("GRUPOS_SESIONES_CAPACIDAD", "4096"))
+
+cadenas_grupo = CadenasDeEnvio(CAPACIDAD_SESIONES_GRUPO, MENSAJES_POR_SESION_GRUPO)
+
+
+def siguiente_clave_de_emisor(grupo: Grupos, id_remitente: int) -> tuple[int, int, bytes]:
+    """
+    Devuelve la clave AES del siguiente mensaje del remitente en la época actual del grupo. Si no
+    hay una sesión abierta en este proceso, crea una: genera la semilla, la cifra con la llave
+    pública del grupo y la guarda en ``sesiones_grupo`` en su propia transacción.
+
+    :param grupo: Grupo destino
+    :param id_remitente: Id del usuario que envía
+    :return: Tupla (id de la sesión, contador, clave AES del mensaje)
+    """
+    def crear_sesion(semilla: bytes) -> int:
+        with db_instance.write() as session:
+            sesion = SesionesGrupo(
+                id_grupo_fk=grupo.id_pk,
+                id_remitente_fk=id_remitente,
+                epoca=grupo.epoca_actual,
+                clave_cadena_cifrada=encrypt_aes_key_with_public_key(semilla, grupo.llave_publica, propietario_grupo(grupo.id_pk))
+            )
+            session.add(sesion)
+            session.flush()
+            return sesion.id_pk
+
+    return cadenas_grupo.siguiente_o_abrir((grupo.id_pk, id_remitente, grupo.epoca_actual), crear_sesion)
+
+
+def obtener_sesion_grupo(session: Session, id_sesion: int) -> SesionesGrupo | None:
+    return session.query(SesionesGrupo).filter(SesionesGrupo.id_pk == id_sesion).one_or_none()
+
+
+def claves_de_cadena_por_sesion(session: Session, id_grupo: int, ids_sesion: set[int]) -> dict[int, str]:
+    """Devuelve id de sesión -> semilla cifrada de las sesiones dadas que son del grupo."""
+    if not ids_sesion:
+        return {}
+    filas = session.query(SesionesGrupo.id_pk, SesionesGrupo.clave_cadena_cifrada).filter(
+        SesionesGrupo.id_grupo_fk == id_grupo,
+        SesionesGrupo.id_pk.in_(ids_sesion)
+    )
+    return {id_sesion: clave for id_sesion, clave in filas}
+
+
+def descifrar_mensaje_de_sesion(
+        grupo_priv_key: ec.EllipticCurvePrivateKey,
+        mensaje_cifrado: bytes | str,
+        nonce: bytes | str,
+        clave_cadena_cifrada: str,
+        contador: int,
+        semillas: dict | None = None
+) -> str:
+    """
+    Descifra un mensaje enviado con una sesión de emisor: descifra la semilla de la sesión (ECDH)
+    y avanza la cadena hasta la posición del mensaje.
+
+    :param grupo_priv_key: Clave privada ECC del grupo en la época de la sesión
+    :param mensaje_cifrado: Mensaje cifrado AES-GCM (binario o base64)
+    :param nonce: Nonce AES-GCM del mensaje (binario o base64)
+    :param clave_cadena_cifrada: Semilla de la sesión cifrada (JSON de ``encrypt_aes_key_with_public_key``)
+    :param contador: Posición del mensaje en la cadena
+    :param semillas: Semillas ya descifradas por semilla cifrada, para no repetir el ECDH en un lote
+    :raises ValueError: Si el contador está fuera de la cadena
+    :return: Mensaje plano
+    """
+    if not 0 <= contador < MENSAJES_POR_SESION_GRUPO:
+        raise ValueError(f"Contador fuera de la sesión: {contador}")
+
+    semilla = semillas.get(clave_cadena_cifrada) if semillas is not None else None
+    if semilla is None:
+        semilla = decrypt_aes_key_with_private_key(grupo_priv_key, clave_cadena_cifrada)
+        if semillas is not None:
+            semillas[clave_cadena_cifrada] = semilla
+
+    return decrypt_message_with_aes_key(clave_de_mensaje(semilla, contador), mensaje_cifrado, nonce)
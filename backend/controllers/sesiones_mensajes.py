@@ -0,0 +1,53 @@
+import hashlib
+import os
+
+from sqlalchemy.orm import Session
+
+from backend.controllers.cache_claves import cargar_clave_publica, propietario_usuario
+from backend.controllers.firma import encrypt_aes_key_with_ecc
+from backend.controllers.ratchet import CadenasDeEnvio
+from backend.database import db as db_instance
+from backend.database.schemas import SesionesMensajes, User
+
+# Sesiones por conversación: el ECDH con la clave del receptor se hace una vez por sesión y cada
+# mensaje deriva su clave AES de una cadena simétrica. Desactivado por defecto: el cliente web todavía
+# espera una clave_aes_cifrada por mensaje y no sabe pedir la semilla a /msg/sesion
+SESIONES_MENSAJES = os.getenv("MENSAJES_SESIONES", "0").lower() in ("1", "true", "si", "yes")
+# Mensajes por sesión antes de abrir otra (acota los HMAC necesarios para derivar una clave al descifrar)
+MENSAJES_POR_SESION = int(os.getenv("MENSAJES_POR_SESION", "1000"))
+# Cadenas de envío que se mantienen en memoria
+CAPACIDAD_SESIONES_MENSAJES = int(os.getenv("MENSAJES_SESIONES_CAPACIDAD", "4096"))
+
+cadenas_mensajes = CadenasDeEnvio(CAPACIDAD_SESIONES_MENSAJES, MENSAJES_POR_SESION)
+
+
+def siguiente_clave_de_sesion(id_remitente: int, receptor: User) -> tuple[int, int, bytes]:
+    """
+    Devuelve la clave AES del siguiente mensaje del remitente al receptor. Si no hay una sesión
+    abierta en este proceso (o el receptor cambió de clave pública), crea una: cifra la semilla con
+    la clave pública del receptor y la guarda en ``sesiones_mensajes`` en su propia transacción.
+
+    :param id_remitente: Id del usuario que envía
+    :param receptor: Usuario que recibe
+    :return: Tupla (id de la sesión, contador, clave AES del mensaje)
+    """
+    id_receptor, clave_publica = receptor.id_pk, receptor.public_key
+
+    def crear_sesion(semilla: bytes) -> int:
+        public_key = cargar_clave_publica(clave_publica, propietario_usuario(id_receptor))
+        with db_instance.write() as session:
+            sesion = SesionesMensajes(
+                id_remitente_fk=id_remitente,
+                id_receptor_fk=id_receptor,
+                clave_cadena_cifrada=encrypt_aes_key_with_ecc(semilla, public_key)
+            )
+            session.add(sesion)
+            session.flush()
+            return sesion.id_pk
+
+    huella = hashlib.sha256(clave_publica.encode()).digest()
+    return cadenas_mensajes.siguiente_o_abrir((id_remitente, id_receptor, huella), crear_sesion)
+
+
+def obtener_sesion_mensajes(session: Session, id_sesion: int) -> SesionesMensajes | None:
+    return session.query(SesionesMensajes).filter(SesionesMensajes.id_pk == id_sesion).one_or_none()
@@ -0,0 +1,114 @@
+import base64
+import json
+import os
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Sobre ECIES binario (clave efímera secp256r1 + HKDF-SHA256 + AES-GCM):
+#
+#   versión (1 byte) | clave pública efímera comprimida (33 bytes) | nonce (12 bytes) | ciphertext + tag
+#
+# La versión y la clave efímera van como datos asociados del AES-GCM. Sustituye al JSON
+# {"encrypted_key", "nonce", "ephemeral_public_key"} con base64 y PEM (unos 300 bytes de texto y
+# un json.loads más un parseo PEM por mensaje). Los sobres se guardan en base64 en las columnas
+# de texto; ``abrir_sobre_guardado`` sigue leyendo el JSON de las filas anteriores.
+VERSION_SOBRE = 1
+LONGITUD_PUNTO = 33
+LONGITUD_NONCE = 12
+LONGITUD_CABECERA = 1 + LONGITUD_PUNTO
+LONGITUD_MINIMA = LONGITUD_CABECERA + LONGITUD_NONCE + 16
+
+
+def _derivar_clave(shared_key: bytes) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"ecies",
+    ).derive(shared_key)
+
+
+def cifrar_sobre(datos: bytes, public_key: ec.EllipticCurvePublicKey) -> bytes:
+    """
+    Cifra ``datos`` (normalmente una clave AES o una semilla) para el dueño de ``public_key``.
+
+    :param datos: Datos a cifrar
+    :param public_key: Clave pública ECC (secp256r1) del destinatario
+    :return: Sobre binario
+    """
+    ephemeral_private_key = ec.generate_private_key(ec.SECP256R1())
+    shared_key = ephemeral_private_key.exchange(ec.ECDH(), public_key)
+
+    cabecera = bytes([VERSION_SOBRE]) + ephemeral_private_key.public_key().public_bytes(
+        serialization.Encoding.X962,
+        serialization.PublicFormat.CompressedPoint
+    )
+    nonce = os.urandom(LONGITUD_NONCE)
+    return cabecera + nonce + AESGCM(_derivar_clave(shared_key)).encrypt(nonce, datos, cabecera)
+
+
+def abrir_sobre(sobre: bytes, private_key: ec.EllipticCurvePrivateKey) -> bytes:
+    """
+    Inverso de ``cifrar_sobre``.
+
+    :param sobre: Sobre binario
+    :param private_key: Clave privada ECC del destinatario
+    :raises ValueError: Si el sobre está truncado o su versión no es soportada
+    :return: Datos descifrados
+    """
+    if len(sobre) < LONGITUD_MINIMA:
+        raise ValueError("Sobre ECIES truncado")
+    if sobre[0] != VERSION_SOBRE:
+        raise ValueError(f"Versión de sobre ECIES no soportada: {sobre[0]}")
+
+    cabecera = sobre[:LONGITUD_CABECERA]
+    nonce = sobre[LONGITUD_CABECERA:LONGITUD_CABECERA + LONGITUD_NONCE]
+    ephemeral_public_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), cabecera[1:])
+    shared_key = private_key.exchange(ec.ECDH(), ephemeral_public_key)
+    return AESGCM(_derivar_clave(shared_key)).decrypt(nonce, sobre[LONGITUD_CABECERA + LONGITUD_NONCE:], cabecera)
+
+
+def codificar_sobre(sobre: bytes) -> str:
+    """Base64 del sobre, para guardarlo en columnas de texto y enviarlo en JSON."""
+    return base64.b64encode(sobre).decode()
+
+
+def _abrir_sobre_json(sobre: dict, private_key: ec.EllipticCurvePrivateKey) -> bytes:
+    # Formato anterior: {"encrypted_key": base64, "nonce": base64, "ephemeral_public_key": PEM}
+    ephemeral_public_key = serialization.load_pem_public_key(sobre["ephemeral_public_key"].encode())
+    shared_key = private_key.exchange(ec.ECDH(), ephemeral_public_key)
+    return AESGCM(_derivar_clave(shared_key)).decrypt(
+        base64.b64decode(sobre["nonce"]),
+        base64.b64decode(sobre["encrypted_key"]),
+        None
+    )
+
+
+def abrir_sobre_guardado(sobre: bytes | str | dict, private_key: ec.EllipticCurvePrivateKey) -> bytes:
+    """
+    Abre un sobre en cualquiera de sus formatos: binario, binario en base64 o el JSON (texto o
+    diccionario) de las filas guardadas antes del formato binario.
+
+    :param sobre: Sobre guardado o recibido
+    :param private_key: Clave privada ECC del destinatario
+    :return: Datos descifrados
+    """
+    if isinstance(sobre, dict):
+        return _abrir_sobre_json(sobre, private_key)
+    if isinstance(sobre, str):
+        if sobre.lstrip().startswith("{"):
+            return _abrir_sobre_json(json.loads(sobre), private_key)
+        sobre = base64.b64decode(sobre)
+    return abrir_sobre(sobre, private_key)
+
+
+def sobre_para_respuesta(sobre: str | None) -> dict | str | None:
+    """Devuelve el JSON de las filas anteriores como diccionario y el sobre binario en base64 tal cual."""
+    if not sobre:
+        return None
+    if sobre.lstrip().startswith("{"):
+        return json.loads(sobre)
+    return sobre
@@ -0,0 +1,511 @@
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from backend.database.schemas import Blockchain, Mensajes, MensajesGrupo, PuntosControlIntegridad, AnclajesParticion
+from backend.controllers.bloques import HASH_GENESIS, PARTICION_RAIZ
+from backend.controllers.cabecera import VERSION_CABECERA, leer_cabecera, hash_cabecera, hash_bloque_texto
+from backend.controllers.firma import calcular_hash_mensaje, descifrar_mensaje_aes, partes_mensaje_cifrado
+from backend.controllers.merkle import hoja_mensaje, calcular_raiz
+from backend.controllers.minero import DIFICULTAD, DIFICULTAD_MINIMA, MODO_DIFICULTAD, cumple_dificultad
+from backend.utils.streaming import TAMANO_LOTE_STREAMING
+
+# Bloques que se leen y verifican juntos en cada rango de la verificación paralela
+BLOQUES_POR_RANGO = int(os.getenv("VERIFICACION_BLOQUES_POR_RANGO", "2000"))
+# Procesos que verifican rangos en paralelo (por defecto uno por núcleo)
+TRABAJADORES_VERIFICACION = int(os.getenv("VERIFICACION_TRABAJADORES", str(os.cpu_count() or 1)))
+# Dificultad que debe declarar como mínimo todo bloque con cabecera: la fija, o el suelo de la adaptativa
+DIFICULTAD_EXIGIDA = int(os.getenv(
+    "VERIFICACION_DIFICULTAD_MINIMA",
+    str(DIFICULTAD if MODO_DIFICULTAD == "fija" else min(DIFICULTAD, DIFICULTAD_MINIMA))
+))
+
+
+class PoolVerificacion:
+    """
+    Pool de procesos de la verificación paralela, uno para toda la vida de la aplicación: crear
+    uno por petición costaría arrancar ``trabajadores`` procesos cada vez. Usa "spawn" porque el
+    proceso principal tiene hilos (servidor y constructor de bloques) y un fork podría heredar
+    sus locks tomados.
+    """
+
+    def __init__(self, trabajadores: int = TRABAJADORES_VERIFICACION):
+        self.trabajadores = trabajadores
+        self._ejecutor = None
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+        self.ejecutor()
+
+    def ejecutor(self) -> ProcessPoolExecutor:
+        """Devuelve el pool, creándolo si todavía no existe (por ejemplo fuera del servidor)."""
+        with self._lock:
+            if self._ejecutor is None:
+                self._ejecutor = ProcessPoolExecutor(
+                    max_workers=self.trabajadores,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._ejecutor
+
+    def detener(self):
+        """Cierra el pool esperando a que terminen los rangos en curso."""
+        with self._lock:
+            if self._ejecutor is not None:
+                self._ejecutor.shutdown(cancel_futures=True)
+                self._ejecutor = None
+
+
+pool_verificacion = PoolVerificacion()
+
+
+class BloqueFila(NamedTuple):
+    id_bloque_pk: int
+    particion: str
+    hash_anterior: str
+    hash_actual: str
+    nonce: str
+    dificultad: int | None
+    timestamp: datetime
+    raiz_merkle: str | None
+    num_transacciones: int | None
+    cabecera: bytes | None
+
+
+class RangoVerificacion(NamedTuple):
+    """Datos de un rango de bloques ya leídos de la base, listos para verificarse en otro proceso."""
+    bloques: list[BloqueFila]
+    # (tipo, identificador, id_bloque, indice_hoja, hash) de los mensajes sellados y cabezas ancladas en el rango
+    hojas: list[tuple]
+    # (id, mensaje, cifrado, nonce_cifrado, clave_aes, hash_mensaje) de los mensajes individuales a descifrar
+    mensajes: list[tuple]
+
+
+COLUMNAS_BLOQUE = (
+    Blockchain.id_bloque_pk,
+    Blockchain.particion,
+    Blockchain.hash_anterior,
+    Blockchain.hash_actual,
+    Blockchain.nonce,
+    Blockchain.dificultad,
+    Blockchain.timestamp,
+    Blockchain.raiz_merkle,
+    Blockchain.num_transacciones,
+    Blockchain.cabecera,
+)
+
+CONSULTAS_HOJAS = (
+    ("individual", Mensajes.id, Mensajes.id_bloque, Mensajes.indice_hoja, Mensajes.hash_mensaje),
+    ("grupal", MensajesGrupo.id_transacciones_pk, MensajesGrupo.id_bloque_grupo, MensajesGrupo.indice_hoja, MensajesGrupo.hash_mensaje),
+)
+
+
+def _leer_rango(
+        session: Session,
+        desde_id: int,
+        hasta_id: int | None,
+        descifrar: bool,
+        particion: str | None = None
+) -> RangoVerificacion:
+    """Lee de una vez los bloques, hojas y (opcionalmente) mensajes individuales del rango."""
+    def en_rango(consulta, columna):
+        consulta = consulta.filter(columna >= desde_id)
+        if hasta_id is not None:
+            consulta = consulta.filter(columna <= hasta_id)
+        if particion is not None and columna is not Blockchain.id_bloque_pk:
+            consulta = consulta.join(Blockchain, Blockchain.id_bloque_pk == columna)
+        if particion is not None:
+            consulta = consulta.filter(Blockchain.particion == particion)
+        return consulta
+
+    bloques = [
+        BloqueFila(*fila)
+        for fila in en_rango(session.query(*COLUMNAS_BLOQUE), Blockchain.id_bloque_pk)
+        .order_by(Blockchain.id_bloque_pk)
+        .yield_per(TAMANO_LOTE_STREAMING)
+    ]
+
+    hojas = []
+    for tipo, columna_id, columna_bloque, columna_indice, columna_hash in CONSULTAS_HOJAS:
+        consulta = en_rango(
+            session.query(columna_id, columna_bloque, columna_indice, columna_hash).filter(columna_indice.isnot(None)),
+            columna_bloque
+        )
+        hojas.extend((tipo, *fila) for fila in consulta.yield_per(TAMANO_LOTE_STREAMING))
+
+    if particion in (None, PARTICION_RAIZ):
+        # Hojas de los bloques de anclaje: la cabeza de cada partición con su hash actual
+        consulta = (
+            session.query(
+                AnclajesParticion.particion,
+                AnclajesParticion.id_bloque_cabeza,
+                AnclajesParticion.id_bloque_ancla,
+                AnclajesParticion.indice_hoja,
+                Blockchain.hash_actual,
+            )
+            .join(Blockchain, Blockchain.id_bloque_pk == AnclajesParticion.id_bloque_cabeza)
+            .filter(AnclajesParticion.id_bloque_ancla >= desde_id)
+        )
+        if hasta_id is not None:
+            consulta = consulta.filter(AnclajesParticion.id_bloque_ancla <= hasta_id)
+        hojas.extend(
+            ("cabeza", f"{nombre}:{id_cabeza}", id_ancla, indice, hash_cabeza)
+            for nombre, id_cabeza, id_ancla, indice, hash_cabeza in consulta.yield_per(TAMANO_LOTE_STREAMING)
+        )
+
+    mensajes = []
+    if descifrar:
+        consulta = en_rango(
+            session.query(
+                Mensajes.id, Mensajes.mensaje, Mensajes.cifrado, Mensajes.nonce_cifrado, Mensajes.clave_aes, Mensajes.hash_mensaje
+            ),
+            Mensajes.id_bloque
+        )
+        mensajes = [tuple(fila) for fila in consulta.order_by(Mensajes.id).yield_per(TAMANO_LOTE_STREAMING)]
+
+    return RangoVerificacion(bloques, hojas, mensajes)
+
+
+def _campos_del_bloque(bloque) -> tuple[dict, str | None, list[str]]:
+    """
+    Devuelve los campos con los que verificar el bloque, su hash recalculado (None si no se puede
+    recalcular) y los errores de formato. Con cabecera binaria los campos salen de la propia cabecera
+    y deben coincidir con las columnas; sin ella se usan las columnas y el hash en formato texto.
+    """
+    columnas = {
+        "hash_anterior": bloque.hash_anterior,
+        "raiz_merkle": bloque.raiz_merkle,
+        "timestamp": bloque.timestamp,
+        "dificultad": bloque.dificultad,
+        "num_transacciones": bloque.num_transacciones,
+        "nonce": bloque.nonce,
+    }
+
+    if bloque.cabecera is None:
+        if bloque.raiz_merkle is None:
+            return columnas, None, []
+        return columnas, hash_bloque_texto(bloque.hash_anterior, bloque.raiz_merkle, bloque.nonce, bloque.timestamp), []
+
+    try:
+        campos = leer_cabecera(bloque.cabecera)._asdict()
+    except struct.error:
+        return columnas, None, ["Cabecera del bloque con formato inválido"]
+
+    errores = []
+    if campos.pop("version") != VERSION_CABECERA:
+        errores.append("Versión de cabecera no soportada")
+    if campos != columnas:
+        errores.append("La cabecera no coincide con los datos del bloque")
+    return campos, hash_cabecera(bloque.cabecera), errores
+
+
+def verificar_bloque(bloque, hash_anterior_esperado: str, hojas: list[tuple[int, bytes]]) -> list[dict]:
+    """
+    Verifica un bloque: enlace con el anterior, hash, prueba de trabajo y raíz de Merkle.
+    Con cabecera binaria basta recalcular su SHA-256 y leer sus campos, sin criptografía ni JSON.
+    La dificultad de un bloque con cabecera no puede ser menor que ``DIFICULTAD_EXIGIDA``: si no,
+    bastaría con declarar dificultad 0 para rehacer un bloque sin prueba de trabajo.
+    Los bloques antiguos (un mensaje por bloque, sin raíz) solo se comprueban por enlace.
+    """
+    campos, hash_calculado, errores_formato = _campos_del_bloque(bloque)
+    errores = [{"id_bloque": bloque.id_bloque_pk, "error": error} for error in errores_formato]
+
+    if bloque.cabecera is not None and (campos["dificultad"] or 0) < DIFICULTAD_EXIGIDA:
+        errores.append({
+            "id_bloque": bloque.id_bloque_pk,
+            "error": f"La dificultad del bloque es menor que la exigida ({DIFICULTAD_EXIGIDA} bits a cero)"
+        })
+
+    if campos["hash_anterior"] != hash_anterior_esperado:
+        errores.append({
+            "id_bloque": bloque.id_bloque_pk,
+            "error": "Hash anterior no coincide con el hash del bloque anterior"
+        })
+
+    if campos["dificultad"] and not cumple_dificultad(bloque.hash_actual, campos["dificultad"]):
+        errores.append({
+            "id_bloque": bloque.id_bloque_pk,
+            "error": f"El hash del bloque no cumple la dificultad ({campos['dificultad']} bits a cero)"
+        })
+
+    if hash_calculado is None:
+        return errores
+
+    if hash_calculado != bloque.hash_actual:
+        errores.append({
+            "id_bloque": bloque.id_bloque_pk,
+            "error": "Hash del bloque no coincide",
+            "esperado": hash_calculado,
+            "actual": bloque.hash_actual
+        })
+
+    if campos["num_transacciones"]:
+        hojas = sorted(hojas)
+        if [indice for indice, _ in hojas] != list(range(campos["num_transacciones"])):
+            errores.append({
+                "id_bloque": bloque.id_bloque_pk,
+                "error": "Faltan o sobran mensajes en el bloque",
+                "esperado": campos["num_transacciones"],
+                "actual": len(hojas)
+            })
+        elif calcular_raiz([hoja for _, hoja in hojas]).hex() != campos["raiz_merkle"]:
+            errores.append({
+                "id_bloque": bloque.id_bloque_pk,
+                "error": "Raíz de Merkle no coincide con los mensajes del bloque"
+            })
+
+    return errores
+
+
+def verificar_mensaje(id_mensaje: int, mensaje: str, cifrado: bytes | None, nonce: bytes | None, clave_aes: bytes, hash_mensaje: str) -> dict | None:
+    """Descifra un mensaje individual con su clave AES y comprueba que su hash coincide."""
+    try:
+        mensaje_original = descifrar_mensaje_aes(*partes_mensaje_cifrado(mensaje, cifrado, nonce), clave_aes)
+        recalculated_hash = calcular_hash_mensaje(str(mensaje_original), algoritmo="sha256")
+    except Exception as e:
+        return {
+            "id": id_mensaje,
+            "error": f"Error al descifrar el mensaje: {str(e)}"
+        }
+
+    if recalculated_hash != hash_mensaje:
+        return {
+            "id": id_mensaje,
+            "error": "Hash del mensaje no coincide",
+            "esperado": recalculated_hash,
+            "actual": hash_mensaje
+        }
+    return None
+
+
+def verificar_rango(rango: RangoVerificacion) -> dict:
+    """
+    Verifica un rango de bloques sin acceder a la base, para poder ejecutarse en otro proceso.
+    Los enlaces se comprueban dentro de cada partición; el del primer bloque de cada partición
+    con el rango anterior lo comprueba quien une los rangos.
+
+    :return: Diccionario con ``desde_id``, ``hasta_id``, ``primeros`` (partición -> (id, hash_anterior)
+        de su primer bloque), ``cabezas`` (partición -> hash de su último bloque), ``ultimo_hash``,
+        ``bloques``, ``errores`` y ``segundos``
+    """
+    inicio = time.perf_counter()
+
+    hojas = defaultdict(list)
+    for tipo, identificador, id_bloque, indice, hash_hoja in rango.hojas:
+        hojas[id_bloque].append((indice, hoja_mensaje(tipo, identificador, hash_hoja)))
+
+    errores = []
+    primeros = {}
+    cabezas = {}
+    for bloque in rango.bloques:
+        if bloque.particion not in cabezas:
+            primeros[bloque.particion] = (bloque.id_bloque_pk, bloque.hash_anterior)
+        hash_anterior = cabezas.get(bloque.particion, bloque.hash_anterior)
+        errores.extend(verificar_bloque(bloque, hash_anterior, hojas.get(bloque.id_bloque_pk, [])))
+        cabezas[bloque.particion] = bloque.hash_actual
+
+    for mensaje in rango.mensajes:
+        error = verificar_mensaje(*mensaje)
+        if error:
+            errores.append(error)
+
+    return {
+        "desde_id": rango.bloques[0].id_bloque_pk if rango.bloques else None,
+        "hasta_id": rango.bloques[-1].id_bloque_pk if rango.bloques else None,
+        "primeros": primeros,
+        "cabezas": cabezas,
+        "ultimo_hash": rango.bloques[-1].hash_actual if rango.bloques else None,
+        "bloques": len(rango.bloques),
+        "errores": errores,
+        "segundos": time.perf_counter() - inicio,
+    }
+
+
+def _unir_rangos(resultados: list[dict], desde_id: int, cabezas: dict[str, str]) -> dict:
+    """
+    Comprueba el enlace de cada partición entre rangos consecutivos y junta sus errores.
+
+    :param cabezas: Hash esperado como ``hash_anterior`` del primer bloque de cada partición
+        (las particiones que no aparecen empiezan en el génesis)
+    """
+    cabezas = dict(cabezas)
+    errores = []
+    ultimo_id = desde_id - 1
+    ultimo_hash = None
+    for resultado in resultados:
+        if not resultado["bloques"]:
+            continue
+        for particion, (id_bloque, hash_anterior) in resultado["primeros"].items():
+            if hash_anterior != cabezas.get(particion, HASH_GENESIS):
+                resultado["errores"].insert(0, {
+                    "id_bloque": id_bloque,
+                    "error": "Hash anterior no coincide con el hash del bloque anterior"
+                })
+        errores.extend(resultado["errores"])
+        cabezas.update(resultado["cabezas"])
+        ultimo_id = resultado["hasta_id"]
+        ultimo_hash = resultado["ultimo_hash"]
+
+    return {
+        "errores": errores,
+        "bloques": sum(r["bloques"] for r in resultados),
+        "ultimo_id": ultimo_id,
+        "ultimo_hash": ultimo_hash,
+        "cabezas": cabezas,
+    }
+
+
+def verificar_cadena(
+        session: Session,
+        desde_id: int = 1,
+        cabezas: dict[str, str] | None = None,
+        hasta_id: int | None = None,
+        descifrar: bool = False,
+        particion: str | None = None
+) -> dict:
+    """
+    Recorre en orden los bloques ``[desde_id, hasta_id]`` verificando enlaces, hashes y raíces de Merkle.
+
+    :param session: Sesión de lectura
+    :param desde_id: Primer bloque a verificar
+    :param cabezas: Hash de la cabeza de cada partición antes de ``desde_id`` (None = todas en el génesis)
+    :param hasta_id: Último bloque a verificar (None = hasta el final de la cadena)
+    :param descifrar: Descifrar además los mensajes individuales sellados y comprobar su hash
+    :param particion: Verificar solo la cadena de esta partición
+    :return: Diccionario con ``errores``, ``bloques`` verificados, ``ultimo_id``, ``ultimo_hash`` y ``cabezas``
+    """
+    resultado = verificar_rango(_leer_rango(session, desde_id, hasta_id, descifrar, particion))
+    return _unir_rangos([resultado], desde_id, cabezas or {})
+
+
+def verificar_cadena_paralela(
+        session: Session,
+        desde_id: int = 1,
+        cabezas: dict[str, str] | None = None,
+        descifrar: bool = False,
+        bloques_por_rango: int = BLOQUES_POR_RANGO,
+        trabajadores: int = TRABAJADORES_VERIFICACION
+) -> dict:
+    """
+    Divide la cadena desde ``desde_id`` en rangos de ``bloques_por_rango`` bloques, lee cada rango
+    de una vez y verifica hashes, raíces de Merkle y descifrados en ``pool_verificacion``.
+    Después une los rangos comprobando el enlace entre ellos. Con un solo rango no se usa el pool.
+
+    :return: Lo mismo que ``verificar_cadena`` más ``rangos`` (resumen y errores por rango),
+        ``segundos`` y ``bloques_por_segundo``
+    """
+    inicio = time.perf_counter()
+    ultimo = session.query(func.max(Blockchain.id_bloque_pk)).scalar() or 0
+    limites = [
+        (inicio_rango, min(inicio_rango + bloques_por_rango - 1, ultimo))
+        for inicio_rango in range(desde_id, ultimo + 1, bloques_por_rango)
+    ]
+
+    if len(limites) <= 1 or trabajadores <= 1:
+        resultados = [verificar_rango(_leer_rango(session, a, b, descifrar)) for a, b in limites]
+    else:
+        # Se lee el siguiente rango mientras los procesos verifican los anteriores,
+        # con como mucho dos rangos en vuelo por trabajador para acotar la memoria
+        ejecutor = pool_verificacion.ejecutor()
+        futuros = []
+        for a, b in limites:
+            futuros.append(ejecutor.submit(verificar_rango, _leer_rango(session, a, b, descifrar)))
+            if len(futuros) >= 2 * trabajadores:
+                futuros[-2 * trabajadores].result()
+        resultados = [futuro.result() for futuro in futuros]
+
+    resultado = _unir_rangos(resultados, desde_id, cabezas or {})
+    segundos = time.perf_counter() - inicio
+    resultado["segundos"] = round(segundos, 3)
+    resultado["bloques_por_segundo"] = round(resultado["bloques"] / segundos, 1) if segundos else None
+    resultado["rangos"] = [
+        {
+            "desde_id": r["desde_id"],
+            "hasta_id": r["hasta_id"],
+            "bloques": r["bloques"],
+            "segundos": round(r["segundos"], 3),
+            "errores": r["errores"],
+        }
+        for r in resultados if r["bloques"]
+    ]
+    return resultado
+
+
+def cabezas_hasta(session: Session, hasta_id: int) -> dict[str, str]:
+    """Devuelve el hash del último bloque de cada partición con id menor o igual a ``hasta_id``."""
+    ultimos = (
+        session.query(func.max(Blockchain.id_bloque_pk).label("id_bloque"))
+        .filter(Blockchain.id_bloque_pk <= hasta_id)
+        .group_by(Blockchain.particion)
+        .subquery()
+    )
+    return dict(
+        session.query(Blockchain.particion, Blockchain.hash_actual)
+        .join(ultimos, Blockchain.id_bloque_pk == ultimos.c.id_bloque)
+        .all()
+    )
+
+
+def _inicio_desde_punto_control(session: Session, verificacion: str) -> tuple[int, dict[str, str]]:
+    """
+    Devuelve el bloque desde el que hay que verificar y la cabeza esperada de cada partición.
+    Si el bloque del punto de control ya no tiene el hash guardado, se vuelve a verificar desde el génesis.
+    """
+    punto = session.get(PuntosControlIntegridad, verificacion)
+    if punto is None:
+        return 1, {}
+
+    hash_actual = (
+        session.query(Blockchain.hash_actual)
+        .filter(Blockchain.id_bloque_pk == punto.id_bloque)
+        .scalar()
+    )
+    if hash_actual != punto.hash_bloque:
+        return 1, {}
+
+    return punto.id_bloque + 1, cabezas_hasta(session, punto.id_bloque)
+
+
+def verificar_incremental(
+        session: Session,
+        verificacion: str,
+        completa: bool = False,
+        descifrar: bool = False
+) -> dict:
+    """
+    Verifica solo los bloques añadidos desde el último punto de control y, si no hay errores,
+    mueve el punto de control al último bloque verificado. La verificación con ``descifrar`` tiene
+    su propio punto de control (``"<verificacion>:descifrar"``): los bloques que solo se verificaron
+    sin descifrar no cuentan como descifrados.
+
+    :param session: Sesión de la base de datos (se hace commit si se guarda el punto de control)
+    :param verificacion: Nombre del punto de control ("individual")
+    :param completa: Ignorar el punto de control y verificar la cadena entera
+    :param descifrar: Descifrar y comprobar el hash de los mensajes individuales sellados en el rango
+    :return: Resultado de ``verificar_cadena_paralela`` más ``desde_id``
+    """
+    if descifrar:
+        verificacion = f"{verificacion}:descifrar"
+    desde_id, cabezas = (1, {}) if completa else _inicio_desde_punto_control(session, verificacion)
+
+    resultado = verificar_cadena_paralela(session, desde_id, cabezas, descifrar=descifrar)
+    resultado["desde_id"] = desde_id
+
+    if not resultado["errores"] and resultado["bloques"]:
+        session.merge(PuntosControlIntegridad(
+            verificacion=verificacion,
+            id_bloque=resultado["ultimo_id"],
+            hash_bloque=resultado["ultimo_hash"],
+            timestamp=datetime.utcnow(),
+        ))
+        session.commit()
+
+    return resultado
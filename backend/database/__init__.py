@@ -1,13 +1,14 @@
 from backend.database.database import Database
-from backend.database.schemas import User, Mensajes, Grupos, Blockchain, MensajesGrupo, MiembrosGrupos
+from backend.database.schemas import User, Mensajes, Grupos, Blockchain, MensajesGrupo, MiembrosGrupos, PuntosControlIntegridad, AnclajesParticion, EpocasGrupo, NodosGrupo, LlavesNodoGrupo, SesionesGrupo, SesionesMensajes, Archivos
 import os
 
 current_directory = os.path.dirname(os.path.abspath(__file__))
-db = Database(f"{current_directory}/db.sqlite")
+db = Database(os.getenv("DB_PATH", f"{current_directory}/db.sqlite"))
 
 __all__ = [
     "db",
     "get_db",
+    "get_async_db",
     "User",
     "Blockchain",
     "Mensajes",
@@ -15,6 +16,14 @@ __all__ = [
     "Blockchain",
     "MensajesGrupo",
     "MiembrosGrupos",
+    "PuntosControlIntegridad",
+    "AnclajesParticion",
+    "EpocasGrupo",
+    "NodosGrupo",
+    "LlavesNodoGrupo",
+    "SesionesGrupo",
+    "SesionesMensajes",
+    "Archivos",
 ]
 
 def get_db():
@@ -23,4 +32,13 @@ def get_db():
     try:
         yield session
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+
+async def get_async_db():
+    """Get an async database session."""
+    session = db.get_async_session()
+    try:
+        yield session
+    finally:
+        await session.close()
@@ -1,38 +1,153 @@
 import os
 import logging
-from contextlib import contextmanager
-from sqlalchemy import create_engine
+from contextlib import contextmanager, asynccontextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from backend.database.schemas import Base
+from backend.database.migraciones import aplicar_migraciones
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Perfiles del motor SQLite. "produccion" activa WAL y los pragmas de rendimiento,
+# "desarrollo" conserva el comportamiento original (journal por defecto y echo de SQL).
+PERFILES = {
+    "produccion": {
+        "echo": False,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,        # ms
+        "mmap_size": 268435456,      # 256 MiB
+        "cache_size": -65536,        # negativo = KiB -> 64 MiB por conexión
+        "pool_size": 10,
+        "max_overflow": 20,
+    },
+    "desarrollo": {
+        "echo": True,
+        "journal_mode": None,
+        "synchronous": None,
+        "busy_timeout": 5000,
+        "mmap_size": None,
+        "cache_size": None,
+        "pool_size": None,
+        "max_overflow": None,
+    },
+}
+
+
+def cargar_configuracion(perfil: str | None = None) -> dict:
+    """
+    Construye la configuración del motor a partir de un perfil y de variables de entorno.
+
+    El perfil se toma de ``DB_PERFIL`` (por defecto ``produccion``) y cada valor puede
+    sobrescribirse con ``DB_ECHO``, ``DB_JOURNAL_MODE``, ``DB_SYNCHRONOUS``, ``DB_BUSY_TIMEOUT``,
+    ``DB_MMAP_SIZE``, ``DB_CACHE_SIZE``, ``DB_POOL_SIZE`` y ``DB_MAX_OVERFLOW``.
+
+    :param perfil: Nombre del perfil; si es None se lee de ``DB_PERFIL``
+    :return: Diccionario con la configuración del motor
+    """
+    perfil = perfil or os.getenv("DB_PERFIL", "produccion")
+    if perfil not in PERFILES:
+        raise ValueError(f"Perfil de base de datos no soportado: {perfil}")
+
+    config = dict(PERFILES[perfil])
+
+    echo = os.getenv("DB_ECHO")
+    if echo is not None:
+        config["echo"] = echo.lower() in ("1", "true", "si", "yes")
+
+    for clave in ("journal_mode", "synchronous"):
+        valor = os.getenv(f"DB_{clave.upper()}")
+        if valor is not None:
+            config[clave] = valor
+
+    for clave in ("busy_timeout", "mmap_size", "cache_size", "pool_size", "max_overflow"):
+        valor = os.getenv(f"DB_{clave.upper()}")
+        if valor is not None:
+            config[clave] = int(valor)
+
+    return config
+
 class Database:
     """Clase para la conexión a la base de datos SQLite."""
 
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, perfil: str | None = None):
         """
         Conecta a la base de datos SQLite y crea el motor.
 
         :param db_path: Ruta al archivo de la base de datos SQLite
+        :param perfil: Perfil del motor ("produccion" o "desarrollo"); por defecto se lee de ``DB_PERFIL``
         """
         self.db_path = db_path
+        self.config = cargar_configuracion(perfil)
         self.engine = None
         self.Session = None
+        self.async_engine = None
+        self.AsyncSession = None
 
         self.connect()
         self.Session = sessionmaker(bind=self.engine)
+        self.AsyncSession = async_sessionmaker(bind=self.async_engine, expire_on_commit=False)
         self.create_tables()
 
     def connect(self):
-        """Conecta a la base de datos SQLite y crea un motor."""
-        connection_string = f"sqlite:///{self.db_path}"
-        self.engine = create_engine(connection_string, echo=True)
+        """Conecta a la base de datos SQLite y crea un motor síncrono y otro asíncrono (aiosqlite)."""
+        config = self.config
+
+        opciones = {
+            "echo": config["echo"],
+            "connect_args": {
+                "check_same_thread": False,
+                "timeout": config["busy_timeout"] / 1000,
+            },
+        }
+
+        # Sin pool_size se deja el pool por defecto de SQLAlchemy
+        if config["pool_size"]:
+            opciones["poolclass"] = QueuePool
+            opciones["pool_size"] = config["pool_size"]
+            opciones["max_overflow"] = config["max_overflow"] or 0
+            opciones["pool_pre_ping"] = True
+
+        self.engine = create_engine(f"sqlite:///{self.db_path}", **opciones)
+        event.listen(self.engine, "connect", self._aplicar_pragmas)
+
+        opciones_async = dict(opciones)
+        if config["pool_size"]:
+            opciones_async["poolclass"] = AsyncAdaptedQueuePool
+
+        self.async_engine = create_async_engine(f"sqlite+aiosqlite:///{self.db_path}", **opciones_async)
+        event.listen(self.async_engine.sync_engine, "connect", self._aplicar_pragmas)
+
+    def _aplicar_pragmas(self, dbapi_connection, connection_record):
+        """
+        Aplica los pragmas del perfil a cada conexión nueva del pool.
+
+        :param dbapi_connection: Conexión sqlite3 recién abierta
+        :param connection_record: Registro de la conexión en el pool
+        """
+        config = self.config
+        cursor = dbapi_connection.cursor()
+        try:
+            if config["journal_mode"]:
+                cursor.execute(f"PRAGMA journal_mode={config['journal_mode']}")
+            if config["synchronous"]:
+                cursor.execute(f"PRAGMA synchronous={config['synchronous']}")
+            if config["busy_timeout"] is not None:
+                cursor.execute(f"PRAGMA busy_timeout={int(config['busy_timeout'])}")
+            if config["mmap_size"] is not None:
+                cursor.execute(f"PRAGMA mmap_size={int(config['mmap_size'])}")
+            if config["cache_size"] is not None:
+                cursor.execute(f"PRAGMA cache_size={int(config['cache_size'])}")
+        finally:
+            cursor.close()
 
     def create_tables(self):
-        """Crea las tablas en la base de datos si no existen."""
+        """Crea las tablas que no existan y aplica las migraciones pendientes del esquema."""
         Base.metadata.create_all(self.engine)
+        aplicar_migraciones(self.engine)
 
     def get_session(self):
         """
@@ -42,6 +157,15 @@ class Database:
         """
         return self.Session()
 
+    def get_async_session(self) -> AsyncSession:
+        """
+        Obtiene una sesión asíncrona de la base de datos, para usar desde rutas ``async def``
+        sin bloquear el event loop.
+
+        :return: Sesión asíncrona de la base de datos
+        """
+        return self.AsyncSession()
+
     @contextmanager
     def write(self):
         """
@@ -76,6 +200,24 @@ class Database:
         finally:
             session.close()
 
+    @asynccontextmanager
+    async def write_async(self):
+        """
+        Versión asíncrona de ``write``: confirma la transacción al salir o hace rollback si hay error.
+
+        :return: Sesión asíncrona de base de datos
+        """
+        session = self.get_async_session()
+        try:
+            yield session
+            await session.commit()
+        except Exception as error:
+            logger.error(f"Error en la operación de escritura: {error}")
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
     def clear(self):
         """
         Elimina todas las tablas de la base de datos y las vuelve a crear.
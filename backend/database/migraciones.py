@@ -0,0 +1,185 @@
+import logging
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@dataclass(frozen=True)
+class Migracion:
+    """Paso versionado del esquema. La versión aplicada se guarda en ``PRAGMA user_version``."""
+
+    version: int
+    descripcion: str
+    aplicar: Callable[[Connection], None]
+
+
+MIGRACIONES: list[Migracion] = []
+
+
+def migracion(version: int, descripcion: str):
+    """
+    Registra una función como migración del esquema.
+
+    Las migraciones deben ser idempotentes: en una base nueva ``Base.metadata.create_all``
+    ya crea las tablas con sus índices y la migración solo marca la versión.
+
+    :param version: Número de versión (estrictamente creciente)
+    :param descripcion: Descripción corta de la migración
+    """
+    def decorador(funcion: Callable[[Connection], None]):
+        if MIGRACIONES and version <= MIGRACIONES[-1].version:
+            raise ValueError(f"La migración {version} no es posterior a {MIGRACIONES[-1].version}")
+        MIGRACIONES.append(Migracion(version, descripcion, funcion))
+        return funcion
+
+    return decorador
+
+
+def version_actual(conexion: Connection) -> int:
+    """Devuelve la versión del esquema guardada en la base de datos."""
+    return conexion.execute(text("PRAGMA user_version")).scalar() or 0
+
+
+def columnas_de(conexion: Connection, tabla: str) -> set[str]:
+    """Devuelve los nombres de las columnas de una tabla."""
+    return {fila[1] for fila in conexion.execute(text(f"PRAGMA table_info({tabla})"))}
+
+
+def agregar_columna(conexion: Connection, tabla: str, columna: str, definicion: str):
+    """Agrega una columna si la tabla todavía no la tiene (SQLite no soporta ``ADD COLUMN IF NOT EXISTS``)."""
+    if columna not in columnas_de(conexion, tabla):
+        conexion.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}"))
+
+
+def aplicar_migraciones(engine: Engine) -> int:
+    """
+    Aplica en orden las migraciones pendientes sobre una base existente.
+
+    :param engine: Motor de SQLAlchemy
+    :return: Versión del esquema tras aplicar las migraciones
+    """
+    with engine.connect() as conexion:
+        version = version_actual(conexion)
+
+    for paso in MIGRACIONES:
+        if paso.version <= version:
+            continue
+
+        logger.info(f"Aplicando migración {paso.version}: {paso.descripcion}")
+        with engine.begin() as conexion:
+            paso.aplicar(conexion)
+            conexion.execute(text(f"PRAGMA user_version = {int(paso.version)}"))
+        version = paso.version
+
+    return version
+
+
+# ---------------------------------------------------------------------------
+# Migraciones
+# ---------------------------------------------------------------------------
+
+@migracion(1, "Índices de las consultas frecuentes y unicidad de correo y membresía")
+def _indices_consultas_frecuentes(conexion: Connection):
+    duplicados = conexion.execute(text(
+        "SELECT correo FROM user GROUP BY correo HAVING COUNT(*) > 1"
+    )).scalars().all()
+    if duplicados:
+        raise RuntimeError(f"No se puede crear el índice único de correo, hay correos duplicados: {duplicados}")
+
+    # Las membresías repetidas son redundantes: se conserva la más antigua
+    conexion.execute(text(
+        "DELETE FROM miembros_de_grupos WHERE id_pk NOT IN ("
+        "SELECT MIN(id_pk) FROM miembros_de_grupos GROUP BY id_grupo_fk, id_user_fk)"
+    ))
+
+    sentencias = [
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_user_correo ON user (correo)",
+        "CREATE INDEX IF NOT EXISTS ix_mensajes_receptor_timestamp ON mensajes (id_receptor, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_mensajes_remitente_timestamp ON mensajes (id_remitente, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_mensajes_receptor_remitente_timestamp ON mensajes (id_receptor, id_remitente, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_mensajes_remitente_receptor_timestamp ON mensajes (id_remitente, id_receptor, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_mensajes_id_bloque ON mensajes (id_bloque)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_miembros_grupo_usuario ON miembros_de_grupos (id_grupo_fk, id_user_fk)",
+        "CREATE INDEX IF NOT EXISTS ix_miembros_usuario ON miembros_de_grupos (id_user_fk)",
+        "CREATE INDEX IF NOT EXISTS ix_mensajes_grupo_grupo_timestamp ON mensajes_grupo (id_grupo_fk, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_mensajes_grupo_id_bloque ON mensajes_grupo (id_bloque_grupo)",
+    ]
+    for sentencia in sentencias:
+        conexion.execute(text(sentencia))
+
+    conexion.execute(text("ANALYZE"))
+
+
+@migracion(2, "Bloques con raíz de Merkle e índice de hoja de cada mensaje")
+def _bloques_merkle(conexion: Connection):
+    agregar_columna(conexion, "blockchain", "raiz_merkle", "VARCHAR")
+    agregar_columna(conexion, "blockchain", "num_transacciones", "INTEGER")
+    agregar_columna(conexion, "mensajes", "indice_hoja", "INTEGER")
+    agregar_columna(conexion, "mensajes_grupo", "indice_hoja", "INTEGER")
+
+
+@migracion(3, "Cadenas particionadas por conversación y por grupo")
+def _cadenas_particionadas(conexion: Connection):
+    # Los bloques existentes forman la cadena raíz
+    agregar_columna(conexion, "blockchain", "particion", "VARCHAR NOT NULL DEFAULT 'raiz'")
+    conexion.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_blockchain_particion_id ON blockchain (particion, id_bloque_pk)"
+    ))
+
+
+@migracion(4, "Dificultad de la prueba de trabajo de cada bloque")
+def _dificultad_bloques(conexion: Connection):
+    agregar_columna(conexion, "blockchain", "dificultad", "INTEGER")
+
+
+@migracion(5, "Cabecera binaria de los bloques")
+def _cabecera_bloques(conexion: Connection):
+    agregar_columna(conexion, "blockchain", "cabecera", "BLOB")
+
+
+
+@migracion(6, "Épocas de la llave de grupo y árbol de llaves por grupo")
+def _epocas_grupo(conexion: Connection):
+    agregar_columna(conexion, "grupos", "epoca_actual", "INTEGER NOT NULL DEFAULT 0")
+    agregar_columna(conexion, "grupos", "profundidad_arbol", "INTEGER")
+    agregar_columna(conexion, "miembros_de_grupos", "hoja", "INTEGER")
+    agregar_columna(conexion, "mensajes_grupo", "epoca", "INTEGER DEFAULT 0")
+    # La llave actual de los grupos existentes es su época 0 (sin árbol)
+    conexion.execute(text(
+        "INSERT INTO epocas_grupo (id_grupo_fk, epoca, llave_publica, profundidad, timestamp) "
+        "SELECT id_pk, 0, llave_publica, NULL, CURRENT_TIMESTAMP FROM grupos "
+        "WHERE id_pk NOT IN (SELECT id_grupo_fk FROM epocas_grupo)"
+    ))
+
+
+@migracion(7, "Sesiones de emisor en los mensajes de grupo")
+def _sesiones_grupo(conexion: Connection):
+    agregar_columna(conexion, "mensajes_grupo", "id_sesion_fk", "INTEGER REFERENCES sesiones_grupo (id_pk)")
+    agregar_columna(conexion, "mensajes_grupo", "contador", "INTEGER")
+
+
+@migracion(8, "Sesiones de las conversaciones individuales")
+def _sesiones_mensajes(conexion: Connection):
+    agregar_columna(conexion, "mensajes", "id_sesion_fk", "INTEGER REFERENCES sesiones_mensajes (id_pk)")
+    agregar_columna(conexion, "mensajes", "contador", "INTEGER")
+
+
+@migracion(9, "Ciphertext y nonce de los mensajes en columnas binarias")
+def _cifrados_binarios(conexion: Connection):
+    # Solo se agregan las columnas: las filas existentes las convierte por lotes ``conversor_cifrados``
+    # con la aplicación en marcha, sin bloquear la base durante toda la conversión
+    for tabla in ("mensajes", "mensajes_grupo"):
+        agregar_columna(conexion, tabla, "cifrado", "BLOB")
+        agregar_columna(conexion, tabla, "nonce_cifrado", "BLOB")
+
+
+if __name__ == "__main__":
+    from backend.database import db
+
+    with db.engine.connect() as conexion:
+        print(f"Esquema en la versión {version_actual(conexion)} (última: {MIGRACIONES[-1].version})")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, LargeBinary
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, LargeBinary, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
@@ -16,19 +16,34 @@ class User(Base):
     nombre = Column(String, nullable=False)
     hash = Column(String, nullable=True)
 
+    __table_args__ = (
+        # get_current_user busca por correo en cada petición autenticada
+        Index("ix_user_correo", "correo", unique=True),
+    )
+
 # Tabla Blockchain general (única)
 class Blockchain(Base):
     __tablename__ = 'blockchain'
 
     id_bloque_pk = Column(Integer, primary_key=True, autoincrement=True)
+    particion = Column(String, nullable=False, default="raiz")  # "raiz", "par:<id>:<id>" o "grupo:<id>"
     hash_anterior = Column(String, nullable=False)
     hash_actual = Column(String, nullable=False)
     nonce = Column(String, nullable=False)
+    dificultad = Column(Integer, nullable=True)  # Bits a cero exigidos al hash (prueba de trabajo); NULL en bloques antiguos
+    cabecera = Column(LargeBinary, nullable=True)  # Cabecera binaria de 86 bytes cuyo SHA-256 es hash_actual; NULL en bloques antiguos
     timestamp = Column(DateTime, nullable=False, default=datetime.utcnow())
+    raiz_merkle = Column(String, nullable=True)  # Raíz de Merkle (hex) de los mensajes del bloque
+    num_transacciones = Column(Integer, nullable=True)  # Hojas del árbol; NULL en bloques de un solo mensaje
 
     mensajes = relationship("Mensajes", back_populates="bloque", foreign_keys='Mensajes.id_bloque')
     mensajes_grupo = relationship("MensajesGrupo", back_populates="bloque", foreign_keys='MensajesGrupo.id_bloque_grupo')
 
+    __table_args__ = (
+        # Cabeza de cada partición y recorrido de una partición en orden
+        Index("ix_blockchain_particion_id", "particion", "id_bloque_pk"),
+    )
+
 
 # Tabla Mensajes (individuales)
 class Mensajes(Base):
@@ -38,25 +53,42 @@ class Mensajes(Base):
     id_bloque = Column(Integer, ForeignKey('blockchain.id_bloque_pk'))
     id_remitente = Column(Integer, ForeignKey('user.id_pk'))
     id_receptor = Column(Integer, ForeignKey('user.id_pk'))
-    mensaje = Column(String, nullable=False)
+    mensaje = Column(String, nullable=False)  # JSON {"ciphertext", "nonce"} en base64; vacío si está en ``cifrado``
+    cifrado = Column(LargeBinary, nullable=True)  # Ciphertext AES-GCM (con tag)
+    nonce_cifrado = Column(LargeBinary, nullable=True)  # Nonce AES-GCM
     firma = Column(String, nullable=False)
     clave_aes = Column(LargeBinary, nullable=True)
-    clave_aes_cifrada = Column(String, nullable=False)
+    clave_aes_cifrada = Column(String, nullable=False)  # JSON ECIES de la clave AES; vacía si va por sesión
     hash_mensaje = Column(String, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    indice_hoja = Column(Integer, nullable=True)  # Posición en el árbol de Merkle del bloque
+    id_sesion_fk = Column(Integer, ForeignKey('sesiones_mensajes.id_pk'), nullable=True)  # Sesión de la conversación
+    contador = Column(Integer, nullable=True)  # Posición del mensaje en la cadena de la sesión
 
     remitente = relationship("User", foreign_keys=[id_remitente])
     receptor = relationship("User", foreign_keys=[id_receptor])
     bloque = relationship("Blockchain", back_populates="mensajes")
 
+    __table_args__ = (
+        # Bandeja de entrada / salida ordenadas por fecha
+        Index("ix_mensajes_receptor_timestamp", "id_receptor", "timestamp"),
+        Index("ix_mensajes_remitente_timestamp", "id_remitente", "timestamp"),
+        # Conversación con un usuario concreto
+        Index("ix_mensajes_receptor_remitente_timestamp", "id_receptor", "id_remitente", "timestamp"),
+        Index("ix_mensajes_remitente_receptor_timestamp", "id_remitente", "id_receptor", "timestamp"),
+        Index("ix_mensajes_id_bloque", "id_bloque"),
+    )
+
 # Tabla Grupos
 class Grupos(Base):
     __tablename__ = 'grupos'
 
     id_pk = Column(Integer, primary_key=True, autoincrement=True)
     nombre_de_grupo = Column(String, nullable=False)
-    llave_publica = Column(String, nullable=False)
+    llave_publica = Column(String, nullable=False)  # Llave pública de la época actual
     tipo_cifrado = Column(String, nullable=False)
+    epoca_actual = Column(Integer, nullable=False, default=0)
+    profundidad_arbol = Column(Integer, nullable=True)  # Niveles del árbol de llaves (None: grupo sin árbol)
 
     miembros_grupo = relationship("MiembrosGrupos", back_populates="grupo")
 
@@ -69,10 +101,17 @@ class MiembrosGrupos(Base):
     id_user_fk = Column(Integer, ForeignKey('user.id_pk'))
 
     llave_privada_grupo_cifrada = Column(LargeBinary, nullable=True)  # NUEVO CAMPO
+    hoja = Column(Integer, nullable=True)  # Posición del miembro en el árbol de llaves del grupo
 
     grupo = relationship("Grupos", back_populates="miembros_grupo")
     usuario = relationship("User", backref="grupos_pertenecientes")
 
+    __table_args__ = (
+        # Un usuario solo puede pertenecer una vez a cada grupo
+        Index("ux_miembros_grupo_usuario", "id_grupo_fk", "id_user_fk", unique=True),
+        Index("ix_miembros_usuario", "id_user_fk"),
+    )
+
 # Tabla Mensajes Grupo
 class MensajesGrupo(Base):
     __tablename__ = 'mensajes_grupo'
@@ -82,13 +121,153 @@ class MensajesGrupo(Base):
     id_grupo_fk = Column(Integer, ForeignKey('grupos.id_pk'))
     id_remitente_fk = Column(Integer, ForeignKey('user.id_pk'))
 
-    mensaje = Column(String, nullable=False)  # Mensaje cifrado AES-GCM (base64)
-    nonce = Column(String, nullable=False)    # Nonce AES-GCM (base64)
-    clave_aes_cifrada = Column(String, nullable=False)  # AES key cifrada con clave pública grupo (base64 o JSON)
+    mensaje = Column(String, nullable=False)  # Mensaje cifrado AES-GCM (base64); vacío si está en ``cifrado``
+    nonce = Column(String, nullable=False)    # Nonce AES-GCM (base64); vacío si está en ``nonce_cifrado``
+    cifrado = Column(LargeBinary, nullable=True)  # Ciphertext AES-GCM (con tag)
+    nonce_cifrado = Column(LargeBinary, nullable=True)  # Nonce AES-GCM
+    clave_aes_cifrada = Column(String, nullable=False)  # AES key cifrada con clave pública grupo (base64 o JSON); vacía si va por sesión
     firma = Column(String, nullable=False)    # Firma ECDSA (hex)
     hash_mensaje = Column(String, nullable=False)  # Hash del mensaje plano (hex)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    indice_hoja = Column(Integer, nullable=True)  # Posición en el árbol de Merkle del bloque
+    epoca = Column(Integer, nullable=True, default=0)  # Época de la llave del grupo con la que se cifró
+    id_sesion_fk = Column(Integer, ForeignKey('sesiones_grupo.id_pk'), nullable=True)  # Sesión de emisor (None: clave AES propia)
+    contador = Column(Integer, nullable=True)  # Posición del mensaje en la cadena de la sesión
 
     remitente = relationship("User", foreign_keys=[id_remitente_fk])
     grupo = relationship("Grupos", foreign_keys=[id_grupo_fk])
     bloque = relationship("Blockchain", back_populates="mensajes_grupo")
+
+    __table_args__ = (
+        Index("ix_mensajes_grupo_grupo_timestamp", "id_grupo_fk", "timestamp"),
+        Index("ix_mensajes_grupo_id_bloque", "id_bloque_grupo"),
+    )
+
+
+# Tabla de puntos de control de la verificación de integridad
+class PuntosControlIntegridad(Base):
+    __tablename__ = 'puntos_control_integridad'
+
+    verificacion = Column(String, primary_key=True)  # "individual" o "individual:descifrar"
+    id_bloque = Column(Integer, nullable=False)  # Último bloque verificado sin errores
+    hash_bloque = Column(String, nullable=False)  # Hash de ese bloque en el momento de verificarlo
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+
+# Tabla de cabezas de partición comprometidas por cada bloque de anclaje de la cadena raíz
+class AnclajesParticion(Base):
+    __tablename__ = 'anclajes_particion'
+
+    id_pk = Column(Integer, primary_key=True, autoincrement=True)
+    id_bloque_ancla = Column(Integer, ForeignKey('blockchain.id_bloque_pk'), nullable=False)
+    particion = Column(String, nullable=False)
+    id_bloque_cabeza = Column(Integer, ForeignKey('blockchain.id_bloque_pk'), nullable=False)
+    indice_hoja = Column(Integer, nullable=False)  # Posición en el árbol de Merkle del bloque de anclaje
+
+    __table_args__ = (
+        Index("ix_anclajes_particion_ancla", "id_bloque_ancla"),
+    )
+
+
+# Tabla de épocas de la llave de cada grupo: cada cambio de miembros abre una nueva
+class EpocasGrupo(Base):
+    __tablename__ = 'epocas_grupo'
+
+    id_pk = Column(Integer, primary_key=True, autoincrement=True)
+    id_grupo_fk = Column(Integer, ForeignKey('grupos.id_pk'), nullable=False)
+    epoca = Column(Integer, nullable=False)
+    llave_publica = Column(String, nullable=False)  # Llave pública del grupo en esta época (raíz del árbol)
+    profundidad = Column(Integer, nullable=True)  # Niveles del árbol de llaves (None: llave única sin árbol)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ux_epocas_grupo_epoca", "id_grupo_fk", "epoca", unique=True),
+    )
+
+
+# Nodos internos del árbol de llaves de cada grupo. Cada versión de un nodo es una fila;
+# la versión vigente en una época es la de mayor ``epoca`` que no la supere
+class NodosGrupo(Base):
+    __tablename__ = 'nodos_grupo'
+
+    id_pk = Column(Integer, primary_key=True, autoincrement=True)
+    id_grupo_fk = Column(Integer, ForeignKey('grupos.id_pk'), nullable=False)
+    nivel = Column(Integer, nullable=False)  # 1 sobre las hojas; la raíz está en el nivel ``profundidad``
+    indice = Column(Integer, nullable=False)  # Posición dentro del nivel
+    epoca = Column(Integer, nullable=False)  # Época en la que se generó esta versión
+    llave_publica = Column(String, nullable=False)
+
+    llaves = relationship("LlavesNodoGrupo")
+
+    __table_args__ = (
+        Index("ix_nodos_grupo_posicion", "id_grupo_fk", "nivel", "indice", "epoca"),
+    )
+
+
+# Llave privada de cada versión de un nodo cifrada para cada uno de sus dos hijos
+class LlavesNodoGrupo(Base):
+    __tablename__ = 'llaves_nodo_grupo'
+
+    id_pk = Column(Integer, primary_key=True, autoincrement=True)
+    id_nodo_fk = Column(Integer, ForeignKey('nodos_grupo.id_pk'), nullable=False)
+    indice_hijo = Column(Integer, nullable=False)  # Posición del hijo en el nivel inferior (hoja si el nodo es de nivel 1)
+    llave_cifrada = Column(LargeBinary, nullable=False)  # nonce + AES-GCM con ECDH(nodo, hijo)
+
+    __table_args__ = (
+        Index("ux_llaves_nodo_grupo_hijo", "id_nodo_fk", "indice_hijo", unique=True),
+    )
+
+
+# Sesiones de emisor (sender keys): la semilla de la cadena simétrica de un remitente en una época
+# del grupo, cifrada una sola vez con la llave pública del grupo. Los mensajes de la sesión solo
+# guardan su posición en la cadena
+class SesionesGrupo(Base):
+    __tablename__ = 'sesiones_grupo'
+
+    id_pk = Column(Integer, primary_key=True, autoincrement=True)
+    id_grupo_fk = Column(Integer, ForeignKey('grupos.id_pk'), nullable=False)
+    id_remitente_fk = Column(Integer, ForeignKey('user.id_pk'), nullable=False)
+    epoca = Column(Integer, nullable=False)
+    clave_cadena_cifrada = Column(String, nullable=False)  # Semilla cifrada con ECIES (mismo JSON que clave_aes_cifrada)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_sesiones_grupo_grupo", "id_grupo_fk", "epoca"),
+    )
+
+
+# Sesiones de las conversaciones individuales: la semilla de la cadena simétrica de un remitente
+# hacia un receptor, cifrada una sola vez con la clave pública del receptor
+class SesionesMensajes(Base):
+    __tablename__ = 'sesiones_mensajes'
+
+    id_pk = Column(Integer, primary_key=True, autoincrement=True)
+    id_remitente_fk = Column(Integer, ForeignKey('user.id_pk'), nullable=False)
+    id_receptor_fk = Column(Integer, ForeignKey('user.id_pk'), nullable=False)
+    clave_cadena_cifrada = Column(String, nullable=False)  # Semilla cifrada con ECIES (mismo JSON que clave_aes_cifrada)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_sesiones_mensajes_remitente_receptor", "id_remitente_fk", "id_receptor_fk"),
+    )
+
+
+# Archivos subidos por los usuarios: el contenido se guarda cifrado por segmentos (STREAM) en
+# ``ARCHIVOS_DIRECTORIO`` y aquí solo quedan los metadatos, la firma y la clave AES cifrada
+class Archivos(Base):
+    __tablename__ = 'archivos'
+
+    id_pk = Column(Integer, primary_key=True, autoincrement=True)
+    id_propietario_fk = Column(Integer, ForeignKey('user.id_pk'), nullable=False)
+    nombre = Column(String, nullable=False)  # Nombre original del archivo
+    nombre_almacenado = Column(String, nullable=False)  # Nombre del archivo cifrado en el directorio de archivos
+    tamano = Column(Integer, nullable=False)  # Bytes de texto plano
+    algoritmo_hash = Column(String, nullable=False)
+    hash_archivo = Column(String, nullable=False)  # Hash hexadecimal del texto plano
+    firma = Column(String, nullable=False)  # Firma ECDSA (hex) del hash con la clave del propietario
+    clave_aes_cifrada = Column(String, nullable=False)  # Sobre ECIES en base64 con la clave pública del propietario
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_archivos_propietario", "id_propietario_fk"),
+    )
@@ -1,12 +1,42 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 load_dotenv()
-from backend.routes import auth_router, blockchain, messages_router, grupos_router, firmas_router
+from backend.routes import auth_router, blockchain, messages_router, grupos_router, firmas_router, metricas_router, archivos_router
+from backend.controllers.bloques import cabeza_cadena, cadenas, constructor_bloques
+from backend.controllers.minero import minero
+from backend.controllers.pool_claves import pool_claves_ecc
+from backend.controllers.conversion_cifrados import conversor_cifrados
+from backend.controllers.verificacion import pool_verificacion
+from backend.utils.ejecutor_cripto import ejecutor_cripto
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # La cabeza de la cadena raíz se carga una vez y después se mantiene en memoria;
+    # las de las particiones se cargan la primera vez que se usan
+    cabeza_cadena.recargar()
+    # Hilo que sella los mensajes pendientes en bloques de Merkle
+    constructor_bloques.iniciar()
+    # Hilo que mantiene pares de claves ECC listos para registros y grupos nuevos
+    pool_claves_ecc.iniciar()
+    # Hilo que pasa a las columnas binarias los cifrados guardados en base64 (termina al acabar)
+    conversor_cifrados.iniciar()
+    # Procesos de la verificación paralela de integridad
+    pool_verificacion.iniciar()
+    yield
+    pool_verificacion.detener()
+    conversor_cifrados.detener()
+    pool_claves_ecc.detener()
+    constructor_bloques.detener()
+    minero.cerrar()
+    ejecutor_cripto.cerrar()
 
 
 app = FastAPI(
     title="Cifrados: Proyecto 2 - Blockchain y Cifrado",
+    lifespan=lifespan,
 )
 
 origins = ["*"]
@@ -16,6 +46,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Hash-Archivo", "X-Algoritmo-Hash", "X-Firma-Archivo"],
 )
 
 app.include_router(auth_router, prefix="/auth", tags=["auth"])
@@ -27,6 +58,10 @@ app.include_router(firmas_router, prefix="/firmas", tags=["firmas"])
 
 app.include_router(blockchain.router, prefix="/blockchain", tags=["blockchain"])
 
+app.include_router(metricas_router, prefix="/metricas", tags=["metricas"])
+
+app.include_router(archivos_router, prefix="/archivos", tags=["archivos"])
+
 @app.post("/dev/clear-db")
 async def clear_db():
     """
@@ -35,6 +70,7 @@ async def clear_db():
     from backend.database import db
 
     db.clear()
+    cadenas.invalidar()
 
     return {"message": "Database cleared successfully."}
 
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Union
 
 class FirmaRequest(BaseModel):
     private_key: str
@@ -11,6 +11,9 @@ class VerificacionRequest(BaseModel):
     message: str
     signature: str
 
+class VerificacionLoteRequest(BaseModel):
+    firmas: List[VerificacionRequest]
+
 class MensajeSolo(BaseModel):
     message: str
 
@@ -46,6 +49,7 @@ class MiembroAgregarResponse(BaseModel):
     id_grupo_fk: int
     id_user_fk: int
     mensaje: str
+    epoca: Optional[int] = None  # Época de la llave del grupo abierta al agregar al miembro
 
 class MessageIndidualRequest(BaseModel):
     mensaje: str
@@ -66,9 +70,11 @@ class MessageReceived(BaseModel):
     message: str
     firma: str
     hash_mensaje: str
-    clave_aes_cifrada: str
+    clave_aes_cifrada: str  # Vacía si el mensaje va por una sesión
     timestamp: datetime
-    remitente: str
+    remitente: Optional[str] = None  # None si el usuario ya no existe y la fila no guarda su id
+    id_sesion: Optional[int] = None  # Sesión de la conversación (ver /msg/sesion/{id_sesion})
+    contador: Optional[int] = None  # Posición del mensaje en la cadena de la sesión
 
     class Config:
         orm_mode = True
@@ -119,25 +125,75 @@ class GroupMessageRequest(BaseModel):
 
 class MensajeGrupoResponse(BaseModel):
     id_transaccion: int
-    remitente: str
+    remitente: Optional[str] = None  # None si el remitente ya no existe y la fila no guarda su id
     mensaje: str
     nonce: str
-    clave_aes_cifrada: str
+    clave_aes_cifrada: str  # Vacía si el mensaje va por una sesión de emisor
     firma: str
     timestamp: str
+    epoca: int = 0  # Época de la llave del grupo con la que se cifró
+    id_sesion: Optional[int] = None  # Sesión de emisor (ver /grupos/sesion/{id_sesion})
+    contador: Optional[int] = None  # Posición del mensaje en la cadena de la sesión
 
 class DescifrarRequest(BaseModel):
     group_id: int
     user_private_key_pem: str  # La llave privada PEM del usuario
+    epoca: Optional[int] = None  # Época de la llave del grupo (por defecto la actual)
 
 class DescifrarResponse(BaseModel):
     llave_privada_grupo: str
+    epoca: Optional[int] = None
 
 class DecryptGroupMessageRequest(BaseModel):
     mensaje_cifrado: str
     nonce: str
-    clave_aes_cifrada: Dict[str, str]  # contiene 'aes_key_encrypted', 'nonce', 'ephemeral_public_key'
+    clave_aes_cifrada: Optional[Union[str, Dict[str, str]]] = None  # sobre binario en base64, o el JSON anterior con 'encrypted_key', 'nonce', 'ephemeral_public_key'
     private_key_grupo_pem: str
+    id_sesion: Optional[int] = None  # En lugar de clave_aes_cifrada, para mensajes de una sesión de emisor
+    contador: Optional[int] = None
+
+class MensajeGrupoCifrado(BaseModel):
+    mensaje_cifrado: str
+    nonce: str
+    clave_aes_cifrada: Optional[Union[str, Dict[str, str]]] = None
+    id_sesion: Optional[int] = None
+    contador: Optional[int] = None
+    epoca: int = 0  # Época de la llave del grupo con la que se cifró (con user_private_key_pem)
+
+class DecryptGroupMessagesBatchRequest(BaseModel):
+    group_id: int
+    private_key_grupo_pem: Optional[str] = None  # Llave del grupo en una época: descifra solo los mensajes de esa época
+    user_private_key_pem: Optional[str] = None  # O la llave del usuario: se usa la llave del grupo de la época de cada mensaje
+    ids_mensajes: Optional[List[int]] = None  # Mensajes guardados del grupo
+    mensajes: Optional[List[MensajeGrupoCifrado]] = None  # O los datos cifrados directamente
 
 class DecryptGroupMessageResponse(BaseModel):
     mensaje_plano: str
+
+class SesionGrupoResponse(BaseModel):
+    id_sesion: int
+    id_grupo: int
+    id_remitente: int
+    epoca: int
+    clave_cadena_cifrada: str  # Semilla de la cadena cifrada con la llave pública del grupo en la época
+
+
+class SesionMensajesResponse(BaseModel):
+    id_sesion: int
+    id_remitente: int
+    id_receptor: int
+    clave_cadena_cifrada: Union[str, Dict[str, str]]  # Semilla cifrada con la clave pública del receptor (sobre en base64)
+
+
+class ArchivoResponse(BaseModel):
+    id_archivo: int
+    nombre: str
+    tamano: int
+    algoritmo_hash: str
+    hash_archivo: str
+    firma: str  # Firma ECDSA (hex) del hash con la clave del propietario
+    timestamp: str
+
+
+class DescargarArchivoRequest(BaseModel):
+    clave_privada_pem: str
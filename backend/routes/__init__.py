@@ -3,6 +3,8 @@ from .mensajes import router as messages_router
 from .grupos import router as grupos_router
 from .firmas import router as firmas_router
 from .blockchain import router as blockchain_router
+from .metricas import router as metricas_router
+from .archivos import router as archivos_router
 
 __all__ = [
     "auth_router",
@@ -10,4 +12,6 @@ __all__ = [
     "grupos_router",
     "firmas_router",
     "blockchain_router",
+    "metricas_router",
+    "archivos_router",
 ]
\ No newline at end of file
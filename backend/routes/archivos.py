@@ -0,0 +1,97 @@
+from urllib.parse import quote
+
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from backend.controllers.archivos import guardar_archivo, obtener_archivo, abrir_archivo
+from backend.controllers.cache_claves import cargar_clave_publica, propietario_usuario
+from backend.database import get_db, User
+from backend.models.message import ArchivoResponse, DescargarArchivoRequest
+from backend.utils.auth import get_current_user
+
+router = APIRouter()
+
+
+def _cargar_clave_privada_de_usuario(clave_privada_pem: str, user: User) -> ec.EllipticCurvePrivateKey:
+    try:
+        private_key = serialization.load_pem_private_key(clave_privada_pem.encode(), password=None)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Clave privada inválida o malformateada")
+
+    public_key = cargar_clave_publica(user.public_key, propietario_usuario(user.id_pk))
+    if not isinstance(private_key, ec.EllipticCurvePrivateKey) or private_key.public_key().public_numbers() != public_key.public_numbers():
+        raise HTTPException(status_code=400, detail="La clave privada no corresponde al usuario")
+    return private_key
+
+
+def _archivo_a_respuesta(archivo) -> ArchivoResponse:
+    return ArchivoResponse(
+        id_archivo=archivo.id_pk,
+        nombre=archivo.nombre,
+        tamano=archivo.tamano,
+        algoritmo_hash=archivo.algoritmo_hash,
+        hash_archivo=archivo.hash_archivo,
+        firma=archivo.firma,
+        timestamp=archivo.timestamp.isoformat()
+    )
+
+
+@router.post("/subir", response_model=ArchivoResponse)
+def subir_archivo(
+    archivo: UploadFile = File(...),
+    clave_privada_pem: str = Form(...),
+    algoritmo_hash: str = Form("sha256"),
+    user: User = Depends(get_current_user)
+):
+    """
+    Sube un archivo: se cifra por segmentos con una clave AES nueva mientras se calcula su hash,
+    y el hash se firma con la clave privada del usuario. El archivo no se carga entero en memoria
+    (la subida multipart ya la vuelca a disco a partir de cierto tamaño).
+    """
+    private_key = _cargar_clave_privada_de_usuario(clave_privada_pem, user)
+    try:
+        guardado = guardar_archivo(archivo.file, archivo.filename or "archivo", user, private_key, algoritmo_hash)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _archivo_a_respuesta(guardado)
+
+
+@router.post("/{id_archivo}/descargar")
+def descargar_archivo(
+    id_archivo: int,
+    datos: DescargarArchivoRequest,
+    db: Session = Depends(get_db),
+    user: User = Depends(get_current_user)
+):
+    """
+    Descarga un archivo descifrándolo segmento a segmento. El hash y la firma van en las cabeceras
+    ``X-Hash-Archivo``, ``X-Algoritmo-Hash`` y ``X-Firma-Archivo``. Si un segmento no se puede
+    autenticar la descarga se corta.
+    """
+    archivo = obtener_archivo(db, id_archivo)
+    if archivo is None:
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    if archivo.id_propietario_fk != user.id_pk:
+        raise HTTPException(status_code=403, detail="No tienes acceso a este archivo")
+
+    private_key = _cargar_clave_privada_de_usuario(datos.clave_privada_pem, user)
+    try:
+        contenido = abrir_archivo(archivo, private_key)
+    except Exception:
+        raise HTTPException(status_code=400, detail="No se pudo descifrar la clave del archivo")
+
+    return StreamingResponse(
+        contenido,
+        media_type="application/octet-stream",
+        headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(archivo.nombre)}",
+            "Content-Length": str(archivo.tamano),
+            "X-Hash-Archivo": archivo.hash_archivo,
+            "X-Algoritmo-Hash": archivo.algoritmo_hash,
+            "X-Firma-Archivo": archivo.firma,
+        }
+    )
@@ -6,8 +6,11 @@ from google.auth.transport import requests
 from google.oauth2 import id_token
 from datetime import timedelta
 import jwt
-from backend.controllers.keys import generate_ecc_keys
-from backend.database import User, get_db
+from backend.controllers.pool_claves import pool_claves_ecc
+from backend.controllers.cache_claves import cache_claves_publicas, propietario_usuario
+from backend.utils.ejecutor_cripto import ejecutor_cripto
+from backend.controllers.auth import obtener_usuario_por_correo_async, registrar_usuario_async
+from backend.database import User, get_async_db
 from backend.models.responses import SuccessfulRegisterResponse
 from backend.models.user import LoginRequest, RegisterRequest
 from backend.utils.auth import (
@@ -20,7 +23,7 @@ from random import randint
 from backend.utils.email_config import send_verification_email
 from pydantic import BaseModel, EmailStr
 from fastapi import Body
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 router = APIRouter()
@@ -31,13 +34,13 @@ GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 verification_codes = {}  # clave: correo, valor: pin
 
 @router.post("/login")
-async def login(login_request: LoginRequest, db=Depends(get_db)):
+async def login(login_request: LoginRequest, db=Depends(get_async_db)):
     """
     Endpoint para iniciar sesión con usuario y contraseña.
     """
-    user = db.query(User).filter(User.correo == login_request.email).first()
+    user = await obtener_usuario_por_correo_async(db, login_request.email)
 
-    if not user or not user.contraseña or not verify_password(user.contraseña, login_request.password):
+    if not user or not user.contraseña or not await ejecutor_cripto.ejecutar(verify_password, user.contraseña, login_request.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     access_token = create_access_token(data={"sub": user.correo}, expires_delta=timedelta(minutes=15))
@@ -68,30 +71,27 @@ async def login(login_request: LoginRequest, db=Depends(get_db)):
     return response
 
 @router.post("/register")
-async def register(register_request: RegisterRequest, db=Depends(get_db)):
+async def register(register_request: RegisterRequest, db=Depends(get_async_db)):
     email = register_request.email
 
     if email in verification_codes:
         raise HTTPException(status_code=400, detail="Verifica tu PIN antes de registrarte.")
 
-    existing_user = db.query(User).filter(User.correo == email).first()
+    existing_user = await obtener_usuario_por_correo_async(db, email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    private, public = generate_ecc_keys()
+    private, public = await pool_claves_ecc.obtener_async()
+    contraseña_hash = await ejecutor_cripto.ejecutar(hash_password, register_request.password)
 
-    new_user = User(
+    await registrar_usuario_async(
+        db,
         correo=email,
-        contraseña=hash_password(register_request.password),
+        contraseña_hash=contraseña_hash,
         public_key=public,
         nombre=register_request.name,
-        hash=None,
     )
 
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-
     return {
         "message": "Usuario registrado correctamente",
         "private_key": private,
@@ -118,7 +118,7 @@ from urllib.parse import urlencode
 from fastapi.responses import RedirectResponse
 
 @router.get("/callback")
-async def auth_callback(code: str, request: Request, db=Depends(get_db)):
+async def auth_callback(code: str, request: Request, db=Depends(get_async_db)):
     try:
         token_request_uri = "https://oauth2.googleapis.com/token"
         data = {
@@ -143,29 +143,28 @@ async def auth_callback(code: str, request: Request, db=Depends(get_db)):
         email = id_info.get('email')
         name = id_info.get('name')
 
-        user = db.query(User).filter(User.correo == email).first()
+        user = await obtener_usuario_por_correo_async(db, email)
 
         private_key_to_send = None  # Inicializá como None por si no se genera
 
         if not user:
-            private, public = generate_ecc_keys()
-            user = User(
+            private, public = await pool_claves_ecc.obtener_async()
+            user = await registrar_usuario_async(
+                db,
                 correo=email,
+                contraseña_hash=None,
                 public_key=public,
-                hash=None,
-                contraseña=None,
                 nombre=name,
             )
-            db.add(user)
-            db.commit()
-            db.refresh(user)
             private_key_to_send = private  # Solo si se generó
         else:
             # Si querés permitir que los usuarios existentes que no tienen llave pública se les genere:
             if not user.public_key:
-                private, public = generate_ecc_keys()
+                private, public = await pool_claves_ecc.obtener_async()
                 user.public_key = public
-                db.commit()
+                await db.commit()
+                # La clave anterior del usuario ya no es válida
+                cache_claves_publicas.invalidar(propietario_usuario(user.id_pk))
                 private_key_to_send = private  # Asignar la nueva llave privada
 
         access_token = create_access_token(data={"sub": user.correo}, expires_delta=timedelta(minutes=15))
@@ -200,13 +199,15 @@ async def auth_callback(code: str, request: Request, db=Depends(get_db)):
 
         return redirect_response
 
+    except HTTPException:
+        raise
     except Exception as e:
         print("❌ Error en /callback:")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 @router.post("/refresh")
-async def refresh_token(refresh_token: str = Cookie(None), db = Depends(get_db)):
+async def refresh_token(refresh_token: str = Cookie(None), db = Depends(get_async_db)):
     print(f"Refresh token received: {refresh_token}")
     if not refresh_token:
         raise HTTPException(status_code=401, detail="Missing refresh token")
@@ -217,7 +218,7 @@ async def refresh_token(refresh_token: str = Cookie(None), db = Depends(get_db))
         if not email:
             raise HTTPException(status_code=401, detail="Invalid token")
 
-        user = db.query(User).filter(User.correo == email).first()
+        user = await obtener_usuario_por_correo_async(db, email)
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
 
@@ -254,8 +255,8 @@ class EmailRequest(BaseModel):
     email: EmailStr
 
 @router.post("/send-pin")
-async def send_pin(request: EmailRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.correo == request.email).first()
+async def send_pin(request: EmailRequest, db: AsyncSession = Depends(get_async_db)):
+    user = await obtener_usuario_por_correo_async(db, request.email)
     if user:
         raise HTTPException(status_code=400, detail="Este correo ya está registrado.")
 
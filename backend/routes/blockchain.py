@@ -1,213 +1,242 @@
-from fastapi import APIRouter, HTTPException, Depends
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, Request
+from typing import Literal
 import hashlib
-import os
+import re
 
 from sqlalchemy.orm import Session
 
-from backend.controllers.firma import calcular_hash_mensaje, decrypt_message_aes
+from backend.controllers.bloques import cabeza_cadena, particion_conversacion, particion_grupo
+from backend.controllers.merkle import hoja_mensaje, generar_prueba
+from backend.controllers.verificacion import verificar_incremental, verificar_cadena
+from backend.controllers.group import verificar_miembro_de_grupo
 from backend.utils.auth import get_current_user
-from backend.database import get_db, Blockchain, User, Mensajes, MensajesGrupo
+from backend.database import db as db_instance, get_db, Blockchain, User, Mensajes, MensajesGrupo
 from backend.models.transactions import ManualTransaction
+from backend.utils.streaming import acepta_ndjson, respuesta_ndjson, TAMANO_LOTE_STREAMING
 
 router = APIRouter()
 
 
+def _consulta_bloques(session: Session):
+    return session.query(
+        Blockchain.id_bloque_pk,
+        Blockchain.hash_anterior,
+        Blockchain.hash_actual,
+        Blockchain.nonce,
+        Blockchain.timestamp,
+    ).order_by(Blockchain.id_bloque_pk)
+
+
+def _bloque_a_dict(b) -> dict:
+    return {
+        "id": b.id_bloque_pk,
+        "hash_anterior": b.hash_anterior,
+        "hash_actual": b.hash_actual,
+        "nonce": b.nonce,
+        "timestamp": b.timestamp
+    }
+
+
+def _iterar_bloques():
+    with db_instance.read() as session:
+        for b in _consulta_bloques(session).yield_per(TAMANO_LOTE_STREAMING):
+            yield _bloque_a_dict(b)
+
+
 # Obtener historial de blockchain
 @router.get("/transactions")
 def obtener_historial_blockchain(
+        request: Request,
         user: User = Depends(get_current_user),
         db: Session = Depends(get_db)
 ):
-    bloques = db.query(Blockchain).order_by(Blockchain.id_bloque_pk).all()
-
-    return [
-        {
-            "id": b.id_bloque_pk,
-            "hash_anterior": b.hash_anterior,
-            "hash_actual": b.hash_actual,
-            "nonce": b.nonce,
-            "timestamp": b.timestamp
-        } for b in bloques
-    ]
+    if acepta_ndjson(request):
+        return respuesta_ndjson(_iterar_bloques())
+
+    return [_bloque_a_dict(b) for b in _consulta_bloques(db).all()]
 
 
 # Crear nueva transacción manualmente
 @router.post("/transactions")
-def crear_transaccion_manual(
-        data: ManualTransaction,
-        db: Session = Depends(get_db)
-):
-    # Obtener último hash
-    ultimo_bloque = db.query(Blockchain).order_by(Blockchain.id_bloque_pk.desc()).first()
-    hash_anterior = ultimo_bloque.hash_actual if ultimo_bloque else "0" * 64
-
-    # Preparar datos
-    nonce = os.urandom(8).hex()
-    timestamp = datetime.utcnow()
-
-    contenido = f"{hash_anterior}{data.hash_extra or data.data}{nonce}{timestamp.isoformat()}"
-    hash_actual = hashlib.sha256(contenido.encode()).hexdigest()
-
-    nuevo_bloque = Blockchain(
-        hash_anterior=str(hash_anterior),
-        hash_actual=hash_actual,
-        nonce=nonce,
-        timestamp=timestamp
-    )
-    db.add(nuevo_bloque)
-    db.commit()
+def crear_transaccion_manual(data: ManualTransaction):
+    # El contenido del bloque manual es el hash indicado o el hash de los datos
+    contenido = data.hash_extra or hashlib.sha256(data.data.encode()).hexdigest()
+    if not re.fullmatch(r"[0-9a-fA-F]{64}", contenido):
+        raise HTTPException(status_code=400, detail="hash_extra debe ser un hash SHA-256 en hexadecimal")
+
+    id_bloque, hash_bloque = cabeza_cadena.agregar_contenido(contenido)
 
     return {
         "message": "Bloque creado exitosamente",
-        "id": nuevo_bloque.id_bloque_pk,
-        "hash": hash_actual
+        "id": id_bloque,
+        "hash": hash_bloque
     }
 
 
 @router.get("/transactions/integridad")
 def verificar_integridad_blockchain(
+        full: bool = False,
+        descifrar: bool = False,
         user: User = Depends(get_current_user),
         db: Session = Depends(get_db)
 ):
-    mensajes = db.query(Mensajes).all()
-    errores = []
-
-    for i, mensaje in enumerate(mensajes):
-        hash = mensaje.hash_mensaje
-
-        blockchain = db.query(Blockchain).filter(Blockchain.id_bloque_pk == mensaje.id_bloque).first()
-
-        if not blockchain:
-            errores.append({
-                "id": mensaje.id,
-                "error": "Bloque asociado no encontrado"
-            })
-            continue
-
-        # Verificar el hash del mensaje generando el hash esperado
-        try:
-            mensaje_original = decrypt_message_aes(mensaje.mensaje, mensaje.clave_aes)
-
-            recalculated_hash = calcular_hash_mensaje(
-                str(mensaje_original),
-                algoritmo="sha256"
-            )
-
-            if recalculated_hash != hash:
-                errores.append({
-                    "id": mensaje.id,
-                    "error": "Hash del mensaje no coincide",
-                    "esperado": recalculated_hash,
-                    "actual": hash
-                })
-
-        except Exception as e:
-            errores.append({
-                "id": mensaje.id,
-                "error": f"Error al descifrar el mensaje: {str(e)}"
-            })
-            continue
-
-        if i == 0:
-            expected_hash_anterior = "0" * 64
-        else:
-            expected_hash_anterior = db.query(Blockchain).filter(Blockchain.id_bloque_pk == mensajes[i - 1].id_bloque).first().hash_actual
-
-        # Validar que el hash_anterior coincide
-        if blockchain.hash_anterior != expected_hash_anterior:
-            errores.append({
-                "id": mensaje.id,
-                "error": "Hash anterior no coincide con el hash del bloque anterior"
-            })
+    """
+    Verifica los bloques añadidos desde el último punto de control (``full=true`` verifica la cadena entera).
+    La verificación recalcula cabeceras y raíces de Merkle; ``descifrar=true`` además descifra los mensajes
+    individuales de esos bloques y comprueba que su texto coincide con el hash sellado.
+    """
+    resultado = verificar_incremental(db, "individual", completa=full, descifrar=descifrar)
+    errores = resultado["errores"]
 
     if errores:
         return {
             "integridad": False,
             "mensaje": "Existen errores en la cadena de bloques",
-            "detalles": errores
+            "detalles": errores,
+            "rangos": resultado["rangos"],
+            "bloques_por_segundo": resultado["bloques_por_segundo"]
         }
 
     return {
         "integridad": True,
-        "mensaje": "Todos los bloques son válidos y la cadena está íntegra"
+        "mensaje": "Todos los bloques son válidos y la cadena está íntegra",
+        "bloques": resultado["bloques"],
+        "desde_bloque": resultado["desde_id"],
+        "hasta_bloque": resultado["ultimo_id"],
+        "bloques_por_segundo": resultado["bloques_por_segundo"]
     }
 
 
 @router.get("/transactions/integridad-grupal")
 def verificar_integridad_blockchain_grupal(
+        full: bool = False,
         user: User = Depends(get_current_user),
         db: Session = Depends(get_db)
 ):
-    mensajes = db.query(MensajesGrupo).order_by(MensajesGrupo.id_transacciones_pk).all()
-    errores = []
-
-    for i, mensaje in enumerate(mensajes):
-        hash_esperado = mensaje.hash_mensaje
-
-        # Obtener bloque correspondiente
-        bloque = db.query(Blockchain).filter(Blockchain.id_bloque_pk == mensaje.id_bloque_grupo).first()
-
-        if not bloque:
-            errores.append({
-                "id": mensaje.id_transacciones_pk,
-                "error": "Bloque asociado no encontrado"
-            })
-            continue
-
-        # # Verificar hash del mensaje
-        # try:
-        #     recalculated_hash = calcular_hash_mensaje(
-        #         mensaje.mensaje,  # Cifrado, asumimos hash sobre texto cifrado (como estaba al enviarlo)
-        #         algoritmo="sha256"
-        #     )
-        #
-        #     if recalculated_hash != hash_esperado:
-        #         errores.append({
-        #             "id": mensaje.id_transacciones_pk,
-        #             "error": "Hash del mensaje no coincide",
-        #             "esperado": recalculated_hash,
-        #             "actual": hash_esperado
-        #         })
-        #
-        # except Exception as e:
-        #     errores.append({
-        #         "id": mensaje.id_transacciones_pk,
-        #         "error": f"Error al calcular hash del mensaje: {str(e)}"
-        #     })
-        #     continue
-
-        # Verificar el hash anterior
-        if i == 0:
-            expected_hash_anterior = "0" * 64
-        else:
-            bloque_anterior = db.query(Blockchain).filter(
-                Blockchain.id_bloque_pk == mensajes[i - 1].id_bloque_grupo
-            ).first()
-
-            if not bloque_anterior:
-                errores.append({
-                    "id": mensaje.id_transacciones_pk,
-                    "error": "Bloque anterior no encontrado"
-                })
-                continue
-
-            expected_hash_anterior = bloque_anterior.hash_actual
-
-        if bloque.hash_anterior != expected_hash_anterior:
-            errores.append({
-                "id": mensaje.id_transacciones_pk,
-                "error": "Hash anterior del bloque no coincide con el hash del bloque anterior"
-            })
+    """
+    Alias de ``/transactions/integridad``: verifica todas las particiones de la cadena, entre ellas las
+    ``grupo:<id>`` donde se sellan los mensajes de los grupos, con el mismo punto de control. Para
+    verificar solo un grupo está ``/transactions/integridad/grupo/{grupo_id}``.
+    """
+    resultado = verificar_incremental(db, "individual", completa=full)
+    errores = resultado["errores"]
 
     if errores:
         return {
             "integridad": False,
             "mensaje": "Existen errores en la cadena de bloques de mensajes grupales",
-            "detalles": errores
+            "detalles": errores,
+            "rangos": resultado["rangos"],
+            "bloques_por_segundo": resultado["bloques_por_segundo"]
+        }
+
+    return {
+        "integridad": True,
+        "mensaje": "Todos los bloques de mensajes grupales son válidos y la cadena está íntegra",
+        "bloques": resultado["bloques"],
+        "desde_bloque": resultado["desde_id"],
+        "hasta_bloque": resultado["ultimo_id"],
+        "bloques_por_segundo": resultado["bloques_por_segundo"]
+    }
+
+
+def _respuesta_integridad_particion(resultado: dict, particion: str) -> dict:
+    if resultado["errores"]:
+        return {
+            "integridad": False,
+            "mensaje": f"Existen errores en la cadena de la partición {particion}",
+            "particion": particion,
+            "detalles": resultado["errores"]
         }
 
     return {
         "integridad": True,
-        "mensaje": "Todos los bloques de mensajes grupales son válidos y la cadena está íntegra"
+        "mensaje": f"La cadena de la partición {particion} está íntegra",
+        "particion": particion,
+        "bloques": resultado["bloques"]
+    }
+
+
+@router.get("/transactions/integridad/conversacion/{correo}")
+def verificar_integridad_conversacion(
+        correo: str,
+        descifrar: bool = False,
+        user: User = Depends(get_current_user),
+        db: Session = Depends(get_db)
+):
+    """
+    Verifica solo la cadena de la conversación entre el usuario y ``correo`` (``descifrar=true`` también descifra sus mensajes).
+    """
+    otro = db.query(User.id_pk).filter(User.correo == correo).first()
+    if not otro:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+
+    particion = particion_conversacion(user.id_pk, otro.id_pk)
+    return _respuesta_integridad_particion(verificar_cadena(db, particion=particion, descifrar=descifrar), particion)
+
+
+@router.get("/transactions/integridad/grupo/{grupo_id}")
+def verificar_integridad_grupo(
+        grupo_id: int,
+        user: User = Depends(get_current_user),
+        db: Session = Depends(get_db)
+):
+    """
+    Verifica solo la cadena de los mensajes de un grupo del que el usuario es miembro.
+    """
+    verificar_miembro_de_grupo(db, grupo_id, user.id_pk)
+
+    particion = particion_grupo(grupo_id)
+    return _respuesta_integridad_particion(verificar_cadena(db, particion=particion), particion)
+
+
+@router.get("/proof/{message_id}")
+def obtener_prueba_inclusion(
+        message_id: int,
+        tipo: Literal["individual", "grupal"] = "individual",
+        user: User = Depends(get_current_user),
+        db: Session = Depends(get_db)
+):
+    """
+    Devuelve la prueba de inclusión de Merkle de un mensaje en su bloque.
+    """
+    if tipo == "individual":
+        mensaje = db.query(Mensajes).filter(Mensajes.id == message_id).first()
+        if not mensaje or user.id_pk not in (mensaje.id_remitente, mensaje.id_receptor):
+            raise HTTPException(status_code=404, detail="Mensaje no encontrado")
+        id_bloque, indice_hoja = mensaje.id_bloque, mensaje.indice_hoja
+    else:
+        mensaje = db.query(MensajesGrupo).filter(MensajesGrupo.id_transacciones_pk == message_id).first()
+        if not mensaje:
+            raise HTTPException(status_code=404, detail="Mensaje no encontrado")
+        verificar_miembro_de_grupo(db, mensaje.id_grupo_fk, user.id_pk)
+        id_bloque, indice_hoja = mensaje.id_bloque_grupo, mensaje.indice_hoja
+
+    if id_bloque is None:
+        raise HTTPException(status_code=409, detail="El mensaje todavía no ha sido sellado en un bloque")
+
+    bloque = db.query(Blockchain).filter(Blockchain.id_bloque_pk == id_bloque).first()
+    if indice_hoja is None or bloque.raiz_merkle is None:
+        raise HTTPException(status_code=409, detail="El mensaje pertenece a un bloque sin árbol de Merkle")
+
+    hojas = [
+        hoja_mensaje("individual", m.id, m.hash_mensaje)
+        for m in db.query(Mensajes.id, Mensajes.hash_mensaje)
+        .filter(Mensajes.id_bloque == id_bloque)
+        .order_by(Mensajes.indice_hoja)
+    ] + [
+        hoja_mensaje("grupal", m.id_transacciones_pk, m.hash_mensaje)
+        for m in db.query(MensajesGrupo.id_transacciones_pk, MensajesGrupo.hash_mensaje)
+        .filter(MensajesGrupo.id_bloque_grupo == id_bloque)
+        .order_by(MensajesGrupo.indice_hoja)
+    ]
+
+    return {
+        "id_bloque": id_bloque,
+        "particion": bloque.particion,
+        "hash_bloque": bloque.hash_actual,
+        "raiz_merkle": bloque.raiz_merkle,
+        "indice_hoja": indice_hoja,
+        "hoja": hojas[indice_hoja].hex(),
+        "prueba": generar_prueba(hojas, indice_hoja)
     }
@@ -1,7 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException
-from backend.models.message import FirmaRequest, VerificacionRequest, MensajeSolo
-from backend.controllers.firma import sign_message, verify_signature, generate_ecc_key_pair, generate_aes_key, calcular_hash_mensaje
+from backend.controllers.pool_claves import pool_claves_ecc
+from backend.models.message import FirmaRequest, VerificacionRequest, VerificacionLoteRequest, MensajeSolo
+from backend.controllers.firma import sign_message, verify_signature, verificar_firmas_lote, generate_aes_key, calcular_hash_mensaje
 import base64
+import os
+
+# Firmas máximas por petición a /verificar-lote
+MAX_FIRMAS_LOTE = int(os.getenv("FIRMAS_MAX_LOTE", "1000"))
 
 router = APIRouter()
 
@@ -15,16 +20,32 @@ def verificar(request: VerificacionRequest):
     is_valid = verify_signature(request.public_key, request.message, request.signature)
     return {"valida": is_valid}
 
+@router.post("/verificar-lote")
+def verificar_lote(request: VerificacionLoteRequest):
+    """
+    Verifica varias firmas en una sola petición, en paralelo sobre el pool criptográfico.
+    Devuelve un resultado por firma en el mismo orden en que se enviaron.
+    """
+    if len(request.firmas) > MAX_FIRMAS_LOTE:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_FIRMAS_LOTE} firmas por lote")
+
+    resultados = verificar_firmas_lote([(f.public_key, f.message, f.signature) for f in request.firmas])
+    return {
+        "resultados": resultados,
+        "validas": sum(1 for r in resultados if r["valida"]),
+        "total": len(resultados)
+    }
+
 @router.get("/generar-claves")
 def generar_todas_las_claves():
     aes_key = generate_aes_key()
-    ecc_keys = generate_ecc_key_pair()
+    private_key, public_key = pool_claves_ecc.obtener()
 
     return {
         "aes_key_base64": base64.b64encode(aes_key).decode(),
         "ecc": {
-            "private_key": ecc_keys["private_key"],
-            "public_key": ecc_keys["public_key"]
+            "private_key": private_key,
+            "public_key": public_key
         }
     }
 
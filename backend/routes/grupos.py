@@ -1,27 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException, Path
+from fastapi import APIRouter, Depends, HTTPException, Path, Request
 from typing import List, Annotated
 from datetime import datetime
-from base64 import b64decode
-import base64
 import os
 
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 from backend.models.user import UserBase
 from backend.utils.auth import get_current_user
-from backend.controllers.keys import cifrar_con_ecdh_aes
+from backend.controllers.cache_claves import propietario_grupo
+from backend.controllers.epocas import descifrar_llave_de_epoca, llaves_de_epoca_de_miembro
 from backend.models.message import GrupoCreateRequest, GrupoCreateResponse, MiembroAgregarRequest, MiembroAgregarResponse, GrupoListItem, GrupoDetalleResponse, MiembroDetalle, UserListItem, MiembroEliminarRequest, GroupMessageRequest, MensajeGrupoResponse,MiembroDetalleMono, DescifrarRequest, DescifrarResponse
-from backend.controllers.group import listar_grupos, crear_grupo, agregar_miembro_controller, obtener_detalles_grupo, listar_usuarios, eliminar_miembro_controller, encrypt_aes_key_with_public_key, obtener_mensajes_de_grupo
-from backend.database import get_db, User, MiembrosGrupos, MensajesGrupo, Grupos
-from backend.models.message import DecryptGroupMessageRequest, DecryptGroupMessageResponse
-from backend.controllers.messages import crear_bloque, calcular_hash_mensaje
+from backend.controllers.group import listar_grupos, crear_grupo, crear_grupo_con_miembros_async, agregar_miembro_controller, obtener_detalles_grupo, listar_usuarios, eliminar_miembro_controller, encrypt_aes_key_with_public_key, decrypt_group_message, obtener_mensajes_de_grupo, verificar_miembro_de_grupo, iterar_mensajes_de_grupo, iterar_mensajes_cifrados_por_id
+from backend.database import get_db, get_async_db, User, MiembrosGrupos, MensajesGrupo, Grupos
+from backend.models.message import DecryptGroupMessageRequest, DecryptGroupMessageResponse, DecryptGroupMessagesBatchRequest, SesionGrupoResponse
+from backend.controllers.sesiones_grupo import CLAVES_DE_EMISOR_GRUPO, siguiente_clave_de_emisor, obtener_sesion_grupo, claves_de_cadena_por_sesion, descifrar_mensaje_de_sesion
+from backend.controllers.messages import calcular_hash_mensaje
+from backend.controllers.firma import cifrar_mensaje_aes
+from backend.controllers.bloques import constructor_bloques
+from backend.utils.streaming import acepta_ndjson, respuesta_ndjson, TAMANO_LOTE_STREAMING
+from backend.utils.ejecutor_cripto import ejecutor_cripto
+
+# Mensajes máximos por petición a /descifrar_mensajes_grupo
+MAX_MENSAJES_LOTE_DESCIFRADO = int(os.getenv("GRUPOS_MAX_LOTE_DESCIFRADO", "5000"))
 
 
 router = APIRouter()
@@ -33,53 +39,24 @@ Ruta para crear un nuevo grupo. Incluir los ids de los miembros que se quieren a
 async def crear_grupo_endpoint(
     request: GrupoCreateRequest,
     user: UserBase = Depends(get_current_user),
-    session: Session = Depends(get_db)
+    session: AsyncSession = Depends(get_async_db)
 ):
+    # Incluir al creador
+    miembros_unicos = set(request.miembros_ids)
+    miembros_unicos.add(user.id_pk)
+
     try:
-        # Crear grupo y generar llaves
-        grupo, llave_privada = crear_grupo(
+        # Crear grupo, cifrar su llave privada para cada miembro e insertarlos en una sola transacción
+        grupo, llave_privada = await crear_grupo_con_miembros_async(
             session=session,
             nombre=request.nombre,
+            ids_miembros=miembros_unicos,
         )
 
-        # Incluir al creador
-        miembros_unicos = set(request.miembros_ids)
-        miembros_unicos.add(user.id_pk)
-
-        for miembro_id in miembros_unicos:
-            agregar_miembro_controller(
-                id_grupo=grupo.id_pk,
-                id_usuario=miembro_id
-            )
-
-            # Obtener clave pública del usuario
-            miembro = session.query(User).filter(User.id_pk == miembro_id).first()
-            if not miembro or not miembro.public_key:
-                raise HTTPException(status_code=400, detail=f"Usuario {miembro_id} no tiene clave pública válida")
-
-            # Cifrar llave privada del grupo con clave pública del usuario
-            try:
-                llave_privada_cifrada = cifrar_con_ecdh_aes(
-                    priv_key_grupo_pem=llave_privada,
-                    pub_key_usuario_pem=miembro.public_key,
-                    datos_a_cifrar=llave_privada.encode()
-                )
-
-                # Actualizar campo en MiembrosGrupos
-                miembro_grupo = session.query(MiembrosGrupos).filter_by(
-                    id_grupo_fk=grupo.id_pk,
-                    id_user_fk=miembro_id
-                ).first()
-
-                miembro_grupo.llave_privada_grupo_cifrada = llave_privada_cifrada
-                session.commit()
-
-            except Exception as e:
-                session.rollback()
-                raise HTTPException(status_code=500, detail=f"Error cifrando llave para usuario {miembro_id}: {str(e)}")
-
+    except HTTPException:
+        raise
     except IntegrityError:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=400, detail="Error: Ya existe un grupo con este nombre.")
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
@@ -97,7 +74,7 @@ async def crear_grupo_endpoint(
 
 
 @router.post("/miembros", response_model=MiembroAgregarResponse, status_code=201)
-async def agregar_miembro(request: MiembroAgregarRequest, user: UserBase = Depends(get_current_user)):
+def agregar_miembro(request: MiembroAgregarRequest, user: UserBase = Depends(get_current_user)):
     try:
         miembro_data = agregar_miembro_controller(
             id_grupo=request.id_grupo,
@@ -114,7 +91,8 @@ async def agregar_miembro(request: MiembroAgregarRequest, user: UserBase = Depen
         id_pk=miembro_data["id_pk"],
         id_grupo_fk=miembro_data["id_grupo_fk"],
         id_user_fk=miembro_data["id_user_fk"],
-        mensaje="Miembro agregado exitosamente al grupo."
+        mensaje="Miembro agregado exitosamente al grupo.",
+        epoca=miembro_data["epoca"]
     )
 
 
@@ -210,12 +188,12 @@ def obtener_usuarios(
 
 
 @router.delete("/miembros", status_code=200)
-async def eliminar_miembro(
+def eliminar_miembro(
     request: MiembroEliminarRequest,
     user: UserBase = Depends(get_current_user)
 ):
     try:
-        eliminar_miembro_controller(
+        epoca = eliminar_miembro_controller(
             id_grupo=request.id_grupo,
             id_usuario=request.id_usuario
         )
@@ -224,22 +202,13 @@ async def eliminar_miembro(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error eliminando miembro: {e}")
 
-    return {"mensaje": "Miembro eliminado del grupo exitosamente."}
+    return {"mensaje": "Miembro eliminado del grupo exitosamente.", "epoca": epoca}
 
 
 def sign_message(private_key: ec.EllipticCurvePrivateKey, message: str) -> str:
     signature = private_key.sign(message.encode(), ec.ECDSA(hashes.SHA256()))
     return signature.hex()
 
-def encrypt_message_aes(message: str, aes_key: bytes) -> dict:
-    aesgcm = AESGCM(aes_key)
-    nonce = os.urandom(12)
-    ciphertext = aesgcm.encrypt(nonce, message.encode(), None)
-    return {
-        "ciphertext": base64.b64encode(ciphertext).decode(),
-        "nonce": base64.b64encode(nonce).decode()
-    }
-
 @router.post("/group/message/{grupo_id}")
 def enviar_mensaje_grupo(
     grupo_id: int,
@@ -275,44 +244,63 @@ def enviar_mensaje_grupo(
     # 4. Firmar mensaje plano
     firma = sign_message(private_key, datos.mensaje)
 
-    # 5. Generar clave AES y cifrar mensaje
-    clave_aes = os.urandom(32)
-    cifrado = encrypt_message_aes(datos.mensaje, clave_aes)
-    mensaje_cifrado = cifrado["ciphertext"]
-    nonce_mensaje = cifrado["nonce"]
+    # 5. Obtener la clave AES: de la cadena de la sesión de emisor del usuario en la época actual,
+    #    o una clave nueva cifrada con la clave pública del grupo (ECIES) en cada mensaje
+    id_sesion = contador = None
+    if CLAVES_DE_EMISOR_GRUPO:
+        id_sesion, contador, clave_aes = siguiente_clave_de_emisor(grupo, user.id_pk)
+        clave_aes_cifrada_json = ""
+    else:
+        clave_aes = os.urandom(32)
+        clave_aes_cifrada_json = encrypt_aes_key_with_public_key(clave_aes, grupo.llave_publica, propietario_grupo(grupo.id_pk))
 
-    # 6. Cifrar clave AES con clave pública del grupo (ECIES)
-    clave_aes_cifrada_json = encrypt_aes_key_with_public_key(clave_aes, grupo.llave_publica)
+    # 6. Cifrar mensaje (ciphertext y nonce se guardan en binario)
+    mensaje_cifrado, nonce_mensaje = cifrar_mensaje_aes(datos.mensaje, clave_aes)
 
     # 7. Calcular hash del mensaje plano
     hash_mensaje = calcular_hash_mensaje(datos.mensaje, "sha256")
 
-    # 8. Crear bloque en la blockchain
-    id_bloque = crear_bloque(hash_mensaje, session)
-
-    # 9. Guardar mensaje en DB incluyendo el bloque
+    # 8. Guardar mensaje en DB; el constructor de bloques lo sellará en el próximo bloque
     nuevo_mensaje = MensajesGrupo(
         id_grupo_fk=grupo_id,
         id_remitente_fk=user.id_pk,
-        mensaje=mensaje_cifrado,
-        nonce=nonce_mensaje,
+        mensaje="",
+        nonce="",
+        cifrado=mensaje_cifrado,
+        nonce_cifrado=nonce_mensaje,
         clave_aes_cifrada=clave_aes_cifrada_json,
         firma=firma,
         hash_mensaje=hash_mensaje,
         timestamp=datetime.utcnow(),
-        id_bloque_grupo=id_bloque  # Asocia el mensaje al nuevo bloque
+        epoca=grupo.epoca_actual,
+        id_sesion_fk=id_sesion,
+        contador=contador,
     )
     session.add(nuevo_mensaje)
     session.commit()
 
-    return {"msg": "Mensaje grupal enviado correctamente", "id_bloque": id_bloque}
+    constructor_bloques.notificar()
+
+    return {
+        "msg": "Mensaje grupal enviado correctamente",
+        "id_transaccion": nuevo_mensaje.id_transacciones_pk,
+        "id_bloque": None,  # Pendiente; consultar /blockchain/proof/{id}?tipo=grupal
+        "epoca": grupo.epoca_actual,
+        "id_sesion": id_sesion,
+        "contador": contador
+    }
 
 @router.get("/GroupMessages/{grupo_id}", response_model=List[MensajeGrupoResponse])
 def obtener_mensajes_grupo(
     grupo_id: int,
+    request: Request,
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
+    if acepta_ndjson(request):
+        verificar_miembro_de_grupo(db, grupo_id, user.id_pk)
+        return respuesta_ndjson(iterar_mensajes_de_grupo(grupo_id, TAMANO_LOTE_STREAMING))
+
     return obtener_mensajes_de_grupo(grupo_id, user.id_pk, db)
 
 @router.get("/public_key/{grupo_id}")
@@ -335,7 +323,7 @@ def obtener_clave_publica_grupo(
     if not grupo or not grupo.llave_publica:
         raise HTTPException(status_code=404, detail="Grupo no encontrado o no tiene clave pública.")
 
-    return {"public_key": grupo.llave_publica}
+    return {"public_key": grupo.llave_publica, "epoca": grupo.epoca_actual}
 
 
 @router.post("/descifrar_llave_privada", response_model=DescifrarResponse)
@@ -353,9 +341,11 @@ def descifrar_llave_privada_grupo(
     if not miembro:
         raise HTTPException(status_code=403, detail="No tienes acceso a este grupo.")
 
-    if not miembro.llave_privada_grupo_cifrada or not miembro.grupo.llave_publica:
+    if not miembro.grupo.llave_publica:
         raise HTTPException(status_code=404, detail="Datos de llave no encontrados.")
 
+    epoca = request.epoca if request.epoca is not None else miembro.grupo.epoca_actual
+
     try:
         # 2. Cargar llave privada usuario (PEM)
         user_priv_key = serialization.load_pem_private_key(
@@ -363,47 +353,52 @@ def descifrar_llave_privada_grupo(
             password=None
         )
 
-        # 3. Cargar llave pública del grupo (PEM)
-        grupo_pub_key = serialization.load_pem_public_key(
-            miembro.grupo.llave_publica.encode('utf-8')
-        )
-
-        # 4. Preparar datos cifrados: puede ser bytes o base64 string
-        encrypted_data = miembro.llave_privada_grupo_cifrada
-
-        # Si es str, asumir base64 y decodificar
-        if isinstance(encrypted_data, str):
-            encrypted_data = b64decode(encrypted_data)
-
-        # Extraer nonce (12 bytes) y ciphertext
-        nonce = encrypted_data[:12]
-        ciphertext = encrypted_data[12:]
-
-        # 5. Derivar clave simétrica con ECDH + HKDF
-        shared_key = user_priv_key.exchange(ec.ECDH(), grupo_pub_key)
-        derived_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=b'grupo-key-ecdh'
-        ).derive(shared_key)
-
-        # 6. Descifrar con AES-GCM
-        aesgcm = AESGCM(derived_key)
-        decrypted = aesgcm.decrypt(nonce, ciphertext, None)
-
-        llave_privada_grupo = decrypted.decode('utf-8')
+        # 3. Subir por el árbol de llaves del grupo hasta la llave de la época
+        llave_privada_grupo = descifrar_llave_de_epoca(session, miembro, user_priv_key, epoca)
 
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error descifrando llave: {e}")
 
-    return DescifrarResponse(llave_privada_grupo=llave_privada_grupo)
+    return DescifrarResponse(llave_privada_grupo=llave_privada_grupo, epoca=epoca)
+
+@router.get("/sesion/{id_sesion}", response_model=SesionGrupoResponse)
+def obtener_sesion_de_emisor(
+    id_sesion: int,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_db)
+):
+    """Semilla cifrada de una sesión de emisor, para derivar en el cliente las claves de sus mensajes."""
+    sesion = obtener_sesion_grupo(session, id_sesion)
+    if not sesion:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada.")
+    verificar_miembro_de_grupo(session, sesion.id_grupo_fk, user.id_pk)
+
+    return SesionGrupoResponse(
+        id_sesion=sesion.id_pk,
+        id_grupo=sesion.id_grupo_fk,
+        id_remitente=sesion.id_remitente_fk,
+        epoca=sesion.epoca,
+        clave_cadena_cifrada=sesion.clave_cadena_cifrada
+    )
 
 @router.post("/descifrar_mensaje_grupo", response_model=DecryptGroupMessageResponse)
 def descifrar_mensaje_grupo(
     request: DecryptGroupMessageRequest,
-    user: User = Depends(get_current_user)
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_db)
 ):
+    if (request.clave_aes_cifrada is None) == (request.id_sesion is None):
+        raise HTTPException(status_code=400, detail="Envía clave_aes_cifrada o id_sesion y contador (solo uno de los dos)")
+
+    sesion = None
+    if request.id_sesion is not None:
+        if request.contador is None:
+            raise HTTPException(status_code=400, detail="Falta el contador del mensaje en la sesión")
+        sesion = obtener_sesion_grupo(session, request.id_sesion)
+        if not sesion:
+            raise HTTPException(status_code=404, detail="Sesión no encontrada.")
+        verificar_miembro_de_grupo(session, sesion.id_grupo_fk, user.id_pk)
+
     try:
         # 1. Cargar clave privada del grupo
         grupo_priv_key = serialization.load_pem_private_key(
@@ -411,36 +406,93 @@ def descifrar_mensaje_grupo(
             password=None
         )
 
-        # 2. Extraer datos cifrados
-        ciphertext = base64.b64decode(request.mensaje_cifrado)
-        nonce = base64.b64decode(request.nonce)
-        encrypted_key_info = request.clave_aes_cifrada
-
-        # 3. Derivar clave compartida (ECIES)
-        ephemeral_pub_key = serialization.load_pem_public_key(
-            encrypted_key_info['ephemeral_public_key'].encode('utf-8')
-        )
-
-        shared_key = grupo_priv_key.exchange(ec.ECDH(), ephemeral_pub_key)
-        derived_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=b"ecies"
-        ).derive(shared_key)
+        # 2. Descifrar la clave AES (ECIES, o semilla de la sesión y cadena) y el mensaje
+        if sesion is not None:
+            mensaje_plano = descifrar_mensaje_de_sesion(
+                grupo_priv_key,
+                request.mensaje_cifrado,
+                request.nonce,
+                sesion.clave_cadena_cifrada,
+                request.contador
+            )
+        else:
+            mensaje_plano = decrypt_group_message(
+                grupo_priv_key,
+                request.mensaje_cifrado,
+                request.nonce,
+                request.clave_aes_cifrada
+            )
 
-        # 4. Descifrar clave AES
-        encrypted_aes_key = base64.b64decode(encrypted_key_info['encrypted_key'])
-        nonce_key = base64.b64decode(encrypted_key_info['nonce'])
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error descifrando mensaje: {e}")
 
-        aesgcm_key = AESGCM(derived_key)
-        aes_key = aesgcm_key.decrypt(nonce_key, encrypted_aes_key, None)
+    return DecryptGroupMessageResponse(mensaje_plano=mensaje_plano)
 
-        # 5. Descifrar mensaje
-        aesgcm_msg = AESGCM(aes_key)
-        mensaje_plano = aesgcm_msg.decrypt(nonce, ciphertext, None).decode('utf-8')
+@router.post("/descifrar_mensajes_grupo")
+def descifrar_mensajes_grupo(
+    request: DecryptGroupMessagesBatchRequest,
+    user: User = Depends(get_current_user),
+    session: Session = Depends(get_db)
+):
+    """
+    Descifra muchos mensajes del grupo en una sola petición: la clave privada del grupo se carga
+    una vez y los mensajes se descifran en el pool criptográfico. Recibe ``ids_mensajes`` (mensajes
+    guardados del grupo) o ``mensajes`` (datos cifrados) y devuelve NDJSON, una línea por mensaje
+    en el orden en que se terminan de descifrar: ``{"id" | "indice", "mensaje_plano"}`` o ``{"id" | "indice", "error"}``.
+    Con ``user_private_key_pem`` cada mensaje se descifra con la llave del grupo de su época (un
+    historial que cruza altas y bajas de miembros); con ``private_key_grupo_pem``, con esa llave.
+    La semilla de cada sesión de emisor y la llave de cada época se descifran una sola vez por lote.
+    """
+    if (request.ids_mensajes is None) == (request.mensajes is None):
+        raise HTTPException(status_code=400, detail="Envía ids_mensajes o mensajes (solo uno de los dos)")
+    if (request.private_key_grupo_pem is None) == (request.user_private_key_pem is None):
+        raise HTTPException(status_code=400, detail="Envía private_key_grupo_pem o user_private_key_pem (solo uno de los dos)")
+
+    total = len(request.ids_mensajes if request.ids_mensajes is not None else request.mensajes)
+    if total > MAX_MENSAJES_LOTE_DESCIFRADO:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_MENSAJES_LOTE_DESCIFRADO} mensajes por lote")
+
+    verificar_miembro_de_grupo(session, request.group_id, user.id_pk)
 
+    try:
+        if request.user_private_key_pem is not None:
+            user_priv_key = serialization.load_pem_private_key(request.user_private_key_pem.encode('utf-8'), password=None)
+            llave_de_epoca = llaves_de_epoca_de_miembro(request.group_id, user.id_pk, user_priv_key)
+        else:
+            grupo_priv_key = serialization.load_pem_private_key(request.private_key_grupo_pem.encode('utf-8'), password=None)
+            llave_de_epoca = lambda epoca: grupo_priv_key
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error descifrando mensaje: {e}")
+        raise HTTPException(status_code=400, detail=f"Llave privada inválida: {e}")
+
+    if request.ids_mensajes is not None:
+        campo = "id"
+        entradas = iterar_mensajes_cifrados_por_id(request.group_id, request.ids_mensajes, TAMANO_LOTE_STREAMING)
+    else:
+        campo = "indice"
+        cadenas = claves_de_cadena_por_sesion(
+            session, request.group_id, {m.id_sesion for m in request.mensajes if m.id_sesion is not None}
+        )
+        entradas = (
+            (indice, m.mensaje_cifrado, m.nonce, m.clave_aes_cifrada, cadenas.get(m.id_sesion), m.contador if m.id_sesion is not None else None, m.epoca)
+            for indice, m in enumerate(request.mensajes)
+        )
 
-    return DecryptGroupMessageResponse(mensaje_plano=mensaje_plano)
+    semillas = {}
+
+    def descifrar(entrada):
+        identificador, mensaje_cifrado, nonce, clave_aes_cifrada, clave_cadena_cifrada, contador, epoca = entrada
+        if mensaje_cifrado is None:
+            return {campo: identificador, "error": "Mensaje no encontrado en el grupo"}
+        try:
+            grupo_priv_key = llave_de_epoca(epoca)
+            if clave_cadena_cifrada is not None and contador is not None:
+                mensaje_plano = descifrar_mensaje_de_sesion(grupo_priv_key, mensaje_cifrado, nonce, clave_cadena_cifrada, contador, semillas)
+            elif clave_aes_cifrada:
+                mensaje_plano = decrypt_group_message(grupo_priv_key, mensaje_cifrado, nonce, clave_aes_cifrada)
+            else:
+                return {campo: identificador, "error": "Sesión no encontrada en el grupo o falta la clave del mensaje"}
+            return {campo: identificador, "mensaje_plano": mensaje_plano}
+        except Exception as e:
+            return {campo: identificador, "error": f"Error descifrando mensaje: {str(e) or type(e).__name__}"}
+
+    return respuesta_ndjson(ejecutor_cripto.mapear_a_medida(descifrar, entradas))
@@ -1,37 +1,84 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from backend.database import db, User, Mensajes, get_db
 from backend.controllers.messages import guardar_mensaje_individual
 from backend.utils.auth import get_current_user
-from backend.controllers.firma import calcular_hash_mensaje, decrypt_message_aes
-from backend.models.message import MessageIndividualResponse, MessageReceived, MessageIndividualRequestSimplified
-from sqlalchemy.orm import Session
+from backend.controllers.firma import calcular_hash_mensaje, descifrar_mensaje_aes, partes_mensaje_cifrado, mensaje_cifrado_a_texto
+from backend.models.message import MessageIndividualResponse, MessageReceived, MessageIndividualRequestSimplified, SesionMensajesResponse
+from backend.controllers.sesiones_mensajes import obtener_sesion_mensajes
+from backend.controllers.sobre import sobre_para_respuesta
+from backend.utils.paginacion import paginar_desc, LIMITE_POR_DEFECTO, LIMITE_MAXIMO
+from backend.utils.streaming import acepta_ndjson, respuesta_ndjson, TAMANO_LOTE_STREAMING
+from sqlalchemy.orm import Session, aliased
 from types import SimpleNamespace as Namespace
 from typing import List
 import json, os
 
 router = APIRouter()
 
+# Columnas que necesitan los listados; se proyectan en lugar de cargar entidades completas.
+# El cifrado se guarda en binario y se pasa a base64 solo al responder (mensaje_cifrado_a_texto)
+COLUMNAS_MENSAJE = (
+    Mensajes.id,
+    Mensajes.mensaje,
+    Mensajes.cifrado,
+    Mensajes.nonce_cifrado,
+    Mensajes.firma,
+    Mensajes.hash_mensaje,
+    Mensajes.clave_aes_cifrada,
+    Mensajes.timestamp,
+    Mensajes.id_sesion_fk,
+    Mensajes.contador,
+)
+
+def _consulta_todos_los_mensajes(session: Session):
+    remitente = aliased(User)
+    receptor = aliased(User)
+
+    return (
+        session.query(
+            *COLUMNAS_MENSAJE,
+            Mensajes.id_remitente,
+            Mensajes.id_receptor,
+            Mensajes.id_bloque,
+            remitente.correo.label("correo_remitente"),
+            receptor.correo.label("correo_receptor"),
+        )
+        .outerjoin(remitente, remitente.id_pk == Mensajes.id_remitente)
+        .outerjoin(receptor, receptor.id_pk == Mensajes.id_receptor)
+    )
+
+
+def _mensaje_a_dict(m) -> dict:
+    return {
+        "id": m.id,
+        "remitente": m.correo_remitente or m.id_remitente,
+        "receptor": m.correo_receptor or m.id_receptor,
+        "mensaje_cifrado": mensaje_cifrado_a_texto(m.mensaje, m.cifrado, m.nonce_cifrado),
+        "firma": m.firma,
+        "hash_mensaje": m.hash_mensaje,
+        "clave_aes_cifrada": sobre_para_respuesta(m.clave_aes_cifrada),
+        "timestamp": m.timestamp.isoformat(),
+        "id_bloque": m.id_bloque,
+        "id_sesion": m.id_sesion_fk,
+        "contador": m.contador
+    }
+
+
+def _iterar_todos_los_mensajes():
+    # La sesión vive dentro del generador para que siga abierta mientras se envía la respuesta
+    with db.read() as session:
+        for m in _consulta_todos_los_mensajes(session).yield_per(TAMANO_LOTE_STREAMING):
+            yield _mensaje_a_dict(m)
+
+
 # Route to get all messages
 @router.get("/all_mensajes")
-def get_all_messages():
+def get_all_messages(request: Request):
+    if acepta_ndjson(request):
+        return respuesta_ndjson(_iterar_todos_los_mensajes())
+
     with db.read() as session:
-        mensajes = session.query(Mensajes).all()
-        resultado = []
-
-        for m in mensajes:
-            resultado.append({
-                "id": m.id,
-                "remitente": m.remitente.correo if m.remitente else m.id_remitente,
-                "receptor": m.receptor.correo if m.receptor else m.id_receptor,
-                "mensaje_cifrado": m.mensaje,
-                "firma": m.firma,
-                "hash_mensaje": m.hash_mensaje,
-                "clave_aes_cifrada": json.loads(m.clave_aes_cifrada),
-                "timestamp": m.timestamp.isoformat(),
-                "id_bloque": m.id_bloque
-            })
-
-        return resultado
+        return [_mensaje_a_dict(m) for m in _consulta_todos_los_mensajes(session).all()]
 
 # Route to send individual messages
 @router.post("/message/{user_destino}")
@@ -75,15 +122,20 @@ def send_individual_message(
 # Route to get individual messages
 @router.get("/message/received", response_model=List[MessageReceived])
 def get_received_messages(
+    response: Response,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: str | None = None,
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user)
 ):
-    messages = (
-        db.query(Mensajes)
-        .filter(Mensajes.id_receptor == user.id_pk)
-        .order_by(Mensajes.timestamp.desc())
-        .all()
+    messages, next_cursor = paginar_desc(
+        db.query(*COLUMNAS_MENSAJE, Mensajes.id_remitente, User.correo.label("remitente"))
+        .outerjoin(User, User.id_pk == Mensajes.id_remitente)
+        .filter(Mensajes.id_receptor == user.id_pk),
+        Mensajes.timestamp, Mensajes.id, limit, cursor
     )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
     message_responses = []
 
@@ -91,12 +143,14 @@ def get_received_messages(
         message_responses.append(
             MessageReceived(
                 id=msg.id,
-                message=msg.mensaje,
+                message=mensaje_cifrado_a_texto(msg.mensaje, msg.cifrado, msg.nonce_cifrado),
                 firma=msg.firma,
                 hash_mensaje=msg.hash_mensaje,
                 clave_aes_cifrada=msg.clave_aes_cifrada,
                 timestamp=msg.timestamp,
-                remitente=msg.remitente.correo
+                id_sesion=msg.id_sesion_fk,
+                contador=msg.contador,
+                remitente=msg.remitente or (str(msg.id_remitente) if msg.id_remitente is not None else None)
             )
         )
 
@@ -106,6 +160,9 @@ def get_received_messages(
 @router.get("/message/received/{user_remitente}", response_model=List[MessageReceived])
 def get_received_messages_from_user(
     user_remitente: str,
+    response: Response,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: str | None = None,
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user)
 ):
@@ -113,24 +170,26 @@ def get_received_messages_from_user(
     if remitente is None:
         raise HTTPException(status_code=404, detail="Usuario remitente no encontrado")
 
-    messages = (
-        db.query(Mensajes)
-        .filter(Mensajes.id_receptor == user.id_pk, Mensajes.id_remitente == remitente.id_pk)
-        .order_by(Mensajes.timestamp.desc())
-        .all()
+    messages, next_cursor = paginar_desc(
+        db.query(*COLUMNAS_MENSAJE).filter(Mensajes.id_receptor == user.id_pk, Mensajes.id_remitente == remitente.id_pk),
+        Mensajes.timestamp, Mensajes.id, limit, cursor
     )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
     message_responses = []
     for msg in messages:
         message_responses.append(
             MessageReceived(
                 id=msg.id,
-                message=msg.mensaje,
+                message=mensaje_cifrado_a_texto(msg.mensaje, msg.cifrado, msg.nonce_cifrado),
                 firma=msg.firma,
                 hash_mensaje=msg.hash_mensaje,
                 clave_aes_cifrada=msg.clave_aes_cifrada,
                 timestamp=msg.timestamp,
-                remitente=msg.remitente.correo
+                id_sesion=msg.id_sesion_fk,
+                contador=msg.contador,
+                remitente=remitente.correo
             )
         )
 
@@ -139,11 +198,22 @@ def get_received_messages_from_user(
 # Route to  get individual messages
 @router.get("/message/sent", response_model=list[MessageReceived])
 def get_sent_messages(
+    response: Response,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: str | None = None,
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user),
     algoritmo_hash: str = "sha256"
 ):
-    messages = db.query(Mensajes).filter(Mensajes.id_remitente == user.id_pk).order_by(Mensajes.timestamp.desc()).all()
+    messages, next_cursor = paginar_desc(
+        db.query(*COLUMNAS_MENSAJE, Mensajes.clave_aes, Mensajes.id_receptor, User.correo.label("receptor"))
+        .outerjoin(User, User.id_pk == Mensajes.id_receptor)
+        .filter(Mensajes.id_remitente == user.id_pk),
+        Mensajes.timestamp, Mensajes.id, limit, cursor
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
     message_responses = []
 
     for msg in messages:
@@ -151,7 +221,8 @@ def get_sent_messages(
             if msg.clave_aes is None:
                 raise ValueError("No se encuentra la clave AES para el remitente")
 
-            mensaje_descifrado = decrypt_message_aes(msg.mensaje, msg.clave_aes)
+            cifrado, nonce = partes_mensaje_cifrado(msg.mensaje, msg.cifrado, msg.nonce_cifrado)
+            mensaje_descifrado = descifrar_mensaje_aes(cifrado, nonce, msg.clave_aes)
             hash_recalculado = calcular_hash_mensaje(mensaje_descifrado, algoritmo_hash)
             if hash_recalculado != msg.hash_mensaje:
                 raise ValueError("Hash del mensaje no coincide")
@@ -168,7 +239,9 @@ def get_sent_messages(
                 clave_aes=msg.clave_aes,
                 clave_aes_cifrada=msg.clave_aes_cifrada,
                 timestamp=msg.timestamp,
-                remitente=msg.receptor.correo
+                id_sesion=msg.id_sesion_fk,
+                contador=msg.contador,
+                remitente=msg.receptor or (str(msg.id_receptor) if msg.id_receptor is not None else None)
             )
         )
 
@@ -178,6 +251,9 @@ def get_sent_messages(
 @router.get("/message/sent/{user_destino}", response_model=List[MessageReceived])
 def get_sent_messages_to_user(
     user_destino: str,
+    response: Response,
+    limit: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: str | None = None,
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user),
     algoritmo_hash: str = "sha256"
@@ -186,12 +262,13 @@ def get_sent_messages_to_user(
     if receptor is None:
         raise HTTPException(status_code=404, detail="Usuario destino no encontrado")
 
-    messages = (
-        db.query(Mensajes)
-        .filter(Mensajes.id_remitente == user.id_pk, Mensajes.id_receptor == receptor.id_pk)
-        .order_by(Mensajes.timestamp.desc())
-        .all()
+    messages, next_cursor = paginar_desc(
+        db.query(*COLUMNAS_MENSAJE, Mensajes.clave_aes)
+        .filter(Mensajes.id_remitente == user.id_pk, Mensajes.id_receptor == receptor.id_pk),
+        Mensajes.timestamp, Mensajes.id, limit, cursor
     )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
     message_responses = []
     for msg in messages:
@@ -199,7 +276,8 @@ def get_sent_messages_to_user(
             if msg.clave_aes is None:
                 raise ValueError("No se encuentra la clave AES para el remitente")
 
-            mensaje_descifrado = decrypt_message_aes(msg.mensaje, msg.clave_aes)
+            cifrado, nonce = partes_mensaje_cifrado(msg.mensaje, msg.cifrado, msg.nonce_cifrado)
+            mensaje_descifrado = descifrar_mensaje_aes(cifrado, nonce, msg.clave_aes)
             hash_recalculado = calcular_hash_mensaje(mensaje_descifrado, algoritmo_hash)
 
             if hash_recalculado != msg.hash_mensaje:
@@ -217,8 +295,31 @@ def get_sent_messages_to_user(
                 clave_aes=msg.clave_aes,
                 clave_aes_cifrada=msg.clave_aes_cifrada,
                 timestamp=msg.timestamp,
-                remitente=msg.receptor.correo
+                id_sesion=msg.id_sesion_fk,
+                contador=msg.contador,
+                remitente=receptor.correo
             )
         )
 
     return message_responses
+
+# Route to get the encrypted seed of a conversation session
+@router.get("/sesion/{id_sesion}", response_model=SesionMensajesResponse)
+def get_session(
+    id_sesion: int,
+    db: Session = Depends(get_db),
+    user: User = Depends(get_current_user)
+):
+    """Semilla cifrada de una sesión, para que el receptor derive las claves de sus mensajes."""
+    sesion = obtener_sesion_mensajes(db, id_sesion)
+    if sesion is None:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    if user.id_pk not in (sesion.id_remitente_fk, sesion.id_receptor_fk):
+        raise HTTPException(status_code=403, detail="No tienes acceso a esta sesión")
+
+    return SesionMensajesResponse(
+        id_sesion=sesion.id_pk,
+        id_remitente=sesion.id_remitente_fk,
+        id_receptor=sesion.id_receptor_fk,
+        clave_cadena_cifrada=sobre_para_respuesta(sesion.clave_cadena_cifrada)
+    )
@@ -0,0 +1,30 @@
+from fastapi import APIRouter
+
+from backend.controllers.cache_claves import cache_claves_publicas
+from backend.controllers.conversion_cifrados import conversor_cifrados
+from backend.controllers.minero import minero
+from backend.controllers.pool_claves import pool_claves_ecc
+from backend.controllers.sesiones_grupo import cadenas_grupo
+from backend.controllers.sesiones_mensajes import cadenas_mensajes
+from backend.utils.ejecutor_cripto import ejecutor_cripto
+
+router = APIRouter()
+
+
+@router.get("/")
+def obtener_metricas():
+    """
+    Métricas de rendimiento del servidor: dificultad y hashrate del minado de bloques
+    aciertos de la caché de claves públicas parseadas, cola del ejecutor criptográfico
+    profundidad del pool de claves ECC pregeneradas, sesiones de grupos y conversaciones y
+    progreso de la conversión de cifrados a columnas binarias.
+    """
+    return {
+        "minero": minero.metricas(),
+        "claves_publicas": cache_claves_publicas.metricas(),
+        "ejecutor_cripto": ejecutor_cripto.metricas(),
+        "pool_claves_ecc": pool_claves_ecc.metricas(),
+        "sesiones_grupo": cadenas_grupo.metricas(),
+        "sesiones_mensajes": cadenas_mensajes.metricas(),
+        "conversion_cifrados": conversor_cifrados.metricas()
+    }
@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class ContadorConsultas:
+    """Acumula las sentencias SQL ejecutadas por un motor mientras está registrado."""
+
+    def __init__(self):
+        self.sentencias: list[str] = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.sentencias.append(statement)
+
+    @property
+    def total(self) -> int:
+        return len(self.sentencias)
+
+
+@contextmanager
+def contar_consultas(engine: Engine | None = None):
+    """
+    Cuenta las sentencias que se ejecutan dentro del bloque.
+
+    Uso en pruebas::
+
+        with contar_consultas() as contador:
+            client.get("/msg/message/received", headers=headers)
+        print(contador.total)
+
+    :param engine: Motor a observar; por defecto el de ``backend.database.db``
+    :return: ContadorConsultas con las sentencias ejecutadas
+    """
+    if engine is None:
+        from backend.database import db
+        engine = db.engine
+
+    contador = ContadorConsultas()
+    event.listen(engine, "before_cursor_execute", contador)
+    try:
+        yield contador
+    finally:
+        event.remove(engine, "before_cursor_execute", contador)
+
+
+@contextmanager
+def limitar_consultas(maximo: int, engine: Engine | None = None):
+    """
+    Falla con ``AssertionError`` si el bloque ejecuta más de ``maximo`` sentencias.
+    Sirve para detectar cargas N+1 en los endpoints de listado.
+
+    :param maximo: Número máximo de sentencias permitidas
+    :param engine: Motor a observar; por defecto el de ``backend.database.db``
+    :return: ContadorConsultas con las sentencias ejecutadas
+    """
+    with contar_consultas(engine) as contador:
+        yield contador
+
+    if contador.total > maximo:
+        detalle = "\n".join(f"  {i + 1}. {sentencia}" for i, sentencia in enumerate(contador.sentencias))
+        raise AssertionError(f"Se ejecutaron {contador.total} consultas (máximo {maximo}):\n{detalle}")
+
+
+if __name__ == "__main__":
+    # Comprobación de los listados: bandeja de entrada, enviados e historial de grupo ejecutan un
+    # número fijo de sentencias (sin cargas N+1) sea cual sea el número de filas que devuelven.
+    # Usa una base de datos temporal: DB_PATH se fija antes de importar la aplicación.
+    import os
+    import tempfile
+
+    MAXIMO_CONSULTAS = 4
+
+    with tempfile.TemporaryDirectory() as directorio:
+        os.environ["DB_PATH"] = os.path.join(directorio, "consultas.db")
+
+        from fastapi.testclient import TestClient
+
+        from backend.database import db
+        from backend.main import app
+
+        with TestClient(app) as client:
+            def registrar(nombre: str) -> dict:
+                correo = f"{nombre}@consultas.com"
+                registro = client.post("/auth/register", json={"email": correo, "password": "consultas1234", "name": nombre})
+                sesion = client.post("/auth/login", json={"email": correo, "password": "consultas1234"}).json()
+                return {
+                    "correo": correo,
+                    "id": sesion["user"]["id"],
+                    "clave": registro.json()["private_key"],
+                    "cabeceras": {"Authorization": f"Bearer {sesion['access_token']}"},
+                }
+
+            ana, beto, caro = registrar("ana"), registrar("beto"), registrar("caro")
+            grupo = client.post("/grupos/newGroup", json={"nombre": "consultas", "miembros_ids": [beto["id"], caro["id"]]}, headers=ana["cabeceras"]).json()
+
+            listados = [
+                ("/msg/message/received?limit=50", beto),
+                (f"/msg/message/received/{ana['correo']}?limit=50", beto),
+                ("/msg/message/sent?limit=50", ana),
+                (f"/msg/message/sent/{beto['correo']}?limit=50", ana),
+                (f"/grupos/GroupMessages/{grupo['id_pk']}", beto),
+            ]
+
+            def enviar(cantidad: int):
+                for i in range(cantidad):
+                    for remitente in (ana, caro):
+                        client.post(f"/msg/message/{beto['correo']}", json={"mensaje": f"m{i}", "clave_privada_pem": remitente["clave"]}, headers=remitente["cabeceras"])
+                        client.post(f"/grupos/group/message/{grupo['id_pk']}", json={"mensaje": f"g{i}", "clave_privada_usuario_pem": remitente["clave"]}, headers=remitente["cabeceras"])
+
+            def contar() -> dict:
+                totales = {}
+                for ruta, usuario in listados:
+                    with limitar_consultas(MAXIMO_CONSULTAS) as contador:
+                        respuesta = client.get(ruta, headers=usuario["cabeceras"])
+                    assert respuesta.status_code == 200, respuesta.text
+                    totales[ruta] = (len(respuesta.json()), contador.total)
+                return totales
+
+            enviar(1)
+            pocas = contar()
+            enviar(10)
+            muchas = contar()
+
+            for ruta, _ in listados:
+                (filas_antes, consultas_antes), (filas, consultas) = pocas[ruta], muchas[ruta]
+                assert filas > filas_antes, ruta
+                assert consultas == consultas_antes, f"{ruta}: {consultas_antes} -> {consultas} consultas"
+                print(f"{ruta}: {filas} filas en {consultas} consultas")
+
+        db.engine.dispose()
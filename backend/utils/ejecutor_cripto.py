@@ -0,0 +1,175 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from typing import Callable, Iterable, Iterator
+
+from fastapi import HTTPException
+
+# Hilos dedicados a operaciones criptográficas (OpenSSL y Argon2 liberan el GIL)
+TRABAJADORES_CRIPTO = int(os.getenv("CRIPTO_TRABAJADORES", str(min(8, os.cpu_count() or 1))))
+# Tareas esperando un hilo a partir de las cuales las rutas async responden 503
+MAX_COLA_CRIPTO = int(os.getenv("CRIPTO_MAX_COLA", str(TRABAJADORES_CRIPTO * 32)))
+# Segundos que se sugieren al cliente en Retry-After cuando la cola está llena
+REINTENTAR_CRIPTO_SEGUNDOS = int(os.getenv("CRIPTO_RETRY_AFTER_SEGUNDOS", "1"))
+
+
+class EjecutorCripto:
+    """
+    Pool de hilos acotado para el trabajo criptográfico pesado (Argon2, generación de claves,
+    ECDH, firmas), fuera del event loop. Lleva la cuenta de la cola y del tiempo de espera;
+    las rutas async que lo usan reciben un 503 con Retry-After cuando la cola está llena.
+    Las operaciones por lotes mantienen una ventana de tareas pendientes para no acaparar la cola.
+    """
+
+    def __init__(
+            self,
+            trabajadores: int = TRABAJADORES_CRIPTO,
+            max_cola: int = MAX_COLA_CRIPTO,
+            reintentar_segundos: int = REINTENTAR_CRIPTO_SEGUNDOS
+    ):
+        self.trabajadores = trabajadores
+        self.max_cola = max_cola
+        self.reintentar_segundos = reintentar_segundos
+        # Tareas de un mismo lote pendientes en el pool como mucho
+        self.ventana_lote = trabajadores * 4
+
+        self._ejecutor = None
+        self._lock = threading.Lock()
+        self._en_cola = 0
+        self._en_ejecucion = 0
+        self._iniciadas = 0
+        self._completadas = 0
+        self._rechazadas = 0
+        self._espera_total = 0.0
+        self._espera_maxima = 0.0
+
+    def _obtener_ejecutor(self) -> ThreadPoolExecutor:
+        # Se llama con self._lock tomado
+        if self._ejecutor is None:
+            self._ejecutor = ThreadPoolExecutor(max_workers=self.trabajadores, thread_name_prefix="cripto")
+        return self._ejecutor
+
+    def enviar(self, funcion: Callable, *args, **kwargs) -> Future:
+        """Envía una tarea al pool contabilizando su espera en la cola."""
+        encolada = time.perf_counter()
+
+        def tarea():
+            espera = time.perf_counter() - encolada
+            with self._lock:
+                self._en_cola -= 1
+                self._en_ejecucion += 1
+                self._iniciadas += 1
+                self._espera_total += espera
+                self._espera_maxima = max(self._espera_maxima, espera)
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._en_ejecucion -= 1
+                    self._completadas += 1
+
+        with self._lock:
+            self._en_cola += 1
+            ejecutor = self._obtener_ejecutor()
+        return ejecutor.submit(tarea)
+
+    def _admitir(self):
+        """Lanza un 503 con Retry-After si ya hay ``max_cola`` tareas esperando."""
+        with self._lock:
+            if self._en_cola >= self.max_cola:
+                self._rechazadas += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Servidor ocupado, inténtalo de nuevo en unos segundos",
+                    headers={"Retry-After": str(self.reintentar_segundos)}
+                )
+
+    async def ejecutar(self, funcion: Callable, *args, **kwargs):
+        """
+        Ejecuta ``funcion`` en el pool desde una ruta async sin bloquear el event loop.
+
+        :raises HTTPException: 503 con Retry-After si ya hay ``max_cola`` tareas esperando
+        :return: Resultado de la función
+        """
+        self._admitir()
+        return await asyncio.wrap_future(self.enviar(funcion, *args, **kwargs))
+
+    async def ejecutar_en_hilo(self, funcion: Callable, *args, **kwargs):
+        """
+        Ejecuta desde una ruta async una función que a su vez reparte trabajo en el pool.
+        Corre en un hilo aparte (no en el pool, para no ocupar un trabajador esperando a los demás).
+
+        :raises HTTPException: 503 con Retry-After si ya hay ``max_cola`` tareas esperando
+        :return: Resultado de la función
+        """
+        self._admitir()
+        return await asyncio.to_thread(funcion, *args, **kwargs)
+
+    async def mapear_en_orden_async(self, funcion: Callable, elementos: Iterable) -> list:
+        """Versión de ``mapear_en_orden`` para rutas async (ver ``ejecutar_en_hilo``)."""
+        return await self.ejecutar_en_hilo(self.mapear_en_orden, funcion, elementos)
+
+    def mapear_en_orden(self, funcion: Callable, elementos: Iterable) -> list:
+        """
+        Aplica ``funcion`` a cada elemento en el pool y devuelve los resultados en el mismo
+        orden que los elementos.
+
+        :param funcion: Función a aplicar; no debe lanzar excepciones que no se quieran propagar
+        :param elementos: Elementos de entrada
+        :return: Lista de resultados
+        """
+        resultados = []
+        pendientes = deque()
+        for elemento in elementos:
+            pendientes.append(self.enviar(funcion, elemento))
+            if len(pendientes) >= self.ventana_lote:
+                resultados.append(pendientes.popleft().result())
+        resultados.extend(tarea.result() for tarea in pendientes)
+        return resultados
+
+    def mapear_a_medida(self, funcion: Callable, elementos: Iterable) -> Iterator:
+        """
+        Aplica ``funcion`` a cada elemento en el pool y produce los resultados a medida que
+        terminan (sin orden). Los elementos se pueden consumir de un generador sin cargarlos
+        todos en memoria.
+
+        :param funcion: Función a aplicar; no debe lanzar excepciones que no se quieran propagar
+        :param elementos: Elementos de entrada
+        :return: Generador de resultados
+        """
+        pendientes = set()
+        for elemento in elementos:
+            pendientes.add(self.enviar(funcion, elemento))
+            if len(pendientes) >= self.ventana_lote:
+                terminadas, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                for tarea in terminadas:
+                    yield tarea.result()
+        for tarea in as_completed(pendientes):
+            yield tarea.result()
+
+    def metricas(self) -> dict:
+        """Devuelve la profundidad de la cola y el tiempo de espera medio y máximo."""
+        with self._lock:
+            return {
+                "trabajadores": self.trabajadores,
+                "max_cola": self.max_cola,
+                "en_cola": self._en_cola,
+                "en_ejecucion": self._en_ejecucion,
+                "completadas": self._completadas,
+                "rechazadas": self._rechazadas,
+                "espera_media_ms": round(self._espera_total / self._iniciadas * 1000, 3) if self._iniciadas else None,
+                "espera_maxima_ms": round(self._espera_maxima * 1000, 3),
+            }
+
+    def cerrar(self):
+        """Espera a las tareas en curso y cierra el pool si se llegó a crear."""
+        with self._lock:
+            ejecutor, self._ejecutor = self._ejecutor, None
+        if ejecutor is not None:
+            ejecutor.shutdown(wait=True)
+
+
+ejecutor_cripto = EjecutorCripto()
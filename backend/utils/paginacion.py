@@ -0,0 +1,66 @@
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+
+# Límites de página para los listados paginados
+LIMITE_POR_DEFECTO = 50
+LIMITE_MAXIMO = 200
+
+
+def codificar_cursor(timestamp: datetime, id_fila: int) -> str:
+    """Codifica la posición (timestamp, id) de la última fila entregada como cursor opaco."""
+    datos = json.dumps({"t": timestamp.isoformat(), "id": id_fila}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(datos.encode()).decode().rstrip("=")
+
+
+def decodificar_cursor(cursor: str) -> tuple[datetime, int]:
+    """Decodifica un cursor generado por ``codificar_cursor``; lanza 400 si no es válido."""
+    try:
+        relleno = "=" * (-len(cursor) % 4)
+        datos = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+        return datetime.fromisoformat(datos["t"]), int(datos["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+
+def paginar_desc(query, columna_timestamp, columna_id, limit: int, cursor: str | None = None):
+    """
+    Aplica paginación por keyset sobre (timestamp, id) en orden descendente.
+
+    La consulta se apoya en los índices ``(filtro, timestamp)``: SQLite añade el rowid
+    al final de cada índice, así que el desempate por id también lo resuelve el índice.
+
+    :param query: Consulta ya filtrada; debe seleccionar las columnas de timestamp e id
+    :param columna_timestamp: Columna de fecha por la que se ordena
+    :param columna_id: Columna id usada para desempatar
+    :param limit: Número máximo de filas a devolver
+    :param cursor: Cursor opaco de la página anterior, o None para la primera página
+    :return: Tupla (filas, next_cursor); next_cursor es None si no hay más filas
+    """
+    if cursor:
+        timestamp, id_fila = decodificar_cursor(cursor)
+        query = query.filter(or_(
+            columna_timestamp < timestamp,
+            and_(columna_timestamp == timestamp, columna_id < id_fila),
+        ))
+
+    filas = (
+        query
+        .order_by(columna_timestamp.desc(), columna_id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+
+    next_cursor = None
+    if len(filas) > limit:
+        filas = filas[:limit]
+        ultima = filas[-1]
+        next_cursor = codificar_cursor(
+            getattr(ultima, columna_timestamp.key),
+            getattr(ultima, columna_id.key),
+        )
+
+    return filas, next_cursor
@@ -0,0 +1,44 @@
+import base64
+import json
+from datetime import datetime
+from typing import Iterable
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+MEDIA_TYPE_NDJSON = "application/x-ndjson"
+
+# Filas que se traen de SQLite por cada viaje del cursor al hacer streaming
+TAMANO_LOTE_STREAMING = 500
+
+
+def acepta_ndjson(request: Request) -> bool:
+    """Indica si el cliente pidió la respuesta como NDJSON (``Accept: application/x-ndjson``)."""
+    return MEDIA_TYPE_NDJSON in request.headers.get("accept", "")
+
+
+def _serializar(valor):
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    if isinstance(valor, bytes):
+        return base64.b64encode(valor).decode()
+    if hasattr(valor, "model_dump"):
+        return valor.model_dump()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def respuesta_ndjson(filas: Iterable) -> StreamingResponse:
+    """
+    Devuelve un ``StreamingResponse`` que escribe una fila JSON por línea a medida que
+    el iterable las produce, sin construir la lista completa en memoria.
+
+    :param filas: Iterable (normalmente un generador) de diccionarios o modelos Pydantic
+    :return: Respuesta NDJSON
+    """
+    def generar():
+        for fila in filas:
+            if hasattr(fila, "model_dump"):
+                fila = fila.model_dump()
+            yield json.dumps(fila, default=_serializar, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generar(), media_type=MEDIA_TYPE_NDJSON)
@@ -21,6 +21,9 @@ import SearchIcon from "@mui/icons-material/Search";
 import { useNavigate } from "react-router-dom";
 import * as Decrypt from "./DecryptMessage.jsx";
 
+// Mensajes recibidos (y otros tantos enviados) que se piden por página
+const MENSAJES_POR_PAGINA = 50;
+
 function ChatPage() {
   const [tab, setTab] = useState(0);
   const [message, setMessage] = useState("");
@@ -46,6 +49,10 @@ function ChatPage() {
   const [grupoActualId, setGrupoActualId] = useState(null);
   const [activeGroup, setActiveGroup] = useState(null);
   const [groupMessages, setGroupMessages] = useState([]); // mensajes grupales
+  // Cursores de la siguiente página de recibidos y enviados (null cuando no hay más)
+  const [cursorRecibidos, setCursorRecibidos] = useState(null);
+  const [cursorEnviados, setCursorEnviados] = useState(null);
+  const [cargandoAnteriores, setCargandoAnteriores] = useState(false);
 
   const mensajesVisibles = activeGroup ? groupMessages : messages;
 
@@ -249,29 +256,41 @@ function ChatPage() {
       const mensajes = await resMsgs.json();
       console.log("📦 Mensajes cifrados obtenidos:", mensajes);
 
-      const resClave = await fetch(
-        "https://cf-backend.albrand.tech/grupos/descifrar_llave_privada",
-        {
-          method: "POST",
-          headers: {
-            "Content-Type": "application/json",
-            Authorization: `Bearer ${accessToken}`,
-          },
-          body: JSON.stringify({
-            group_id: grupo.id_pk,
-            user_private_key_pem: privateKeyPem,
-          }),
-        }
-      );
+      // La llave del grupo cambia en cada alta o baja de miembros: cada mensaje se descifra con la
+      // llave de su época, y cada época se pide una sola vez
+      const llavesPorEpoca = {};
+      const obtenerLlaveDeEpoca = (epoca) => {
+        if (!llavesPorEpoca[epoca]) {
+          llavesPorEpoca[epoca] = (async () => {
+            const resClave = await fetch(
+              "https://cf-backend.albrand.tech/grupos/descifrar_llave_privada",
+              {
+                method: "POST",
+                headers: {
+                  "Content-Type": "application/json",
+                  Authorization: `Bearer ${accessToken}`,
+                },
+                body: JSON.stringify({
+                  group_id: grupo.id_pk,
+                  user_private_key_pem: privateKeyPem,
+                  epoca,
+                }),
+              }
+            );
 
-      if (!resClave.ok) {
-        const errorText = await resClave.text();
-        console.error("❌ Error descifrando llave:", errorText);
-        throw new Error("Error al descifrar la llave privada del grupo");
-      }
+            if (!resClave.ok) {
+              const errorText = await resClave.text();
+              console.error("❌ Error descifrando llave:", errorText);
+              throw new Error("Error al descifrar la llave privada del grupo");
+            }
 
-      const { llave_privada_grupo } = await resClave.json();
-      console.log("🔑 Llave privada del grupo descifrada");
+            const { llave_privada_grupo } = await resClave.json();
+            console.log(`🔑 Llave privada del grupo descifrada (época ${epoca})`);
+            return llave_privada_grupo;
+          })();
+        }
+        return llavesPorEpoca[epoca];
+      };
 
       const mensajesDescifrados = await Promise.all(
         mensajes.map(async (msg) => {
@@ -279,10 +298,8 @@ function ChatPage() {
             console.log("📨 Mensaje recibido:", msg);
             console.log("🔍 Usuarios cargados:", users);
 
-            let claveParsed = msg.clave_aes_cifrada;
-            if (typeof claveParsed === "string") {
-              claveParsed = JSON.parse(claveParsed);
-            }
+            const claveParsed = Decrypt.parsearClaveCifrada(msg.clave_aes_cifrada);
+            const llave_privada_grupo = await obtenerLlaveDeEpoca(msg.epoca ?? 0);
 
             const resDescifrado = await fetch(
               "https://cf-backend.albrand.tech/grupos/descifrar_mensaje_grupo",
@@ -418,76 +435,116 @@ function ChatPage() {
     }
   };
 
-  useEffect(() => {
-    const getAllMessages = async () => {
-      if (!activeUser || !privateKeyPem) return;
-
-      try {
-        // 1. Fetch recibidos
-        const resReceived = await fetch(
-          `https://cf-backend.albrand.tech/msg/message/received/${activeUser.correo}`,
-          {
-            headers: { Authorization: `Bearer ${accessToken}` },
-          }
-        );
-        if (!resReceived.ok)
-          throw new Error("Error al obtener mensajes recibidos");
-        const receivedData = await resReceived.json();
-
-        const mensajesRecibidos = await Promise.all(
-          receivedData.map(async (msg) => {
-            try {
-              const contenido = JSON.parse(msg.message);
-              const clave = JSON.parse(msg.clave_aes_cifrada);
-              const textoPlano = await Decrypt.descifrarTodo(
-                clave,
-                contenido,
-                privateKeyPem
-              );
-              return {
-                text: textoPlano,
-                type: "received",
-                timestamp: msg.timestamp,
-              };
-            } catch (e) {
-              console.error("Error descifrando recibido:", e);
-              return null;
-            }
-          })
-        );
+  // Pide una página de la conversación con el usuario activo. El backend devuelve primero los más
+  // recientes y el cursor de la página siguiente (más antigua) en la cabecera X-Next-Cursor
+  const obtenerPaginaMensajes = async (tipo, cursor) => {
+    const params = new URLSearchParams({ limit: MENSAJES_POR_PAGINA });
+    if (cursor) params.set("cursor", cursor);
+    const res = await fetch(
+      `https://cf-backend.albrand.tech/msg/message/${tipo}/${activeUser.correo}?${params}`,
+      {
+        headers: { Authorization: `Bearer ${accessToken}` },
+      }
+    );
+    if (!res.ok)
+      throw new Error(
+        tipo === "received"
+          ? "Error al obtener mensajes recibidos"
+          : "Error al obtener mensajes enviados"
+      );
+    return {
+      datos: await res.json(),
+      siguiente: res.headers.get("X-Next-Cursor"),
+    };
+  };
 
-        // 2. Fetch enviados
-        const resSent = await fetch(
-          `https://cf-backend.albrand.tech/msg/message/sent/${activeUser.correo}`,
-          {
-            headers: { Authorization: `Bearer ${accessToken}` },
-          }
-        );
-        if (!resSent.ok) throw new Error("Error al obtener mensajes enviados");
-        const sentData = await resSent.json();
+  const descifrarRecibidos = async (receivedData) => {
+    const mensajesRecibidos = await Promise.all(
+      receivedData.map(async (msg) => {
+        try {
+          const contenido = JSON.parse(msg.message);
+          const clave = Decrypt.parsearClaveCifrada(msg.clave_aes_cifrada);
+          const textoPlano = await Decrypt.descifrarTodo(
+            clave,
+            contenido,
+            privateKeyPem
+          );
+          return {
+            text: textoPlano,
+            type: "received",
+            timestamp: msg.timestamp,
+          };
+        } catch (e) {
+          console.error("Error descifrando recibido:", e);
+          return null;
+        }
+      })
+    );
+    return mensajesRecibidos.filter(Boolean);
+  };
 
-        const mensajesEnviados = sentData.map((msg) => ({
+  // Carga una página de recibidos y otra de enviados y las une a los mensajes ya mostrados.
+  // Con `inicial` empieza por los más recientes; si no, sigue los cursores guardados y solo
+  // pide los tipos que aún tienen páginas
+  const cargarMensajes = async (inicial) => {
+    const [recibidos, enviados] = await Promise.all([
+      inicial || cursorRecibidos
+        ? obtenerPaginaMensajes("received", inicial ? null : cursorRecibidos)
+        : null,
+      inicial || cursorEnviados
+        ? obtenerPaginaMensajes("sent", inicial ? null : cursorEnviados)
+        : null,
+    ]);
+
+    const nuevos = [];
+    if (recibidos) {
+      nuevos.push(...(await descifrarRecibidos(recibidos.datos)));
+      setCursorRecibidos(recibidos.siguiente);
+    }
+    if (enviados) {
+      nuevos.push(
+        ...enviados.datos.map((msg) => ({
           text: msg.message,
           type: "sent",
           timestamp: msg.timestamp,
-        }));
+        }))
+      );
+      setCursorEnviados(enviados.siguiente);
+    }
+
+    setMessages((prev) => {
+      const todos = inicial ? nuevos : [...nuevos, ...prev];
+      todos.sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
+      return todos;
+    });
+  };
 
-        // 3. Combinar, filtrar nulos y ordenar
-        const todos = [
-          ...mensajesRecibidos.filter(Boolean),
-          ...mensajesEnviados,
-        ];
-        todos.sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
+  const handleCargarAnteriores = async () => {
+    setCargandoAnteriores(true);
+    try {
+      await cargarMensajes(false);
+    } catch (error) {
+      console.error("Error obteniendo mensajes anteriores:", error);
+    } finally {
+      setCargandoAnteriores(false);
+    }
+  };
 
-        // 4. Guardar
-        setMessages(todos);
+  useEffect(() => {
+    const getAllMessages = async () => {
+      if (!activeUser || !privateKeyPem) return;
+
+      try {
+        await cargarMensajes(true);
       } catch (error) {
         console.error("Error obteniendo mensajes:", error);
       }
     };
 
-    // Limpiar mensajes antes de cargar nuevos al cambiar de usuario
+    // Limpiar mensajes y cursores antes de cargar nuevos al cambiar de usuario
     setMessages([]);
+    setCursorRecibidos(null);
+    setCursorEnviados(null);
     getAllMessages();
   }, [activeUser, accessToken, privateKeyPem]);
 
@@ -756,6 +813,17 @@ function ChatPage() {
             backgroundColor: "#fff",
           }}
         >
+          {!activeGroup && (cursorRecibidos || cursorEnviados) && (
+            <Button
+              variant="text"
+              size="small"
+              disabled={cargandoAnteriores}
+              onClick={handleCargarAnteriores}
+              sx={{ alignSelf: "center", textTransform: "none" }}
+            >
+              {cargandoAnteriores ? "Cargando..." : "Cargar mensajes anteriores"}
+            </Button>
+          )}
           {mensajesVisibles.length === 0 ? (
             <Typography color="#888" textAlign="center">
               No hay mensajes aún
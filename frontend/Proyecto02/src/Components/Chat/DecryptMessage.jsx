@@ -1,3 +1,100 @@
+// Sobre ECIES binario del backend (ver backend/controllers/sobre.py), en base64:
+// versión (1 byte) | clave pública efímera comprimida (33 bytes) | nonce (12 bytes) | ciphertext + tag.
+// La versión y la clave efímera van como datos asociados del AES-GCM.
+const VERSION_SOBRE = 1;
+const LONGITUD_CABECERA_SOBRE = 34;
+const LONGITUD_NONCE_SOBRE = 12;
+
+// Parámetros de P-256 para descomprimir la clave efímera (WebCrypto solo importa puntos sin comprimir)
+const P256_P = BigInt("0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff");
+const P256_B = BigInt("0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b");
+
+function base64ABytes(base64) {
+  return Uint8Array.from(atob(base64), c => c.charCodeAt(0));
+}
+
+function modulo(a, m) {
+  const r = a % m;
+  return r < 0n ? r + m : r;
+}
+
+function potenciaModular(base, exponente, m) {
+  let resultado = 1n;
+  base = modulo(base, m);
+  while (exponente > 0n) {
+    if (exponente & 1n) resultado = (resultado * base) % m;
+    base = (base * base) % m;
+    exponente >>= 1n;
+  }
+  return resultado;
+}
+
+function enteroABytes(valor) {
+  return Uint8Array.from(valor.toString(16).padStart(64, "0").match(/../g), h => parseInt(h, 16));
+}
+
+function descomprimirPunto(comprimido) {
+  const x = BigInt("0x" + Array.from(comprimido.slice(1), b => b.toString(16).padStart(2, "0")).join(""));
+  const y2 = modulo(x * x * x - 3n * x + P256_B, P256_P);
+  // p ≡ 3 (mod 4): la raíz cuadrada es y2^((p + 1) / 4)
+  let y = potenciaModular(y2, (P256_P + 1n) / 4n, P256_P);
+  if (Number(y & 1n) !== (comprimido[0] & 1)) y = P256_P - y;
+
+  const punto = new Uint8Array(65);
+  punto[0] = 0x04;
+  punto.set(enteroABytes(x), 1);
+  punto.set(enteroABytes(y), 33);
+  return punto;
+}
+
+/**
+ * Normaliza el campo clave_aes_cifrada de la API: los mensajes antiguos traen el JSON
+ * {encrypted_key, nonce, ephemeral_public_key} (como texto u objeto) y los nuevos el sobre
+ * binario en base64, que se devuelve tal cual.
+ */
+export function parsearClaveCifrada(valor) {
+  if (typeof valor === "string" && valor.trim().startsWith("{")) {
+    return JSON.parse(valor);
+  }
+  return valor;
+}
+
+async function abrirSobre(sobreBase64, privateKey) {
+  const sobre = base64ABytes(sobreBase64);
+  if (sobre[0] !== VERSION_SOBRE) {
+    throw new Error(`Versión de sobre ECIES no soportada: ${sobre[0]}`);
+  }
+  const cabecera = sobre.slice(0, LONGITUD_CABECERA_SOBRE);
+  const nonce = sobre.slice(LONGITUD_CABECERA_SOBRE, LONGITUD_CABECERA_SOBRE + LONGITUD_NONCE_SOBRE);
+
+  const publicKeyEphemeral = await crypto.subtle.importKey(
+    "raw",
+    descomprimirPunto(cabecera.slice(1)),
+    { name: "ECDH", namedCurve: "P-256" },
+    false,
+    []
+  );
+  const derivedKey = await deriveSharedKey(privateKey, publicKeyEphemeral);
+  return crypto.subtle.decrypt(
+    { name: "AES-GCM", iv: nonce, additionalData: cabecera },
+    derivedKey,
+    sobre.slice(LONGITUD_CABECERA_SOBRE + LONGITUD_NONCE_SOBRE)
+  );
+}
+
+async function abrirClaveJson(claveCifrada, privateKey) {
+  const publicKeyEphemeral = await importPublicKey(claveCifrada.ephemeral_public_key);
+  const derivedKey = await deriveSharedKey(privateKey, publicKeyEphemeral);
+
+  const encryptedKey = base64ABytes(claveCifrada.encrypted_key);
+  const nonceKey = base64ABytes(claveCifrada.nonce);
+  return window.crypto.subtle.decrypt(
+    { name: "AES-GCM", iv: nonceKey },
+    derivedKey,
+    encryptedKey
+  );
+}
+
 export async function importPrivateKey(pem) {
   try {
     console.log("Importando clave privada...");
@@ -137,19 +234,12 @@ export async function descifrarTodo(claveCifrada, contenido, clavePrivadaPem) {
   try {
     console.log("Iniciando proceso completo de descifrado...");
     const privateKey = await importPrivateKey(clavePrivadaPem);
-    const publicKeyEphemeral = await importPublicKey(claveCifrada.ephemeral_public_key);
-
-    const derivedKey = await deriveSharedKey(privateKey, publicKeyEphemeral);
-
-    const encryptedKey = Uint8Array.from(atob(claveCifrada.encrypted_key), c => c.charCodeAt(0));
-    const nonceKey = Uint8Array.from(atob(claveCifrada.nonce), c => c.charCodeAt(0));
 
     console.log("Descifrando clave AES...");
-    const aesKeyBuffer = await window.crypto.subtle.decrypt(
-      { name: "AES-GCM", iv: nonceKey },
-      derivedKey,
-      encryptedKey
-    );
+    const clave = parsearClaveCifrada(claveCifrada);
+    const aesKeyBuffer = typeof clave === "string"
+      ? await abrirSobre(clave, privateKey)
+      : await abrirClaveJson(clave, privateKey);
     console.log("Clave AES descifrada con éxito.");
 
     const aesKey = await window.crypto.subtle.importKey(